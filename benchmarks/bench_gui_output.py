@@ -0,0 +1,90 @@
+import os
+import time
+
+import click
+
+# render without a display unless one is requested explicitly
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PySide2.QtGui import QTextCursor  # noqa: E402
+from PySide2.QtWidgets import QApplication, QTextEdit  # noqa: E402
+
+from wsmonitor.gui.process_widget import ProcessOutputTabWidget  # noqa: E402
+from wsmonitor.process.data import OutputEvent  # noqa: E402
+
+FRAME_RATE = 60
+
+
+class LegacyOutputWidget(QTextEdit):
+    # the previous implementation: unbounded QTextEdit, one insert per event
+
+    def append_event(self, event: OutputEvent):
+        self.moveCursor(QTextCursor.End)
+        self.insertPlainText(event.output)
+
+
+def make_event(lines: int, line_no: int) -> OutputEvent:
+    event = OutputEvent("bench", "", [])
+    now, mono = time.time(), time.monotonic()
+    for stream in (OutputEvent.STDOUT, OutputEvent.STDERR):
+        count = lines // 2 if stream == OutputEvent.STDOUT else lines - lines // 2
+        text = "".join(f"{line_no + idx:10d} some output of the benchmark process\n" for idx in range(count))
+        event.extend(OutputEvent.from_chunk("bench", text, stream, now, mono))
+        line_no += count
+    return event
+
+
+def measure(app: QApplication, widget, lines_per_second: int, duration: float):
+    frame_budget = 1. / FRAME_RATE
+    lines_per_frame = max(lines_per_second // FRAME_RATE, 1)
+    frames = int(duration * FRAME_RATE)
+    dropped = 0
+    worst = 0.
+    line_no = 0
+
+    for _ in range(frames):
+        event = make_event(lines_per_frame, line_no)
+        line_no += lines_per_frame
+
+        start = time.perf_counter()
+        widget.append_event(event)
+        widget.repaint()
+        app.processEvents()
+        elapsed = time.perf_counter() - start
+
+        worst = max(worst, elapsed)
+        if elapsed > frame_budget:
+            dropped += 1
+        else:
+            time.sleep(frame_budget - elapsed)
+
+    return dropped / frames, worst
+
+
+@click.command()
+@click.option("--duration", default=3., help="Seconds per measured rate")
+@click.option("--legacy", is_flag=True, help="Measure the previous QTextEdit based output")
+@click.option("--max-dropped", default=.01, help="Tolerated fraction of dropped frames")
+def main(duration: float, legacy: bool, max_dropped: float):
+    app = QApplication([])
+    sustained = 0
+    click.echo(f"{'lines/s':>10} {'dropped':>8} {'worst frame ms':>15}")
+    for lines_per_second in (1000, 5000, 10000, 25000, 50000, 100000, 200000, 400000):
+        widget = LegacyOutputWidget() if legacy else ProcessOutputTabWidget()
+        widget.resize(800, 600)
+        widget.show()
+
+        dropped, worst = measure(app, widget, lines_per_second, duration)
+        click.echo(f"{lines_per_second:>10} {dropped:>8.1%} {worst * 1000:>15.1f}")
+        widget.close()
+        widget.deleteLater()
+
+        if dropped > max_dropped:
+            break
+        sustained = lines_per_second
+
+    click.echo(f"Sustained without dropping frames: {sustained} lines/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+import click
+
+from wsmonitor.process.process_monitor import ProcessMonitor
+
+
+def make_ballast(megabytes: int) -> bytearray:
+    # touched memory makes the address space of the server large, as after
+    # buffering lots of output
+    ballast = bytearray(megabytes * 1024 * 1024)
+    for offset in range(0, len(ballast), 4096):
+        ballast[offset] = 1
+    return ballast
+
+
+async def measure(launcher: bool, starts: int, concurrency: int, command: str) -> float:
+    monitor = ProcessMonitor()
+    if launcher and not monitor.enable_launcher():
+        raise click.ClickException("Failed to start the launcher")
+    uids = [f"job-{idx}" for idx in range(concurrency)]
+    for uid in uids:
+        monitor.add_process(uid, command)
+
+    async def run_jobs(uid: str, count: int):
+        for _ in range(count):
+            await monitor.start_process(uid)
+
+    begin = time.perf_counter()
+    await asyncio.gather(*(run_jobs(uid, starts // concurrency) for uid in uids))
+    duration = time.perf_counter() - begin
+
+    if monitor._launcher is not None:
+        await monitor._launcher.close()
+    return starts // concurrency * concurrency / duration
+
+
+@click.command()
+@click.option("--starts", default=2000, help="Processes started per measurement")
+@click.option("--concurrency", default=8, help="Processes running at the same time")
+@click.option("--ballast", "ballast_sizes", multiple=True, type=int,
+              help="Memory in MB held by the server while starting, can be repeated")
+@click.option("--command", default="true", help="The started command")
+def main(starts: int, concurrency: int, ballast_sizes, command: str):
+    loop = asyncio.get_event_loop()
+    click.echo(f"Starting '{command}' {starts} times, {concurrency} at a time")
+    click.echo(f"{'ballast MB':>10} {'direct/s':>10} {'launcher/s':>11} {'speedup':>8}")
+    for megabytes in ballast_sizes or (0, 512, 2048):
+        ballast = make_ballast(megabytes)
+        direct = loop.run_until_complete(measure(False, starts, concurrency, command))
+        launched = loop.run_until_complete(measure(True, starts, concurrency, command))
+        del ballast
+        click.echo(f"{megabytes:>10} {direct:>10.0f} {launched:>11.0f} {launched / direct:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
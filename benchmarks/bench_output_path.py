@@ -0,0 +1,89 @@
+import random
+import string
+import time
+import tracemalloc
+
+import click
+
+from wsmonitor.process.data import OutputEvent
+from wsmonitor.wire import OutputFrame
+
+
+def make_chunks(count: int, lines_per_chunk: int, line_size: int):
+    rnd = random.Random(42)
+    lines = ["".join(rnd.choice(string.ascii_letters) for _ in range(line_size - 1)) + "\n"
+             for _ in range(100)]
+    return [("".join(rnd.choice(lines) for _ in range(lines_per_chunk))).encode() for _ in range(count)]
+
+
+def json_path(chunks, batch: int):
+    # decode every chunk, merge the events and encode them as json
+    for start in range(0, len(chunks), batch):
+        event = None
+        for chunk in chunks[start:start + batch]:
+            chunk_event = OutputEvent.from_chunk("process", chunk.decode(errors="replace"), 1, 0., 0.)
+            if event is None:
+                event = chunk_event
+            else:
+                event.extend(chunk_event)
+        event.offset = start
+        event.to_json_str()
+
+
+def frame_json_path(chunks, batch: int):
+    # raw output collected in a frame, decoded once for json clients
+    for start in range(0, len(chunks), batch):
+        frame = OutputFrame("process")
+        for chunk in chunks[start:start + batch]:
+            frame.append(chunk, 1, 0., 0.)
+        frame.finish(start)
+        frame.to_event().to_json_str()
+
+
+def frame_binary_path(chunks, batch: int):
+    for start in range(0, len(chunks), batch):
+        frame = OutputFrame("process")
+        for chunk in chunks[start:start + batch]:
+            frame.append(chunk, 1, 0., 0.)
+        frame.finish(start)
+
+
+PATHS = {"json": json_path, "frame+json": frame_json_path, "frame": frame_binary_path}
+
+
+def measure(path, chunks, batch: int, repeat: int):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        path(chunks, batch)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+
+    tracemalloc.start()
+    path(chunks, batch)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+@click.command()
+@click.option("--chunks", default=20000, help="Number of chunks read from the processes")
+@click.option("--lines", default=4, help="Lines per chunk")
+@click.option("--line-size", default=100, help="Bytes per line")
+@click.option("--batch", default=50, help="Chunks per broadcast")
+@click.option("--repeat", default=5, help="Repetitions, the fastest is reported")
+def main(chunks: int, lines: int, line_size: int, batch: int, repeat: int):
+    """
+    Compares the output path of json events with the binary frames: the
+    throughput from read chunks to the broadcast message and the peak of
+    the allocated memory.
+    """
+    data = make_chunks(chunks, lines, line_size)
+    size = sum(len(chunk) for chunk in data)
+    for name, path in PATHS.items():
+        duration, peak = measure(path, data, batch, repeat)
+        click.echo(f"{name:>12}: {size / duration / 1e6:8.1f} MB/s, peak {peak / 1e3:8.1f} kB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import asyncio
+
+import click
+
+from wsmonitor.bench import run_bench, write_results
+from wsmonitor.util import LOOP_BACKENDS
+
+# (processes, clients, lines per second and process)
+SCENARIOS = {
+    "baseline": (10, 4, 200),
+    "many_processes": (200, 2, 20),
+    "many_clients": (10, 50, 100),
+    "chatty": (4, 2, 10000),
+}
+
+
+@click.command()
+@click.option("--duration", default=10., help="Measured seconds per scenario")
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice(list(SCENARIOS)),
+              help="Only run these scenarios, all by default")
+@click.option("--loop", "loop_backends", multiple=True, type=click.Choice(LOOP_BACKENDS),
+              help="Event loops of the server to compare, the default loop by default")
+@click.option("--output", "output_path", default=None, help="Write the results as json to this file")
+def main(duration: float, scenarios, loop_backends, output_path: str):
+    loop = asyncio.get_event_loop()
+    results = {}
+    for name in scenarios or SCENARIOS:
+        processes, clients, rate = SCENARIOS[name]
+        for backend in loop_backends or ["default"]:
+            key = name if backend == "default" else f"{name}[{backend}]"
+            click.echo(f"Running {key}: {processes} processes, {clients} clients, {rate} lines/s", err=True)
+            results[key] = loop.run_until_complete(run_bench(processes, clients, duration, rate,
+                                                             server_args=["--loop", backend]))
+            summary = results[key]["results"]
+            click.echo(f"  p50 {summary['latency_ms']['p50']:.1f} ms, p99 {summary['latency_ms']['p99']:.1f} ms, "
+                       f"{summary['throughput_mb_s']:.2f} MB/s, cpu {summary['server_cpu']:.2f}", err=True)
+
+    text = write_results(results, output_path)
+    if text is not None:
+        click.echo(text)
+
+
+if __name__ == "__main__":
+    main()
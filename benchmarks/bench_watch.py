@@ -0,0 +1,91 @@
+import asyncio
+import random
+import re
+import string
+import time
+
+import click
+
+from wsmonitor.process.data import OutputEvent
+from wsmonitor.process.process_monitor import ProcessMonitor
+from wsmonitor.process.watch import WatchRule
+
+
+def make_chunks(total_bytes: int, chunk_size: int):
+    rnd = random.Random(42)
+    words = ["".join(rnd.choice(string.ascii_lowercase) for _ in range(rnd.randint(2, 10)))
+             for _ in range(500)]
+
+    chunks = []
+    size = 0
+    while size < total_bytes:
+        lines = []
+        chunk_len = 0
+        while chunk_len < chunk_size:
+            line = " ".join(rnd.choice(words) for _ in range(12)) + "\n"
+            lines.append(line)
+            chunk_len += len(line)
+        chunk = "".join(lines).encode()
+        chunks.append(chunk)
+        size += len(chunk)
+    return chunks, size
+
+
+def make_rules(count: int):
+    # patterns that (almost) never match, the common case for alerts
+    return [WatchRule(f"Error code {idx:04d}|Listening on port {idx}") for idx in range(count)]
+
+
+async def read_output(chunks, rules) -> float:
+    # the path of the output of a running process: read from the pipe,
+    # scanned by the watch rules and queued for the clients
+    monitor = ProcessMonitor()
+    process = monitor.add_process("bench", "true", watch_rules=rules)
+    reader = asyncio.StreamReader(limit=2 ** 16)
+    for chunk in chunks:
+        reader.feed_data(chunk)
+    reader.feed_eof()
+
+    start = time.perf_counter()
+    await process._read_stream(reader, monitor._on_process_output, OutputEvent.STDOUT)
+    return time.perf_counter() - start
+
+
+def measure(chunks, size: int, rules, repeat: int):
+    loop = asyncio.get_event_loop()
+    best = min(loop.run_until_complete(read_output(chunks, rules)) for _ in range(repeat))
+    return size / best / 1e6
+
+
+def measure_per_line(chunks, size: int, rules, repeat: int):
+    # the naive approach for comparison: one regex per rule and line
+    regexes = [re.compile(rule.pattern.encode()) for rule in rules]
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for chunk in chunks:
+            for line in chunk.splitlines():
+                for regex in regexes:
+                    regex.search(line)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return size / best / 1e6
+
+
+@click.command()
+@click.option("--megabytes", default=16, help="Amount of output to scan")
+@click.option("--chunk-size", default=64 * 1024, help="Size of the scanned chunks")
+@click.option("--repeat", default=3, help="Repetitions, the best one is reported")
+def main(megabytes: int, chunk_size: int, repeat: int):
+    chunks, size = make_chunks(megabytes * 1024 * 1024, chunk_size)
+    click.echo(f"Scanning {size / 1e6:.1f} MB in {len(chunks)} chunks")
+    click.echo(f"{'patterns':>8} {'output MB/s':>14} {'naive scan MB/s':>16}")
+    for count in (0, 10, 100):
+        rules = make_rules(count)
+        combined = measure(chunks, size, rules, repeat)
+        per_line = measure_per_line(chunks, size, rules, repeat) if count else float("nan")
+        click.echo(f"{count:>8} {combined:>14.1f} {per_line:>16.1f}")
+
+
+if __name__ == "__main__":
+    main()
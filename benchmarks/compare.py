@@ -0,0 +1,61 @@
+import json
+
+import click
+
+# metric path -> True if higher values are better
+METRICS = {
+    ("latency_ms", "p50"): False,
+    ("latency_ms", "p99"): False,
+    ("throughput_mb_s",): True,
+    ("lines_per_s",): True,
+    ("action_rtt_ms", "p50"): False,
+    ("action_rtt_ms", "p99"): False,
+    ("server_cpu",): False,
+    ("server_max_rss_mb",): False,
+}
+
+
+def load(path: str):
+    with open(path, "r") as results_file:
+        results = json.load(results_file)
+    # a single run of 'wsmonitor bench' or the scenarios of bench_server.py
+    return {"bench": results} if "results" in results else results
+
+
+def lookup(results, path):
+    for key in path:
+        if results is None:
+            return None
+        results = results.get(key, None)
+    return results
+
+
+@click.command()
+@click.argument("baseline")
+@click.argument("current")
+@click.option("--threshold", default=.1, help="Relative change reported as regression")
+def main(baseline: str, current: str, threshold: float):
+    """
+    Compares two benchmark result files, exits with 1 on regressions.
+    """
+    old, new = load(baseline), load(current)
+    regressions = 0
+    for scenario in sorted(set(old) & set(new)):
+        click.echo(scenario)
+        for path, higher_is_better in METRICS.items():
+            before = lookup(old[scenario]["results"], path)
+            after = lookup(new[scenario]["results"], path)
+            if not before or after is None:
+                continue
+
+            change = (after - before) / before
+            regressed = (change < -threshold) if higher_is_better else (change > threshold)
+            regressions += regressed
+            marker = " REGRESSION" if regressed else ""
+            click.echo(f"  {'.'.join(path):<22} {before:>10.2f} {after:>10.2f} {change:>+8.1%}{marker}")
+
+    raise SystemExit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
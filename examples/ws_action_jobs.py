@@ -0,0 +1,64 @@
+import asyncio
+import hashlib
+import signal
+
+from wsmonitor.jobs import Job, THREAD, PROCESS
+from wsmonitor.ws_monitor import WebsocketActionServer, JobClientAction
+
+
+async def countdown(job: Job, seconds: int):
+    # runs on the loop, cancelling the job cancels the coroutine
+    for remaining in range(seconds, 0, -1):
+        job.progress({"remaining": remaining})
+        await asyncio.sleep(1)
+    return "Liftoff"
+
+
+def hash_rounds(job: Job, rounds: int):
+    # CPU bound, runs on the thread pool and checks for cancellation
+    digest = b""
+    for done in range(rounds):
+        if job.is_cancelled():
+            return None
+        digest = hashlib.sha256(digest).digest()
+        if done % 100000 == 0:
+            job.progress({"done": done, "rounds": rounds})
+    return digest.hex()
+
+
+def count_primes(limit: int):
+    # runs on the process pool, without the job
+    return sum(1 for number in range(2, limit) if all(number % div for div in range(2, int(number ** .5) + 1)))
+
+
+def main():
+    loop = asyncio.get_event_loop()
+    wpm = WebsocketActionServer()
+    wpm.jobs.thread_workers = 2
+    wpm.add_action("countdown", JobClientAction("countdown", ["seconds"], countdown, wpm.jobs))
+    wpm.add_action("hash", JobClientAction("hash", ["rounds"], hash_rounds, wpm.jobs, THREAD))
+    wpm.add_action("primes", JobClientAction("primes", ["limit"], count_primes, wpm.jobs, PROCESS))
+
+    def shutdown_handler():
+        asyncio.ensure_future(wpm.stop_server())
+
+    loop.add_signal_handler(signal.SIGINT, shutdown_handler)
+    loop.add_signal_handler(signal.SIGTERM, shutdown_handler)
+
+    async def main_loop():
+
+        await wpm.start_server()
+        await wpm.server.wait_closed()
+        loop.stop()
+
+    try:
+        loop.create_task(main_loop())
+        loop.run_forever()
+
+    finally:
+        loop.stop()
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,9 @@ setup(
     description='Websocket interface for process control',
     author='Mark Weinreuter',
     packages=find_packages(exclude=('tests', 'examples')),
+    extras_require={
+        'uvloop': ['uvloop'],
+    },
     entry_points={
         'console_scripts': [
             'wsmonitor=wsmonitor.cli:cli',
@@ -0,0 +1,66 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+from wsmonitor.process.cgroup import Cgroup, CgroupManager, delegated_root
+from wsmonitor.process.data import ProcessData
+from wsmonitor.process.process import Process
+
+
+async def run_process(cgroup: Cgroup, command: str = "echo started"):
+    # returns the exit code and the output
+    process = Process(ProcessData("cgroup-test", command))
+    output = []
+    process.set_output_listener(lambda _, data, *args: output.append(data))
+    process.set_cgroup(cgroup)
+    exit_code = await process.start_as_task()
+    return exit_code, b"".join(output)
+
+
+class CgroupFallbackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_start_without_missing_cgroup(self):
+        # moving the child into the cgroup fails, it is started without it
+        directory = tempfile.mkdtemp()
+        try:
+            cgroup = Cgroup(os.path.join(directory, "gone"))
+            exit_code, output = self.loop.run_until_complete(run_process(cgroup))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(output, b"started\n")
+
+    @unittest.skipIf(delegated_root() is None, "no delegated cgroup v2")
+    def test_start_in_delegated_cgroup(self):
+        manager = CgroupManager(delegated_root())
+        self.assertIs(manager.enable(), True)
+        cgroup = manager.prepare("cgroup-test", None)
+        self.assertIsNotNone(cgroup)
+        try:
+            exit_code, output = self.loop.run_until_complete(
+                run_process(cgroup, "cat /proc/self/cgroup"))
+            self.assertEqual(exit_code, 0)
+            self.assertIn(os.path.basename(cgroup.path).encode(), output)
+
+            # the cgroup is gone before the next start
+            os.rmdir(cgroup.path)
+            exit_code, output = self.loop.run_until_complete(
+                run_process(cgroup, "cat /proc/self/cgroup"))
+            self.assertEqual(exit_code, 0)
+            self.assertNotIn(os.path.basename(cgroup.path).encode(), output)
+        finally:
+            manager.remove("cgroup-test")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from wsmonitor.process.output_log import OutputLog
+
+
+class OutputLogRotationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = OutputLog(self.directory, "rotation-test", max_segment_size=16)
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.directory)
+
+    def segment_names(self):
+        return sorted(name for name in os.listdir(self.log.directory) if name.endswith(".log"))
+
+    def test_no_rotation_without_lines(self):
+        # progress output without a newline stays in the first segment
+        for progress in range(10):
+            self.log.append(b"progress %d%%\r" % progress, 1.0)
+        self.log.flush()
+        self.assertEqual(self.segment_names(), ["0000000000000000.log"])
+
+        self.log.append(b"done\n", 1.0)
+        self.log.append(b"next\n", 1.0)
+        self.log.flush()
+        self.assertEqual(self.segment_names(), ["0000000000000000.log", "0000000000000001.log"])
+        self.assertEqual(self.log.line_count(), 2)
+        self.assertEqual(self.log.read_lines(1, 1), (1, b"next\n"))
+
+    def test_no_rotation_of_aged_segment_without_lines(self):
+        self.log.max_segment_age = 10
+        self.log.append(b"a", 1.0)
+        self.log.append(b"b\n", 20.0)
+        self.log.flush()
+        self.assertEqual(len(self.log._segments), 1)
+        self.assertEqual(self.log.read_lines(0, 1), (0, b"ab\n"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import asyncio
+import unittest
+
+from wsmonitor.ws_process_monitor import WebsocketProcessMonitor
+
+
+class RecordingMonitor(WebsocketProcessMonitor):
+
+    def __init__(self):
+        super().__init__()
+        self.running = 0
+        self.overlapped = False
+
+    async def _reload_processes(self, processes, restart):
+        self.running += 1
+        self.overlapped |= self.running > 1
+        await asyncio.sleep(.01)
+        self.running -= 1
+        return {"added": [], "updated": [], "restarted": [], "removed": [], "skipped": []}
+
+
+class ReloadConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_reloads_do_not_interleave(self):
+        monitor = RecordingMonitor()
+        self.loop.run_until_complete(asyncio.gather(
+            monitor.reload_config([]), monitor.reload_config([], True)))
+        self.assertFalse(monitor.overlapped)
+
+
+if __name__ == '__main__':
+    unittest.main()
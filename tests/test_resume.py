@@ -0,0 +1,48 @@
+import asyncio
+import unittest
+
+from wsmonitor.process.data import OutputEvent
+from wsmonitor.resume import ResumeState
+from wsmonitor.ws_process_monitor import WebsocketProcessMonitor
+
+
+def resume_state(monitor: WebsocketProcessMonitor, offset: int) -> ResumeState:
+    resume = ResumeState()
+    resume.session = monitor.session
+    resume.seq = monitor._state_seq
+    resume.offset = offset
+    return resume
+
+
+class ResumeOutputGapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.monitor = WebsocketProcessMonitor(resume_output_size=10)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def keep_output(self, count: int):
+        for _ in range(count):
+            self.monitor._output_offset += 1
+            self.monitor._keep_output(OutputEvent("resume-test", "12345678\n",
+                                                  offset=self.monitor._output_offset))
+
+    def test_resume_with_kept_output(self):
+        self.keep_output(1)
+        self.assertEqual(self.monitor._missed_state_events(resume_state(self.monitor, 0)), [])
+        self.assertEqual(self.monitor._missed_state_events(resume_state(self.monitor, 1)), [])
+
+    def test_full_summary_after_output_gap(self):
+        # only the last output fits into the history
+        self.keep_output(3)
+        self.assertEqual(self.monitor._missed_state_events(resume_state(self.monitor, 2)), [])
+        self.assertIsNone(self.monitor._missed_state_events(resume_state(self.monitor, 1)))
+        self.assertIsNone(self.monitor._missed_state_events(resume_state(self.monitor, 0)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+from wsmonitor.process.watch import OutputWatcher, WatchRule
+
+
+def matched(watcher: OutputWatcher, chunk: bytes):
+    return [(rule.action, line) for rule, line in watcher.scan(chunk)]
+
+
+class OutputWatcherTest(unittest.TestCase):
+
+    def test_overlapping_rules_all_match(self):
+        watcher = OutputWatcher([WatchRule("on port", WatchRule.READY),
+                                 WatchRule("Listening on", WatchRule.ALERT)])
+        self.assertEqual(matched(watcher, b"starting\nListening on port 80\n"),
+                         [(WatchRule.READY, b"Listening on port 80"),
+                          (WatchRule.ALERT, b"Listening on port 80")])
+
+    def test_rules_with_common_prefix_all_match(self):
+        watcher = OutputWatcher([WatchRule("Error", WatchRule.ALERT),
+                                 WatchRule("Error 42", WatchRule.RESTART)])
+        self.assertEqual(matched(watcher, b"Error 42\n"),
+                         [(WatchRule.ALERT, b"Error 42"), (WatchRule.RESTART, b"Error 42")])
+
+    def test_once_and_lines(self):
+        watcher = OutputWatcher([WatchRule("ready", WatchRule.READY, once=True),
+                                 WatchRule("fail")])
+        self.assertEqual(matched(watcher, b"ready\nfail 1\nready\nfail 2"),
+                         [(WatchRule.READY, b"ready"), (WatchRule.ALERT, b"fail 1"),
+                          (WatchRule.ALERT, b"fail 2")])
+        watcher.reset()
+        self.assertEqual(matched(watcher, b"ready\n"), [(WatchRule.READY, b"ready")])
+
+    def test_empty_pattern_rejected(self):
+        with self.assertRaises(ValueError):
+            WatchRule("x*")
+
+
+if __name__ == '__main__':
+    unittest.main()
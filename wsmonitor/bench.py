@@ -0,0 +1,243 @@
+import asyncio
+import json
+import logging
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, Any, List, Optional
+
+import websockets
+
+from wsmonitor.process.data import OutputEvent
+from wsmonitor.resume import Backoff
+from wsmonitor.ws_client import WSMonitorClient
+from wsmonitor.util import from_json
+from wsmonitor.wire import FEATURE_BINARY, decode_frame, with_features
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def emit(rate: int, size: int) -> None:
+    """
+    Output of the synthetic processes: rate lines per second of size bytes,
+    each line starts with the time it was written.
+    """
+    padding = "x" * max(size - 19, 0)
+    batch = max(rate // 100, 1)
+    interval = batch / rate
+    next_time = time.monotonic()
+    while True:
+        now = time.time()
+        sys.stdout.write("".join(f"{now:.6f} {padding}\n" for _ in range(batch)))
+        sys.stdout.flush()
+        next_time += interval
+        time.sleep(max(next_time - time.monotonic(), 0))
+
+
+def percentiles(values: List[float], scale: float = 1.) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def at(fraction: float) -> float:
+        return values[min(int(len(values) * fraction), len(values) - 1)] * scale
+
+    return {"p50": at(.5), "p95": at(.95), "p99": at(.99), "max": values[-1] * scale}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class ProcessSampler:
+    # cpu time and rss of a process, read from /proc (None elsewhere)
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self.max_rss = 0
+
+    def cpu_time(self) -> Optional[float]:
+        try:
+            with open(f"/proc/{self.pid}/stat", "rb") as stat_file:
+                fields = stat_file.read().rsplit(b")", 1)[1].split()
+        except OSError:
+            return None
+        # utime and stime, fields 14 and 15
+        return (int(fields[11]) + int(fields[12])) / self.clock_ticks
+
+    def sample_rss(self) -> Optional[int]:
+        try:
+            with open(f"/proc/{self.pid}/statm", "rb") as statm_file:
+                rss = int(statm_file.read().split()[1]) * self.page_size
+        except OSError:
+            return None
+        self.max_rss = max(self.max_rss, rss)
+        return rss
+
+
+class BenchClient:
+    """
+    Simulated websocket client, measures the latency of every received
+    output line from the time it has been written by the process.
+    """
+
+    def __init__(self, url: str, binary: bool = False):
+        self.url = with_features(url, [FEATURE_BINARY] if binary else [])
+        self.bytes = 0
+        self.lines = 0
+        self.latencies: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self.websocket = await websockets.connect(self.url, max_size=None)
+        self._task = asyncio.ensure_future(self._read())
+
+    async def _read(self) -> None:
+        while True:
+            message = await self.websocket.recv()
+            received = time.time()
+            event = decode_frame(message) if isinstance(message, bytes) else from_json(message)
+            if not isinstance(event, OutputEvent):
+                continue
+
+            self.bytes += len(event.output)
+            for line in event.output.splitlines():
+                try:
+                    self.latencies.append(received - float(line[:17]))
+                except ValueError:
+                    continue
+                self.lines += 1
+
+    def reset(self) -> None:
+        self.bytes = 0
+        self.lines = 0
+        self.latencies = []
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        await self.websocket.close()
+
+
+async def run_bench(processes: int = 10, clients: int = 4, duration: float = 10., rate: int = 200,
+                    line_size: int = 100, actions: int = 50, output_timeout: float = .5,
+                    server_args: Optional[List[str]] = None, warmup: float = 1.,
+                    binary: bool = False) -> Dict[str, Any]:
+    """
+    Starts a server with processes synthetic processes which write rate lines
+    per second each and connects clients websocket clients to it, which
+    receive the output as binary frames if binary is set. Returns the
+    configuration and the measured results.
+    """
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [PACKAGE_ROOT, os.environ.get("PYTHONPATH")])))
+    command = [sys.executable, "-m", "wsmonitor.cli", "--port", str(port), "server",
+               "--output-timeout", str(output_timeout)] + (server_args or [])
+    server = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    sampler = ProcessSampler(server.pid)
+
+    control = WSMonitorClient(backoff=Backoff(.1, 1.))
+    bench_clients = [BenchClient(f"ws://127.0.0.1:{port}/", binary) for _ in range(clients)]
+    try:
+        if not await control.connect_with_backoff("127.0.0.1", port, max_attempts=50):
+            raise RuntimeError("Failed to connect to the benchmark server")
+
+        emit_command = f"{sys.executable} -u -m wsmonitor.bench {rate} {line_size}"
+        uids = [f"bench-{idx}" for idx in range(processes)]
+        for uid in uids:
+            await control.action("add", uid=uid, cmd=emit_command, group=True)
+        for client in bench_clients:
+            await client.start()
+        for uid in uids:
+            await control.action("start", uid=uid)
+
+        await asyncio.sleep(warmup)
+        for client in bench_clients:
+            client.reset()
+        cpu_start, wall_start = sampler.cpu_time(), time.monotonic()
+
+        round_trips = []
+        action_interval = duration / max(actions, 1)
+        while time.monotonic() - wall_start < duration:
+            start = time.perf_counter()
+            await control.action("list")
+            round_trips.append(time.perf_counter() - start)
+            sampler.sample_rss()
+            await asyncio.sleep(action_interval)
+
+        elapsed = time.monotonic() - wall_start
+        cpu_end = sampler.cpu_time()
+        received = [(client.bytes, client.lines) for client in bench_clients]
+        latencies = [latency for client in bench_clients for latency in client.latencies]
+    finally:
+        for client in bench_clients:
+            try:
+                await client.close()
+            except (AttributeError, websockets.WebSocketException):
+                pass
+        await control.close()
+        # the server stops all processes on shutdown
+        server.send_signal(signal.SIGINT)
+        try:
+            server.wait(30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+    total_bytes = sum(size for size, _ in received)
+    total_lines = sum(lines for _, lines in received)
+    cpu = None if cpu_start is None or cpu_end is None else (cpu_end - cpu_start) / elapsed
+    return {
+        "config": {"processes": processes, "clients": clients, "duration": duration, "rate": rate,
+                   "line_size": line_size, "output_timeout": output_timeout,
+                   "server_args": server_args or [], "binary": binary},
+        "results": {
+            "latency_ms": percentiles(latencies, 1e3),
+            "throughput_mb_s": total_bytes / elapsed / 1e6,
+            "throughput_per_client_mb_s": total_bytes / elapsed / 1e6 / max(clients, 1),
+            "lines_per_s": total_lines / elapsed,
+            "expected_lines_per_s": processes * rate * clients,
+            "action_rtt_ms": percentiles(round_trips, 1e3),
+            "server_cpu": cpu,
+            "server_max_rss_mb": sampler.max_rss / 1e6 if sampler.max_rss else None,
+        },
+        "environment": environment(),
+    }
+
+
+def environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=PACKAGE_ROOT, capture_output=True,
+                                text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    try:
+        import uvloop
+        uvloop_version = uvloop.__version__
+    except ImportError:
+        uvloop_version = None
+    return {"commit": commit, "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "uvloop": uvloop_version, "time": time.time()}
+
+
+def write_results(results: Any, path: Optional[str]) -> Optional[str]:
+    # returns the results as text to be printed if there is no path
+    text = json.dumps(results, indent=2)
+    if path is None:
+        return text
+    with open(path, "w") as results_file:
+        results_file.write(text + "\n")
+    return None
+
+
+if __name__ == "__main__":
+    emit(int(sys.argv[1]), int(sys.argv[2]))
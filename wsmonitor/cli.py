@@ -1,19 +1,24 @@
 import asyncio
-from functools import partial
 import json
 import logging
+from typing import Optional, Dict
 
 import click
 from click import get_current_context
 
-from wsmonitor.process.process import Process
+from wsmonitor.config import read_process_config, load_processes, \
+    schedule_autostart
+from wsmonitor.federation import FederatedProcessMonitor, parse_upstream
+from wsmonitor.process.cgroup import delegated_root
+from wsmonitor.process.data import OutputEvent
+from wsmonitor.sharding import ShardedProcessMonitor
 from wsmonitor.ws_client import run_single_action_client
 
 try:
     from wsmonitor.gui import main_window
 except ImportError:
     print("PySide2 is not installed")
-from wsmonitor.util import run
+from wsmonitor.util import run, set_loop_backend, LOOP_BACKENDS
 from wsmonitor.ws_process_monitor import WebsocketProcessMonitor
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s',
@@ -22,50 +27,88 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s',
 
 class ServerConfig:
 
-    def __init__(self, host: str = "127.0.0.1", port: int = 8766):
+    def __init__(self, host: str = "127.0.0.1", port: int = 8766,
+                 socket: Optional[str] = None):
         self.host: str = host
         self.port: int = port
+        self.socket: Optional[str] = socket
 
 
 pass_config = click.make_pass_decorator(ServerConfig, ensure=True)
 
 
-def run_server(host, port, output_timeout, config_filepath=None):
-    wpm = WebsocketProcessMonitor(output_timeout)
+def run_server(host, port, output_timeout, config_filepath=None,
+               log_dir=None, log_options=None, registry_dir=None,
+               adopt=False, metrics_port=None, loop_backend="default",
+               shards=0, socket_path=None, socket_mode=0o600,
+               cgroup_root=None, launcher=False):
+    # the loop is chosen before the monitor creates its queues
+    set_loop_backend(loop_backend)
+    if cgroup_root == "auto":
+        cgroup_root = delegated_root()
+        if cgroup_root is None:
+            logging.warning("No delegated cgroup v2 found, processes run without cgroups and limits")
+    if shards > 0:
+        # the processes are supervised by the worker processes
+        wpm = ShardedProcessMonitor(shards, output_timeout, log_dir=log_dir,
+                                    log_options=log_options,
+                                    registry_dir=registry_dir, adopt=adopt,
+                                    loop_backend=loop_backend,
+                                    cgroup_root=cgroup_root,
+                                    launcher=launcher,
+                                    metrics_port=metrics_port)
+        if config_filepath is not None:
+            wpm.add_initial_processes(read_process_config(config_filepath))
+        wpm.config_path = config_filepath
+        run(wpm.run(host, port, socket_path, socket_mode), wpm.shutdown,
+            loop_backend, wpm.reload_config)
+        return
+
+    wpm = WebsocketProcessMonitor(output_timeout, metrics_port=metrics_port)
+    if cgroup_root is not None:
+        wpm.enable_cgroups(cgroup_root)
+    if launcher:
+        wpm.enable_launcher()
+    if log_dir is not None:
+        wpm.enable_output_logs(log_dir, **(log_options or {}))
+    if registry_dir is not None:
+        wpm.enable_registry(registry_dir)
+        wpm.restore_registry(adopt)
 
     if config_filepath is not None:
-        with open(config_filepath, "r") as config_file:
-            data = config_file.read()
-            config_file.close()
+        schedule_autostart(wpm, load_processes(
+            wpm, read_process_config(config_filepath)))
+    # reloaded on SIGHUP and with the reload action
+    wpm.config_path = config_filepath
 
-            import json
-            processes = json.loads(data)
-            for process_config in processes:
-                process = wpm.add_process(
-                    process_config["uid"],
-                    process_config["cmd"],
-                    as_process_group=process_config["group"],
-                    command_kwargs=process_config.get("command_kwargs", None))
+    run(wpm.run(host, port, socket_path, socket_mode), wpm.shutdown,
+        loop_backend, wpm.reload_config)
 
-                autostart = process_config.get("auto_start", None)
-                if isinstance(process, Process) and bool(autostart):
-                    delay = autostart if isinstance(autostart, int) else 0
-                    asyncio.get_event_loop().call_later(
-                        delay, partial(wpm.start_process, process.uid()))
 
-    run(wpm.run(host, port), wpm.shutdown)
+def run_aggregator(host, port, upstreams, output_timeout, metrics_port=None,
+                   loop_backend="default", socket_path=None,
+                   socket_mode=0o600):
+    set_loop_backend(loop_backend)
+    monitor = FederatedProcessMonitor(upstreams, output_timeout,
+                                      metrics_port=metrics_port)
+    run(monitor.run(host, port, socket_path, socket_mode), monitor.shutdown,
+        loop_backend)
 
 
 @click.group()
 @click.option("--host", default="127.0.0.1",
               help="The host the server is running on")
 @click.option("--port", default=8766, help="The port the server is running on")
+@click.option("--socket", default=None,
+              help="Unix socket of the server, used instead of host and port")
 @click.option("-v", is_flag="True", help="Enable verbose output.")
 @click.option("-vv", is_flag="True", help="Enable verbose verbose output.")
 @pass_config
-def cli(config: ServerConfig, host: str, port: int, v: bool, vv: bool):
+def cli(config: ServerConfig, host: str, port: int, socket: str, v: bool,
+        vv: bool):
     config.host = host
     config.port = port
+    config.socket = socket
     if v:
         logging.getLogger().setLevel(logging.INFO)
     if vv:
@@ -87,13 +130,103 @@ def gui(config: ServerConfig):
               help="Send OutputEvents with the configured interval")
 @click.option("--initial", default=None,
               help="JSON file with the initial processes to load")
+@click.option("--log-dir", default=None,
+              help="Directory to store the output of all processes in")
+@click.option("--log-segment-size", default=16,
+              help="Size in MB after which an output log segment is rotated")
+@click.option("--log-segment-age", default=3600,
+              help="Age in seconds after which an output log segment is rotated")
+@click.option("--log-segments", default=8,
+              help="Number of output log segments kept per process")
+@click.option("--registry", "registry_dir", default=None,
+              help="Directory to persist the registered processes in")
+@click.option("--adopt", is_flag=True,
+              help="Take over processes of a previous run which are still running")
+@click.option("--metrics-port", default=None, type=int,
+              help="Serve Prometheus metrics on this local port")
+@click.option("--loop", "loop_backend", type=click.Choice(LOOP_BACKENDS),
+              default="default",
+              help="Event loop implementation, auto uses uvloop if installed")
+@click.option("--shards", default=0,
+              help="Supervise the processes in this many worker processes")
+@click.option("--socket-mode", default="600",
+              help="Permissions of the unix socket given with --socket, in octal")
+@click.option("--no-tcp", is_flag=True,
+              help="Only serve on the unix socket given with --socket")
+@click.option("--cgroup-root", default=None,
+              help="Delegated cgroup v2 directory to run every process in its own cgroup, "
+                   "auto uses the cgroup of the server")
+@click.option("--launcher", is_flag=True,
+              help="Start the processes from a small helper process, faster for frequently started jobs")
 @pass_config
-def server(config: ServerConfig, output_timeout: float, initial: str):
+def server(config: ServerConfig, output_timeout: float, initial: str,
+           log_dir: str, log_segment_size: int, log_segment_age: int,
+           log_segments: int, registry_dir: str, adopt: bool,
+           metrics_port: int, loop_backend: str, shards: int,
+           socket_mode: str, no_tcp: bool, cgroup_root: str, launcher: bool):
     """
     Starts the ProcessMonitor server.
     """
+    if no_tcp and config.socket is None:
+        raise click.UsageError("--no-tcp requires --socket")
+    try:
+        mode = int(socket_mode, 8)
+    except ValueError:
+        raise click.BadParameter(f"'{socket_mode}' is not an octal mode",
+                                 param_hint="--socket-mode")
+
     click.echo('Starting ws server: %s' % config)
-    run_server(config.host, config.port, output_timeout, initial)
+    log_options = {"max_segment_size": log_segment_size * 1024 * 1024,
+                   "max_segment_age": log_segment_age,
+                   "max_segments": log_segments}
+    try:
+        run_server(config.host, None if no_tcp else config.port, output_timeout,
+                   initial, log_dir, log_options, registry_dir, adopt,
+                   metrics_port, loop_backend, shards, config.socket, mode,
+                   cgroup_root, launcher)
+    except OSError as excpt:
+        raise click.ClickException(str(excpt))
+
+
+@cli.command()
+@click.option("--upstream", "upstreams", multiple=True, required=True,
+              help="Server to aggregate as name=host:port, can be repeated")
+@click.option("--output-timeout", default=0.5,
+              help="Send OutputEvents with the configured interval")
+@click.option("--metrics-port", default=None, type=int,
+              help="Serve Prometheus metrics on this local port")
+@click.option("--loop", "loop_backend", type=click.Choice(LOOP_BACKENDS),
+              default="default",
+              help="Event loop implementation, auto uses uvloop if installed")
+@pass_config
+def aggregate(config: ServerConfig, upstreams, output_timeout: float,
+              metrics_port: int, loop_backend: str):
+    """
+    Serves the processes of several servers as "<name>/<uid>".
+    """
+    try:
+        parsed = [parse_upstream(upstream) for upstream in upstreams]
+    except ValueError as excpt:
+        raise click.BadParameter(str(excpt), param_hint="--upstream")
+    if len({name for name, _, _ in parsed}) != len(parsed):
+        raise click.BadParameter("Upstream names must be unique",
+                                 param_hint="--upstream")
+    click.echo('Starting aggregator: %s' % config)
+    try:
+        run_aggregator(config.host, config.port, parsed, output_timeout,
+                       metrics_port, loop_backend, config.socket)
+    except OSError as excpt:
+        raise click.ClickException(str(excpt))
+
+
+def parse_labels(ctx, param, values) -> Optional[Dict[str, str]]:
+    labels = {}
+    for value in values:
+        key, separator, label = value.partition("=")
+        if not key or not separator:
+            raise click.BadParameter(f"'{value}', expected key=value")
+        labels[key] = label
+    return labels or None
 
 
 @cli.command(context_settings=dict(
@@ -104,15 +237,44 @@ def server(config: ServerConfig, output_timeout: float, initial: str):
 @click.argument("cmd")
 @click.option("--as-group", is_flag=True,
               help="Execute the process in its own process group.")
+@click.option("--label", "labels", multiple=True, callback=parse_labels,
+              help="Label of the process as key=value, can be given multiple times.")
+@click.option("--memory-max", default=None,
+              help="Memory limit if the server uses cgroups, in bytes or e.g. 512M.")
+@click.option("--cpu-max", default=None, type=float,
+              help="CPU limit if the server uses cgroups, in CPUs e.g. 0.5.")
+@click.option("--pids-max", default=None, type=int,
+              help="Limit of the number of processes if the server uses cgroups.")
+@click.option("--lines-per-second", default=None, type=float,
+              help="Output lines passed on per second, the rest is suppressed.")
+@click.option("--bytes-per-second", default=None, type=float,
+              help="Output bytes passed on per second, the rest is suppressed.")
+@click.option("--sample", default=None, type=int,
+              help="Only keep every n-th line of output.")
+@click.option("--head", default=None, type=int,
+              help="Only keep the first lines of output of a run and the --tail.")
+@click.option("--tail", default=None, type=int,
+              help="Keep the last lines of output of a run, passed on when it ended.")
 @pass_config
-def add(config: ServerConfig, uid: str, cmd: str, as_group: bool):
+def add(config: ServerConfig, uid: str, cmd: str, as_group: bool, labels,
+        memory_max: str, cpu_max: float, pids_max: int, lines_per_second: float,
+        bytes_per_second: float, sample: int, head: int, tail: int):
     """
     Adds a new process with the given unique id and executes the specified command once started.
     """
     kwargs = get_context_kwargs()
+    limits = {key: value for key, value in (("memory_max", memory_max), ("cpu_max", cpu_max),
+                                            ("pids_max", pids_max)) if value is not None}
+    output_limit = {key: value for key, value in (("lines_per_second", lines_per_second),
+                                                  ("bytes_per_second", bytes_per_second),
+                                                  ("sample", sample), ("head", head),
+                                                  ("tail", tail)) if value is not None}
     result = run_single_action_client(config.host, config.port, "add", uid=uid,
                                       cmd=cmd, group=as_group,
-                                      command_kwargs=kwargs)
+                                      command_kwargs=kwargs,
+                                      labels=labels, limits=limits or None,
+                                      output_limit=output_limit or None,
+                                      socket_path=config.socket)
     click.echo(f'Add command {uid}="{cmd}" group={as_group} -> {result}')
 
 
@@ -124,7 +286,7 @@ def remove(config: ServerConfig, uid: str):
     Removes the process with the given unique id.
     """
     result = run_single_action_client(config.host, config.port, "remove",
-                                      uid=uid)
+                                      uid=uid, socket_path=config.socket)
     click.echo(f'Remove command {uid} -> {result}')
 
 
@@ -141,7 +303,8 @@ def start(config: ServerConfig, uid: str):
     kwargs = get_context_kwargs()
 
     result = run_single_action_client(config.host, config.port, "start",
-                                      uid=uid, command_kwargs=kwargs)
+                                      uid=uid, command_kwargs=kwargs,
+                                      socket_path=config.socket)
     click.echo(f'Start "{uid} ({kwargs})" -> {result}')
 
 
@@ -163,7 +326,8 @@ def action(config: ServerConfig, action: str, project: str, uid: str):
     Sends the given action command.
     """
     result = run_single_action_client(config.host, config.port, action,
-                                      uid=uid, project=project)
+                                      uid=uid, project=project,
+                                      socket_path=config.socket)
     click.echo(f'Action "{action}" -> {result}')
 
 
@@ -175,7 +339,8 @@ def restart(config: ServerConfig, uid: str):
     Re-starts the process with the given unique id.
     """
     click.echo(f'Re-start {uid}')
-    run_single_action_client(config.host, config.port, "restart", uid=uid)
+    run_single_action_client(config.host, config.port, "restart", uid=uid,
+                             socket_path=config.socket)
 
 
 @cli.command()
@@ -186,17 +351,95 @@ def stop(config: ServerConfig, uid: str):
     Stops the process with the given unique id.
     """
     click.echo(f'Stop {uid}')
-    run_single_action_client(config.host, config.port, "stop", uid=uid)
+    run_single_action_client(config.host, config.port, "stop", uid=uid,
+                             socket_path=config.socket)
 
 
 @cli.command()
-@click.option("--uid", default="")
+@click.option("--uid", default="", help="Only show the output of this process.")
+@click.option("--stream", type=click.Choice(["all", "stdout", "stderr"]),
+              default="all", help="Only show the output of this stream.")
+@click.option("--timestamps", is_flag=True,
+              help="Prefix each line with its time and stream.")
 @pass_config
-def output(config: ServerConfig, uid: str):
+def output(config: ServerConfig, uid: str, stream: str, timestamps: bool):
     """
     Logs the output reported from the ProcessMonitor.
     """
-    run_single_action_client(config.host, config.port, "output")
+    run_single_action_client(config.host, config.port, "output", uid=uid,
+                             stream=OutputEvent.STREAMS.get(stream, None),
+                             timestamps=timestamps, socket_path=config.socket)
+
+
+@cli.command()
+@click.argument("uid")
+@click.option("--start", default=None, type=int,
+              help="First line to show, negative values count from the end.")
+@click.option("--count", default=100, help="Number of lines to show.")
+@click.option("--since", default=None, type=float,
+              help="Show the lines logged since the given unix timestamp.")
+@pass_config
+def history(config: ServerConfig, uid: str, start: int, count: int,
+            since: float):
+    """
+    Shows the logged output of the process with the given unique id.
+    """
+    data = run_single_action_client(config.host, config.port, "history",
+                                    uid=uid, start=start, count=count,
+                                    since=since, socket_path=config.socket)
+    if isinstance(data, dict):
+        click.echo(data["output"], nl=False)
+    else:
+        click.echo(f'History of {uid} -> {data}')
+
+
+@cli.command()
+@pass_config
+def stats(config: ServerConfig):
+    """
+    Shows the metrics of the server.
+    """
+    data = run_single_action_client(config.host, config.port, "stats",
+                                    socket_path=config.socket)
+    click.echo(json.dumps(data, indent=True))
+
+
+@cli.command()
+@click.option("--processes", default=10, help="Number of synthetic processes")
+@click.option("--clients", default=4, help="Number of simulated websocket clients")
+@click.option("--duration", default=10., help="Measured seconds")
+@click.option("--rate", default=200, help="Lines per second written by each process")
+@click.option("--line-size", default=100, help="Bytes per output line")
+@click.option("--actions", default=50, help="Number of actions sent to measure their round trip")
+@click.option("--output-timeout", default=0.5,
+              help="Output interval of the benchmarked server")
+@click.option("--loop", "loop_backend", type=click.Choice(LOOP_BACKENDS),
+              default="default", help="Event loop of the benchmarked server")
+@click.option("--binary", is_flag=True,
+              help="The clients receive the output as binary frames")
+@click.option("--output", "output_path", default=None,
+              help="Write the results as json to this file")
+def bench(processes: int, clients: int, duration: float, rate: int,
+          line_size: int, actions: int, output_timeout: float,
+          loop_backend: str, binary: bool, output_path: str):
+    """
+    Benchmarks a server started with synthetic processes and clients.
+    """
+    from wsmonitor.bench import run_bench, write_results
+
+    results = asyncio.get_event_loop().run_until_complete(run_bench(
+        processes, clients, duration, rate, line_size, actions,
+        output_timeout, ["--loop", loop_backend], binary=binary))
+    summary = results["results"]
+    click.echo(f"latency ms: {summary['latency_ms']}", err=True)
+    click.echo(f"throughput: {summary['throughput_mb_s']:.2f} MB/s, "
+               f"{summary['lines_per_s']:.0f}/{summary['expected_lines_per_s']} lines/s", err=True)
+    click.echo(f"action rtt ms: {summary['action_rtt_ms']}", err=True)
+    click.echo(f"server cpu: {summary['server_cpu']}, "
+               f"max rss: {summary['server_max_rss_mb']} MB", err=True)
+    text = write_results(results, output_path)
+    if text is not None:
+        click.echo(text)
 
 
 @cli.command(name="list")
@@ -207,7 +450,8 @@ def list_processes(config: ServerConfig, as_json):
     """
     Lists all processes.
     """
-    data = run_single_action_client(config.host, config.port, "list")
+    data = run_single_action_client(config.host, config.port, "list",
+                                    socket_path=config.socket)
     if data is not None:
         result = json.dumps(data, indent=True)
         click.echo(result)
@@ -215,5 +459,82 @@ def list_processes(config: ServerConfig, as_json):
         click.echo("No processes could be retrieved")
 
 
+@cli.command()
+@click.argument("uid")
+@pass_config
+def usage(config: ServerConfig, uid: str):
+    """
+    Shows the cpu and memory usage of a process which runs in a cgroup.
+    """
+    data = run_single_action_client(config.host, config.port, "usage", uid=uid,
+                                    socket_path=config.socket)
+    click.echo(json.dumps(data, indent=True))
+
+
+@cli.command(name="reload")
+@click.option("--restart", is_flag=True,
+              help="Restart running processes whose config changed.")
+@pass_config
+def reload_config(config: ServerConfig, restart: bool):
+    """
+    Applies the changes of the --initial process config of the server.
+    """
+    data = run_single_action_client(config.host, config.port, "reload",
+                                    restart=restart, socket_path=config.socket)
+    click.echo(json.dumps(data, indent=True))
+
+
+@cli.command()
+@click.option("--state", "states", multiple=True,
+              help="Only processes in this state, can be given multiple times.")
+@click.option("--label", "labels", multiple=True, callback=parse_labels,
+              help="Only processes with this label as key=value, can be given multiple times.")
+@click.option("--prefix", default=None, help="Only processes whose uid starts with the prefix.")
+@click.option("--failed", is_flag=True, help="Only processes which ended with an exit code other than 0.")
+@click.option("--offset", default=0, help="Number of matching processes to skip.")
+@click.option("--limit", default=None, type=int, help="Maximum number of processes to show.")
+@click.option("--field", "fields", multiple=True,
+              help="Only show this field of the processes, can be given multiple times.")
+@pass_config
+def query(config: ServerConfig, states, labels, prefix: str, failed: bool,
+          offset: int, limit: int, fields):
+    """
+    Lists the processes matching all of the filters.
+    """
+    data = run_single_action_client(config.host, config.port, "query",
+                                    state=list(states) or None, labels=labels,
+                                    prefix=prefix, failed=True if failed else None,
+                                    offset=offset, limit=limit,
+                                    fields=list(fields) or None,
+                                    socket_path=config.socket)
+    if data is not None:
+        click.echo(json.dumps(data, indent=True))
+    else:
+        click.echo("No processes could be retrieved")
+
+
+@cli.command()
+@pass_config
+def jobs(config: ServerConfig):
+    """
+    Lists the running and recently finished jobs of job actions.
+    """
+    data = run_single_action_client(config.host, config.port, "jobs",
+                                    socket_path=config.socket)
+    click.echo(json.dumps(data, indent=True))
+
+
+@cli.command(name="cancel-job")
+@click.argument("job", type=int)
+@pass_config
+def cancel_job(config: ServerConfig, job: int):
+    """
+    Cancels a running job.
+    """
+    data = run_single_action_client(config.host, config.port, "cancel_job",
+                                    job=job, socket_path=config.socket)
+    click.echo(json.dumps(data, indent=True))
+
+
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,140 @@
+import asyncio
+import json
+import logging
+from functools import partial
+from typing import List, Dict, Any, Union, Optional
+
+from wsmonitor.process.process import Process
+from wsmonitor.process.process_monitor import ProcessMonitor
+from wsmonitor.process.output_limit import output_limit_from_config
+from wsmonitor.process.startup import ready_condition_from_config
+from wsmonitor.process.watch import watch_rules_from_config
+
+logger = logging.getLogger(__name__)
+
+
+def read_process_config(config_filepath: str) -> List[Dict[str, Any]]:
+    with open(config_filepath, "r") as config_file:
+        return json.load(config_file)
+
+
+def _add_arguments(process_config: Dict[str, Any]) -> Dict[str, Any]:
+    # the arguments of ProcessMonitor.add_process, raises on invalid entries
+    return dict(uid=process_config["uid"],
+                command=process_config["cmd"],
+                as_process_group=process_config["group"],
+                command_kwargs=process_config.get("command_kwargs", None),
+                depends_on=process_config.get("depends_on", None),
+                ready=ready_condition_from_config(
+                    process_config.get("ready", None)),
+                watch_rules=watch_rules_from_config(
+                    process_config.get("watch", None)),
+                # removed labels and limits are cleared on reload
+                labels=process_config.get("labels", {}),
+                limits=process_config.get("limits", {}),
+                output_limit=output_limit_from_config(
+                    process_config.get("output_limit", None)))
+
+
+def load_processes(monitor: ProcessMonitor, processes: List[Dict[str, Any]]) -> Dict[str, int]:
+    """
+    Adds the configured processes, returns the auto start delays of the
+    processes which should be started.
+    """
+    autostart_delays = {}
+    for process_config in processes:
+        process = monitor.add_process(**_add_arguments(process_config))
+        if isinstance(process, Process):
+            monitor.config_entries[process.uid()] = process_config
+
+        delay = _autostart_delay(process_config)
+        if isinstance(process, Process) and delay is not None:
+            autostart_delays[process.uid()] = delay
+    return autostart_delays
+
+
+def _autostart_delay(process_config: Dict[str, Any]) -> Optional[int]:
+    autostart = process_config.get("auto_start", None)
+    if not autostart:
+        return None
+    return autostart if isinstance(autostart, int) and not isinstance(autostart, bool) else 0
+
+
+async def reload_processes(monitor: ProcessMonitor, processes: List[Dict[str, Any]],
+                           restart: bool = False) -> Union[str, Dict[str, List[str]]]:
+    """
+    Applies the changes of the config since it was last loaded: new
+    processes are added, changed idle ones updated and removed ones stopped
+    and removed. Changed running processes are restarted with restart,
+    otherwise they are skipped and updated by a later reload.
+    Nothing is applied if the config is invalid. Calls must not overlap,
+    WebsocketProcessMonitor.reload_config runs them one after the other.
+    """
+    entries: Dict[str, Dict[str, Any]] = {}
+    arguments: Dict[str, Dict[str, Any]] = {}
+    for process_config in processes:
+        try:
+            uid = process_config["uid"]
+            if uid in entries:
+                return f"Process '{uid}' is configured twice"
+            entries[uid] = process_config
+            # only changed entries are parsed
+            if monitor.config_entries.get(uid, None) != process_config or monitor.get_process(uid) is None:
+                arguments[uid] = _add_arguments(process_config)
+        except (KeyError, TypeError, ValueError) as excpt:
+            return f"Invalid process config {process_config}: {excpt!r}"
+
+    result: Dict[str, List[str]] = {"added": [], "updated": [], "restarted": [], "removed": [], "skipped": []}
+    removed = [uid for uid in monitor.config_entries if uid not in entries]
+    running = [uid for uid in removed if monitor.get_process(uid) is not None
+               and monitor.get_process(uid).is_running()]
+    await asyncio.gather(*(monitor.stop_process(uid) for uid in running))
+    for uid in removed:
+        if isinstance(monitor.remove_process(uid), str):
+            result["skipped"].append(uid)
+        else:
+            result["removed"].append(uid)
+        monitor.config_entries.pop(uid, None)
+
+    restarts = []
+    autostart_delays = {}
+    for uid, add_arguments in arguments.items():
+        process = monitor.get_process(uid)
+        if process is not None and process.is_running():
+            if not restart:
+                result["skipped"].append(uid)
+                continue
+            restarts.append(uid)
+            continue
+
+        key = "added" if process is None else "updated"
+        if isinstance(monitor.add_process(**add_arguments), str):
+            result["skipped"].append(uid)
+            continue
+        monitor.config_entries[uid] = entries[uid]
+        result[key].append(uid)
+        delay = _autostart_delay(entries[uid])
+        if key == "added" and delay is not None:
+            autostart_delays[uid] = delay
+
+    async def restart_changed(uid: str) -> None:
+        await monitor.stop_process(uid)
+        if isinstance(monitor.add_process(**arguments[uid]), str):
+            result["skipped"].append(uid)
+            return
+        monitor.config_entries[uid] = entries[uid]
+        started = monitor.start_process(uid)
+        result["updated" if isinstance(started, str) else "restarted"].append(uid)
+
+    await asyncio.gather(*(restart_changed(uid) for uid in restarts))
+    schedule_autostart(monitor, autostart_delays)
+    logger.info("Reloaded process config: %s", {key: len(uids) for key, uids in result.items()})
+    return result
+
+
+def schedule_autostart(monitor: ProcessMonitor, autostart_delays: Dict[str, int]) -> None:
+    if autostart_delays:
+        # started as soon as the loop runs, dependencies first
+        asyncio.get_event_loop().call_soon(
+            partial(monitor.start_processes_ordered,
+                    list(autostart_delays.keys()), autostart_delays))
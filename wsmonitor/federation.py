@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple, List
+
+from wsmonitor.upstream import Upstream, UpstreamProcessMonitor
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# separates the name of the upstream from the uid of the process
+SEPARATOR = "/"
+
+
+class ServerUpstream(Upstream):
+
+    def __init__(self, name: str, host: str, port: int):
+        super().__init__(name)
+        self.host = host
+        self.port = port
+
+
+def parse_upstream(value: str) -> Tuple[str, str, int]:
+    """
+    Parses an upstream given as name=host:port.
+    """
+    name, _, address = value.partition("=")
+    host, _, port = address.rpartition(":")
+    if not name or SEPARATOR in name or not host or not port.isdigit():
+        raise ValueError(f"Invalid upstream '{value}', expected name=host:port")
+    return name, host, int(port)
+
+
+class FederatedProcessMonitor(UpstreamProcessMonitor):
+    """
+    Aggregates several servers behind one endpoint. Their processes are
+    exposed as "<name>/<uid>", a server which is not reachable is retried in
+    the background.
+    """
+
+    def __init__(self, upstreams: List[Tuple[str, str, int]], output_broadcast_timeout=.5, **kwargs):
+        super().__init__(output_broadcast_timeout, **kwargs)
+        self.servers: Dict[str, ServerUpstream] = {}
+        for name, host, port in upstreams:
+            if name in self.servers:
+                raise ValueError(f"Upstream '{name}' is configured twice")
+            self.servers[name] = ServerUpstream(name, host, port)
+            self.add_upstream(self.servers[name])
+        self._connect_tasks: List[asyncio.Future] = []
+
+    def locate(self, uid: str) -> Optional[Tuple[Upstream, str]]:
+        name, separator, upstream_uid = uid.partition(SEPARATOR)
+        upstream = self.servers.get(name, None)
+        if not separator or upstream is None:
+            return None
+        return upstream, upstream_uid
+
+    def front_uid(self, upstream: Upstream, uid: str) -> str:
+        return upstream.name + SEPARATOR + uid
+
+    async def run(self, host="127.0.0.1", port=8766, socket_path: Optional[str] = None,
+                  socket_mode: int = 0o600):
+        self._connect_tasks = [asyncio.ensure_future(server.client.connect_with_backoff(server.host, server.port))
+                               for server in self.servers.values()]
+        return await super().run(host, port, socket_path, socket_mode)
+
+    async def shutdown(self):
+        for task in self._connect_tasks:
+            task.cancel()
+        await super().shutdown()
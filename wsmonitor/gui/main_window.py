@@ -2,15 +2,14 @@ import json
 import logging
 import signal
 import sys
-from json import JSONDecodeError
 
-from PySide2 import QtWebSockets
-from PySide2.QtCore import (QUrl, Qt)
+from PySide2.QtCore import Qt, Signal, QThread, QMetaObject
 from PySide2.QtWidgets import QMainWindow, QSplitter, QSizePolicy, QStatusBar, QApplication, QWidget, QVBoxLayout, \
     QLineEdit, QPushButton, QStyle, QHBoxLayout
 
 from wsmonitor.gui.process_list import ProcessListWidget
 from wsmonitor.gui.process_widget import ProcessOutputTabsWidget
+from wsmonitor.gui.ws_worker import WebsocketWorker
 from wsmonitor.process.data import ProcessSummaryEvent, StateChangedEvent, ActionResponse, OutputEvent
 
 logger = logging.getLogger(__name__)
@@ -18,21 +17,35 @@ logger.setLevel(logging.DEBUG)
 
 
 class ProcessMonitorWindow(QMainWindow):
+    open_requested = Signal(str)
+    send_requested = Signal(str)
+
     def __init__(self):
         super(ProcessMonitorWindow, self).__init__()
         self.ui = ProcessMonitorUI(self)
 
         self._ws_connected = False
-        self.client = QtWebSockets.QWebSocket("", QtWebSockets.QWebSocketProtocol.Version13, None)
-
-        # Subscribe to events from the ws connection
-        self.client.error.connect(self.on_ws_error)
-        self.client.connected.connect(self.on_connected)
-        self.client.disconnected.connect(self.on_disconnected)
-        self.client.textMessageReceived.connect(self.on_message)
+        # The websocket lives in a worker thread which decodes the messages
+        # and hands them to the UI in batches
+        self.worker_thread = QThread(self)
+        self.worker = WebsocketWorker()
+        self.worker.moveToThread(self.worker_thread)
+        self.worker_thread.started.connect(self.worker.setup)
+        self.worker_thread.finished.connect(self.worker.deleteLater)
+
+        # Subscribe to events from the ws connection, all queued connections
+        self.worker.error.connect(self.on_ws_error)
+        self.worker.connected.connect(self.on_connected)
+        self.worker.disconnected.connect(self.on_disconnected)
+        self.worker.reconnecting.connect(self.on_reconnecting)
+        self.worker.events_received.connect(self.on_events)
+        self.open_requested.connect(self.worker.open)
+        self.send_requested.connect(self.worker.send)
+        self.worker_thread.start()
 
         self.ui.process_list.action_requested.connect(self.on_action_requested)
         self.ui.process_list.process_state_changed.connect(self.process_state_changed)
+        self.ui.process_list.process_selected.connect(self.ui.tabs_output.open_process_tab)
         self.ui.btn_connect.clicked.connect(self.on_connect_clicked)
 
     def on_connect_clicked(self):
@@ -48,38 +61,29 @@ class ProcessMonitorWindow(QMainWindow):
             self.ui.txt_conenction.setText(server_url)
 
         logger.info("Connecting to: %s", server_url)
-        self.client.open(QUrl(server_url))
-
-    def on_message(self, message):
-        # logger.info("Incomming msg: %s" % message)
-        try:
-            json_data = json.loads(message)
-            msg_type = json_data["type"]
-            payload = json_data["data"]
-
-            if msg_type == "ProcessSummaryEvent":
-                pdatas = ProcessSummaryEvent.from_json(payload)
-                new_processes, removed_processes = self.ui.process_list.update_process_data(set(pdatas.processes))
-                for process in new_processes:
-                    self.ui.tabs_output.add_process_tab(process.uid)
-                for process in removed_processes:
-                    self.ui.tabs_output.remove_process_tab(process.uid)
-
-            if msg_type == "StateChangedEvent":
-                state: StateChangedEvent = StateChangedEvent.from_json(payload)
-                self.ui.process_list.update_single_process_state(state)
-            if msg_type == "ActionResponse":
-                response = ActionResponse.from_json(payload)
-                self.ui.process_list.on_action_completed(response)
-            if msg_type == "OutputEvent":
-                output = OutputEvent.from_json(payload)
-                self.ui.handle_output(output)
-        except JSONDecodeError as excpt:
-            logger.error("Failed to parse message", exc_info=excpt)
-        except KeyError as excpt:
-            logger.error("Could not retrieve expected field from JSON", exc_info=excpt)
-        except Exception as excpt:  # pylint: disable=broad-except
-            logger.error("Unexpected exception on incomming message", exc_info=excpt)
+        self.open_requested.emit(server_url)
+
+    def on_events(self, events: list):
+        for event in events:
+            try:
+                self.on_event(event)
+            except Exception as excpt:  # pylint: disable=broad-except
+                logger.error("Unexpected exception on incomming message", exc_info=excpt)
+
+    def on_event(self, event):
+        if isinstance(event, ProcessSummaryEvent):
+            new_processes, removed_processes = self.ui.process_list.update_process_data(set(event.processes))
+            for process in new_processes:
+                self.ui.tabs_output.add_process_tab(process.uid)
+            for process in removed_processes:
+                self.ui.tabs_output.remove_process_tab(process.uid)
+
+        elif isinstance(event, StateChangedEvent):
+            self.ui.process_list.update_single_process_state(event)
+        elif isinstance(event, ActionResponse):
+            self.ui.process_list.on_action_completed(event)
+        elif isinstance(event, OutputEvent):
+            self.ui.handle_output(event)
 
     def process_state_changed(self, uid: str, state: str):
         self.ui.tabs_output.process_state_changed(uid, state)
@@ -98,23 +102,30 @@ class ProcessMonitorWindow(QMainWindow):
         self._ws_connected = False
         self.ui.set_disconnected_ui("Connection has been closed.")
 
+    def on_reconnecting(self, delay: float):
+        self.ui.set_disconnected_ui(f"Reconnecting in {delay:.1f}s.")
+
     def send_message(self, msg):
         if not self._ws_connected:
             logger.warning("CLIENT NOT CONNECTED!")
             return
         logger.info("Sending message: %s", msg)
-        self.client.sendTextMessage(msg)
+        self.send_requested.emit(msg)
 
-    def on_ws_error(self, error_code):
-        logger.error("WS Error, code: %s", error_code)
-        error_msg = self.client.errorString()
-        logger.error(error_msg)
-
-        self.client.close()
+    def on_ws_error(self, error_msg: str):
+        logger.error("WS Error: %s", error_msg)
         self.ui.set_disconnected_ui(error_msg)
 
     def close(self):
-        self.client.close()
+        if self.worker_thread.isRunning():
+            # make sure the socket is closed before the thread stops
+            QMetaObject.invokeMethod(self.worker, "close", Qt.BlockingQueuedConnection)
+        self.worker_thread.quit()
+        self.worker_thread.wait()
+
+    def closeEvent(self, event):
+        self.close()
+        super().closeEvent(event)
 
 
 class ProcessMonitorUI:
@@ -171,7 +182,7 @@ class ProcessMonitorUI:
         self.statusbar.showMessage("Connection established.")
 
     def handle_output(self, output: OutputEvent):
-        self.tabs_output.append_output(output.uid, output.output)
+        self.tabs_output.append_output(output.uid, output)
 
 
 def main(host: str = "127.0.0.1", port: int = 8765):
@@ -0,0 +1,45 @@
+from collections import deque
+from typing import Optional, Iterator, Tuple, Deque
+
+from wsmonitor.process.data import OutputEvent
+
+
+class OutputBuffer:
+    """
+    Ring buffer of output chunks which keeps at most max_lines lines.
+    Chunks are stored as (stream, wall clock time, text, line count).
+    """
+
+    def __init__(self, max_lines: int = 10000):
+        self.max_lines = max_lines
+        self._chunks: Deque[Tuple[int, float, str, int]] = deque()
+        self._lines = 0
+
+    def append(self, stream: int, wall: float, text: str) -> None:
+        lines = text.count("\n")
+        self._chunks.append((stream, wall, text, lines))
+        self._lines += lines
+
+        # always keep the last chunk, even if it alone is too long
+        while self._lines > self.max_lines and len(self._chunks) > 1:
+            self._lines -= self._chunks.popleft()[3]
+
+    def append_event(self, event: OutputEvent) -> None:
+        for stream, wall, _, text in event.iter_chunks():
+            self.append(stream, wall, text)
+
+    def chunks(self, stream: Optional[int] = None) -> Iterator[Tuple[int, float, str]]:
+        # chunks without a stream (e.g. markers) are always included
+        for chunk_stream, wall, text, _ in self._chunks:
+            if stream is None or chunk_stream in (stream, 0):
+                yield chunk_stream, wall, text
+
+    def clear(self) -> None:
+        self._chunks.clear()
+        self._lines = 0
+
+    def line_count(self) -> int:
+        return self._lines
+
+    def __len__(self):
+        return len(self._chunks)
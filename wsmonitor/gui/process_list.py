@@ -1,74 +1,98 @@
-from typing import Set, Dict
+from typing import Set
 
-from PySide2.QtCore import Signal, Qt
-from PySide2.QtWidgets import QScrollArea, QWidget, QVBoxLayout, QLabel, QSizePolicy
+from PySide2.QtCore import Signal, Qt, QModelIndex
+from PySide2.QtWidgets import QWidget, QVBoxLayout, QSizePolicy, QTableView, QHeaderView, QAbstractItemView, \
+    QLineEdit, QComboBox, QHBoxLayout
 
-from wsmonitor.gui.process_widget import logger, ProcessWidget
+from wsmonitor.gui.process_model import ProcessTableModel, ProcessFilterProxyModel, ActionButtonDelegate, \
+    ProcessDataRole
+from wsmonitor.gui.process_widget import logger
 from wsmonitor.process.data import ActionResponse, StateChangedEvent, ProcessData
 
 
-class ProcessListWidget(QScrollArea):
+class ProcessListWidget(QWidget):
     action_requested = Signal(str, str)
     process_state_changed = Signal(str, str)
+    process_selected = Signal(str)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.process_data = set()
-        self.process_widget_map = {}  # type: Dict[str, ProcessWidget]
-
-        self.main_widget = QWidget()
-        self.process_layout = QVBoxLayout()
-        self.process_layout.setContentsMargins(2, 2, 2, 2)
-        self.main_widget.setLayout(self.process_layout)
-
-        self.lbl_default = QLabel(text="No processes found")
-        self.process_layout.addWidget(self.lbl_default)
-        self.process_layout.addStretch()
-
-        # Configure ScrollArea
-        self.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
-        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAsNeeded)
-        self.setWidgetResizable(True)
-        self.setWidget(self.main_widget)
+        self.model = ProcessTableModel(self)
+        self.proxy = ProcessFilterProxyModel(self)
+        self.proxy.setSourceModel(self.model)
+
+        self.txt_filter = QLineEdit(self)
+        self.txt_filter.setPlaceholderText("Filter processes")
+        self.txt_filter.setClearButtonEnabled(True)
+        self.cmb_state = QComboBox(self)
+        self.cmb_state.addItem("All states", None)
+        for state in (ProcessData.INITIALIZED, ProcessData.STARTING, ProcessData.STARTED,
+                      ProcessData.STOPPING, ProcessData.ENDED):
+            self.cmb_state.addItem(state, state)
+
+        filter_layout = QHBoxLayout()
+        filter_layout.addWidget(self.txt_filter)
+        filter_layout.addWidget(self.cmb_state)
+
+        # The view only paints the visible rows, the buttons are painted by
+        # delegates instead of being widgets
+        self.table = QTableView(self)
+        self.table.setModel(self.proxy)
+        self.table.setSortingEnabled(True)
+        self.table.sortByColumn(ProcessTableModel.COLUMN_UID, Qt.AscendingOrder)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.table.setWordWrap(False)
+        self.table.verticalHeader().hide()
+        # fixed row heights, sizing rows to their contents would touch every row
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        header = self.table.horizontalHeader()
+        header.setSectionResizeMode(QHeaderView.Interactive)
+        header.setStretchLastSection(True)
+        header.resizeSection(ProcessTableModel.COLUMN_START_STOP, 80)
+        header.resizeSection(ProcessTableModel.COLUMN_RESTART, 90)
+
+        self.start_stop_delegate = ActionButtonDelegate(self.model, parent=self)
+        self.restart_delegate = ActionButtonDelegate(self.model, restart=True, parent=self)
+        self.table.setItemDelegateForColumn(ProcessTableModel.COLUMN_START_STOP, self.start_stop_delegate)
+        self.table.setItemDelegateForColumn(ProcessTableModel.COLUMN_RESTART, self.restart_delegate)
+        self.start_stop_delegate.action_requested.connect(self.action_requested)
+        self.restart_delegate.action_requested.connect(self.action_requested)
+
+        layout = QVBoxLayout()
+        layout.setContentsMargins(2, 2, 2, 2)
+        layout.addLayout(filter_layout)
+        layout.addWidget(self.table)
+        self.setLayout(layout)
         self.setSizePolicy(QSizePolicy.MinimumExpanding, QSizePolicy.MinimumExpanding)
 
+        self.txt_filter.textChanged.connect(self.proxy.setFilterFixedString)
+        self.table.selectionModel().currentRowChanged.connect(lambda current, _: self._select(current))
+        self.table.activated.connect(self._select)
+        self.cmb_state.currentIndexChanged.connect(
+            lambda _: self.proxy.set_state_filter(self.cmb_state.currentData()))
+
+    def _select(self, index: QModelIndex):
+        process: ProcessData = index.data(ProcessDataRole) if index.isValid() else None
+        if process is not None:
+            self.process_selected.emit(process.uid)
+
     def on_action_completed(self, response: ActionResponse):
         logger.info("Action completed: %s", response)
-        self.process_widget_map[response.uid].on_action_completed(response.action)
+        if response.uid is not None:
+            self.model.set_awaiting_response(response.uid, False)
 
     def update_single_process_state(self, event: StateChangedEvent):
-        self.process_widget_map[event.uid].update_state(event.state, event.exit_code)
+        if self.model.update_state(event.uid, event.state, event.exit_code):
+            self.process_state_changed.emit(event.uid, event.state)
 
     def update_process_data(self, updated_process_data: Set[ProcessData]):
-        potentially_updated = set()
-        for process_data in updated_process_data:
-            if process_data in self.process_data:
-                potentially_updated.add(process_data)
-
-        new_processes = updated_process_data - self.process_data
-        unknown_processes = self.process_data - updated_process_data
-        print(potentially_updated, new_processes, unknown_processes)
-        # TODO(mark): update process data sets with new data
-        for known_process in potentially_updated:
-            widget = self.process_widget_map[known_process.uid]
-            widget.on_update_process_data(known_process)
-
-        for new_process in new_processes:
-            widget = ProcessWidget(new_process)
-            self.process_widget_map[new_process.uid] = widget
-            widget.actionRequested.connect(self.action_requested)
-            widget.process_state_changed.connect(self.process_state_changed)
-            self.process_layout.insertWidget(0, widget)
-
-        # TODO(mark): unknown processes
-        for process in unknown_processes:
-            widget = self.process_widget_map[process.uid]
-            logger.info("Removing widget: %s", process.uid)
-            self.process_layout.removeWidget(widget)
-            del self.process_widget_map[process.uid]
-            widget.deleteLater()
-
-        self.process_data = new_processes | potentially_updated
-        self.lbl_default.setVisible(len(self.process_data) == 0)
+        new_processes, unknown_processes, state_changed = self.model.update_processes(updated_process_data)
+        logger.debug("Process summary: %d new, %d removed, %d changed states",
+                     len(new_processes), len(unknown_processes), len(state_changed))
+
+        for uid in state_changed:
+            self.process_state_changed.emit(uid, self.model.get_process(uid).state)
 
         return new_processes, unknown_processes
@@ -0,0 +1,215 @@
+import logging
+from typing import List, Dict, Set, Tuple, Optional, Any
+
+from PySide2.QtCore import QAbstractTableModel, QModelIndex, Qt, QSortFilterProxyModel, Signal, QEvent, QRect
+from PySide2.QtWidgets import QStyledItemDelegate, QStyleOptionButton, QStyle, QApplication
+
+from wsmonitor.gui.process_widget import get_color_for_process
+from wsmonitor.process.data import ProcessData
+
+logger = logging.getLogger(__name__)
+
+# the ProcessData of a row, used by the delegates and the filter
+ProcessDataRole = Qt.UserRole + 1
+
+
+class ProcessTableModel(QAbstractTableModel):
+    COLUMN_UID = 0
+    COLUMN_STATE = 1
+    COLUMN_START_STOP = 2
+    COLUMN_RESTART = 3
+    COLUMN_COMMAND = 4
+    HEADERS = ["Process", "State", "", "", "Command"]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._processes: List[ProcessData] = []
+        self._rows: Dict[str, int] = {}
+        self._awaiting_response: Set[str] = set()
+
+    def rowCount(self, parent=QModelIndex()):  # pylint: disable=invalid-name
+        return 0 if parent.isValid() else len(self._processes)
+
+    def columnCount(self, parent=QModelIndex()):  # pylint: disable=invalid-name
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):  # pylint: disable=invalid-name
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def data(self, index: QModelIndex, role=Qt.DisplayRole) -> Any:
+        if not index.isValid():
+            return None
+
+        process = self._processes[index.row()]
+        column = index.column()
+        if role == Qt.DisplayRole:
+            if column == self.COLUMN_UID:
+                return process.uid
+            if column == self.COLUMN_STATE:
+                return process.state_info()
+            if column == self.COLUMN_COMMAND:
+                return process.command
+            return None
+
+        if role == Qt.BackgroundRole:
+            return get_color_for_process(process)
+        if role == Qt.ToolTipRole and column == self.COLUMN_COMMAND:
+            return process.command
+        if role == ProcessDataRole:
+            return process
+        return None
+
+    def is_awaiting_response(self, uid: str) -> bool:
+        return uid in self._awaiting_response
+
+    def set_awaiting_response(self, uid: str, awaiting: bool) -> None:
+        if awaiting:
+            self._awaiting_response.add(uid)
+        else:
+            self._awaiting_response.discard(uid)
+        self._row_changed(uid)
+
+    def get_process(self, uid: str) -> Optional[ProcessData]:
+        row = self._rows.get(uid, None)
+        return None if row is None else self._processes[row]
+
+    def update_state(self, uid: str, state: str, exit_code: Optional[int]) -> bool:
+        """
+        Returns whether the state of the process has changed.
+        """
+        process = self.get_process(uid)
+        if process is None:
+            return False
+
+        changed = process.state != state
+        if changed or process.exit_code != exit_code:
+            process.state = state
+            process.exit_code = exit_code
+            self._row_changed(uid)
+        return changed
+
+    def update_processes(self, processes: Set[ProcessData]) -> Tuple[Set[ProcessData], Set[ProcessData], Set[str]]:
+        """
+        Applies a full summary, returns the new and removed processes and the
+        uids whose state has changed.
+        """
+        known = set(self._processes)
+        new_processes = processes - known
+        removed_processes = known - processes
+        state_changed = set()
+
+        for process in processes:
+            if process not in known:
+                continue
+            current = self.get_process(process.uid)
+            if current.state != process.state:
+                state_changed.add(process.uid)
+            if (current.state, current.exit_code, current.command) != \
+                    (process.state, process.exit_code, process.command):
+                current.state = process.state
+                current.exit_code = process.exit_code
+                current.command = process.command
+                self._row_changed(process.uid)
+
+        if removed_processes:
+            # removals are rare, rebuild the rows instead of moving them
+            self.beginResetModel()
+            self._processes = [process for process in self._processes if process not in removed_processes]
+            self._rows = {process.uid: row for row, process in enumerate(self._processes)}
+            self._awaiting_response -= {process.uid for process in removed_processes}
+            self.endResetModel()
+
+        if new_processes:
+            first = len(self._processes)
+            self.beginInsertRows(QModelIndex(), first, first + len(new_processes) - 1)
+            for process in sorted(new_processes, key=lambda data: data.uid):
+                self._rows[process.uid] = len(self._processes)
+                self._processes.append(process)
+            self.endInsertRows()
+
+        return new_processes, removed_processes, state_changed
+
+    def _row_changed(self, uid: str) -> None:
+        row = self._rows.get(uid, None)
+        if row is not None:
+            self.dataChanged.emit(self.index(row, 0), self.index(row, self.columnCount() - 1))
+
+
+class ProcessFilterProxyModel(QSortFilterProxyModel):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.state_filter: Optional[str] = None
+        self.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        self.setFilterKeyColumn(-1)
+
+    def set_state_filter(self, state: Optional[str]) -> None:
+        self.state_filter = state
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row: int, source_parent: QModelIndex) -> bool:  # pylint: disable=invalid-name
+        if self.state_filter is not None:
+            index = self.sourceModel().index(source_row, 0, source_parent)
+            process: ProcessData = self.sourceModel().data(index, ProcessDataRole)
+            if process.state != self.state_filter:
+                return False
+        return super().filterAcceptsRow(source_row, source_parent)
+
+
+class ActionButtonDelegate(QStyledItemDelegate):
+    """
+    Paints the start/stop or restart button of a row instead of creating
+    button widgets, clicks are reported through action_requested.
+    """
+    action_requested = Signal(str, str)
+
+    def __init__(self, model: ProcessTableModel, restart: bool = False, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.model = model
+        self.restart = restart
+        self._pressed: Optional[Tuple[str, bool]] = None
+
+    def _button(self, process: ProcessData) -> Tuple[str, QStyle.StandardPixmap, bool]:
+        enabled = not self.model.is_awaiting_response(process.uid)
+        if self.restart:
+            return "Restart", QStyle.SP_BrowserReload, enabled and process.is_in_state(ProcessData.STARTED)
+        if process.is_in_state(ProcessData.STARTED):
+            return "Stop", QStyle.SP_MediaStop, enabled
+        return "Start", QStyle.SP_MediaPlay, enabled and process.is_in_state(ProcessData.INITIALIZED,
+                                                                             ProcessData.ENDED)
+
+    def paint(self, painter, option, index):
+        process: ProcessData = index.data(ProcessDataRole)
+        if process is None:
+            return
+
+        text, icon, enabled = self._button(process)
+        style = QApplication.style()
+        button = QStyleOptionButton()
+        button.rect = QRect(option.rect).adjusted(2, 2, -2, -2)
+        button.text = text
+        button.icon = style.standardIcon(icon)
+        button.iconSize = option.decorationSize
+        button.state = QStyle.State_Enabled if enabled else QStyle.State_None
+        if enabled and self._pressed == (process.uid, self.restart):
+            button.state |= QStyle.State_Sunken
+        style.drawControl(QStyle.CE_PushButton, button, painter)
+
+    def editorEvent(self, event, model, option, index):  # pylint: disable=invalid-name
+        process: ProcessData = index.data(ProcessDataRole)
+        if process is None or event.type() not in (QEvent.MouseButtonPress, QEvent.MouseButtonRelease):
+            return False
+
+        if event.type() == QEvent.MouseButtonPress:
+            self._pressed = (process.uid, self.restart)
+            return True
+
+        clicked = self._pressed == (process.uid, self.restart) and option.rect.contains(event.pos())
+        self._pressed = None
+        text, _, enabled = self._button(process)
+        if clicked and enabled:
+            self.model.set_awaiting_response(process.uid, True)
+            self.action_requested.emit(process.uid, text.lower())
+        return True
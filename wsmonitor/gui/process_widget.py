@@ -1,13 +1,15 @@
 import logging
-from typing import Dict
+from collections import OrderedDict
+from typing import Dict, Set, Optional
 
 from PySide2 import QtCore, QtGui
 from PySide2.QtCore import Signal, Slot
-from PySide2.QtGui import QColor, QTextCursor, Qt
-from PySide2.QtWidgets import QWidget, QGridLayout, QLabel, QPushButton, QSizePolicy, QStyle, QVBoxLayout, QTextEdit, \
-    QCheckBox, QTabWidget, QHBoxLayout
+from PySide2.QtGui import QColor, QTextCursor, Qt, QTextCharFormat
+from PySide2.QtWidgets import QWidget, QGridLayout, QLabel, QPushButton, QSizePolicy, QStyle, QVBoxLayout, \
+    QPlainTextEdit, QCheckBox, QTabWidget, QHBoxLayout, QComboBox
 
-from wsmonitor.process.data import ProcessData
+from wsmonitor.gui.output_buffer import OutputBuffer
+from wsmonitor.process.data import ProcessData, OutputEvent
 
 logger = logging.getLogger(__name__)
 
@@ -165,30 +167,126 @@ class ProcessWidget(BlinkBackgroundWidget):
 
 
 class ProcessOutputTabsWidget(QTabWidget):
-
-    def __init__(self, *args, **kwargs):
+    """
+    Output views are only created once a process is opened, at most
+    max_open_tabs views exist at a time. The output of processes without a
+    view is kept in a small buffer which fills the view once it is opened.
+    Together these keep at most max_pending_lines, the buffers of the
+    processes which had no output for the longest time are dropped first.
+    """
+    MAX_OPEN_TABS = 16
+    PENDING_LINES = 500
+    MAX_PENDING_LINES = 50000
+
+    def __init__(self, *args, max_open_tabs: int = MAX_OPEN_TABS, pending_lines: int = PENDING_LINES,
+                 max_pending_lines: int = MAX_PENDING_LINES, **kwargs):
         super().__init__(*args, **kwargs)
-        self.tabs: Dict[str, ProcessOutputTabWidget] = {}
+        self.max_open_tabs = max_open_tabs
+        self.pending_lines = pending_lines
+        self.max_pending_lines = max_pending_lines
+        # ordered by the last use, the first tab is closed first
+        self.tabs: Dict[str, ProcessOutputTabWidget] = OrderedDict()
+        # ordered by the last output, the first buffer is dropped first
+        self.pending: Dict[str, OutputBuffer] = OrderedDict()
+        self._pending_line_count = 0
+        self.uids: Set[str] = set()
+
+        self.setTabsClosable(True)
+        self.tabCloseRequested.connect(lambda index: self.close_process_tab(self.tabText(index)))
+        self.currentChanged.connect(self._on_current_changed)
 
     def add_process_tab(self, uid: str):
-        logger.info("Added output tab for %s", uid)
-        output = ProcessOutputTabWidget(self)
-        self.tabs[uid] = output
-        output.tab_id = self.addTab(output, uid)
+        self.uids.add(uid)
 
     def remove_process_tab(self, uid: str):
-        logger.info("Remove output tab for %s", uid)
-        output = self.tabs[uid]
-        self.removeTab(output.tab_id)
-        del self.tabs[uid]
-        output.deleteLater()
-
-    def append_output(self, uid: str, output: str):
-        tab = self.tabs[uid]
-        tab.append(output)
+        logger.info("Remove output of %s", uid)
+        self.uids.discard(uid)
+        self._pop_pending(uid)
+        if uid in self.tabs:
+            self._remove_tab(uid)
+
+    def open_process_tab(self, uid: str):
+        if uid not in self.uids:
+            return
+
+        tab = self.tabs.get(uid, None)
+        if tab is None:
+            if len(self.tabs) >= self.max_open_tabs:
+                self.close_process_tab(next(iter(self.tabs)))
+
+            logger.info("Open output tab for %s", uid)
+            tab = ProcessOutputTabWidget(self)
+            pending = self._pop_pending(uid)
+            if pending is not None:
+                tab.load(pending)
+            self.tabs[uid] = tab
+            self.addTab(tab, uid)
+
+        self.setCurrentWidget(tab)
+
+    def close_process_tab(self, uid: str):
+        if uid not in self.tabs:
+            return
+
+        tab = self._remove_tab(uid)
+        # keep the tail of the output for re-opening the view
+        pending = OutputBuffer(self.pending_lines)
+        for stream, wall, output in tab.buffer.chunks():
+            pending.append(stream, wall, output)
+        self.pending[uid] = pending
+        self._pending_line_count += pending.line_count()
+        self._drop_pending()
+
+    def _pop_pending(self, uid: str) -> Optional[OutputBuffer]:
+        pending = self.pending.pop(uid, None)
+        if pending is not None:
+            self._pending_line_count -= pending.line_count()
+        return pending
+
+    def _drop_pending(self) -> None:
+        # the most recent buffer is kept, it is bounded by pending_lines
+        while self._pending_line_count > self.max_pending_lines and len(self.pending) > 1:
+            self._pop_pending(next(iter(self.pending)))
+
+    def _remove_tab(self, uid: str) -> 'ProcessOutputTabWidget':
+        tab = self.tabs.pop(uid)
+        self.removeTab(self.indexOf(tab))
+        tab.deleteLater()
+        return tab
+
+    def _on_current_changed(self, index: int):
+        tab = self.widget(index)
+        for uid, open_tab in self.tabs.items():
+            if open_tab is tab:
+                self.tabs.move_to_end(uid)
+                break
+
+    def append_output(self, uid: str, output: OutputEvent):
+        tab = self.tabs.get(uid, None)
+        if tab is not None:
+            tab.append_event(output)
+            return
+        if uid not in self.uids:
+            # e.g. output arriving after the process was removed
+            return
+
+        pending = self.pending.get(uid, None)
+        if pending is None:
+            pending = self.pending[uid] = OutputBuffer(self.pending_lines)
+        else:
+            self.pending.move_to_end(uid)
+        lines = pending.line_count()
+        pending.append_event(output)
+        self._pending_line_count += pending.line_count() - lines
+        self._drop_pending()
 
     def process_state_changed(self, uid: str, state: str):
-        tab = self.tabs[uid]
+        tab = self.tabs.get(uid, None)
+        if tab is None:
+            if state == ProcessData.STARTED:
+                self._pop_pending(uid)
+            return
+
         tab.process_state_changed(state)
         # Show output on process start
         if state == ProcessData.STARTED:
@@ -198,13 +296,19 @@ class ProcessOutputTabsWidget(QTabWidget):
 class ProcessOutputTabWidget(QWidget):
     STARTED_OUTPUT_LINE = "\n" + "-" * 19 + " OUTPUT STARTED " + "-" * 19 + "\n\n"
     ENDED_OUTPUT_LINE = "\n" + "-" * 20 + " OUTPUT ENDED " + "-" * 20 + "\n"
+    MAX_LINES = 10000
 
-    def __init__(self, *args, **kwargs) -> None:
+    def __init__(self, *args, max_lines: int = MAX_LINES, **kwargs) -> None:
         super().__init__(*args, **kwargs)
 
-        self.tab_id = -1
+        # The buffer keeps the output for re-rendering with other filters,
+        # both the buffer and the document are limited to max_lines
+        self.buffer = OutputBuffer(max_lines)
         self.layout = QVBoxLayout(self)
-        self.txt_output = QTextEdit(self)
+        self.txt_output = QPlainTextEdit(self)
+        self.txt_output.setMaximumBlockCount(max_lines)
+        self.txt_output.setLineWrapMode(QPlainTextEdit.NoWrap)
+        self.txt_output.setUndoRedoEnabled(False)
 
         policy = self.txt_output.sizePolicy()
         policy.setHorizontalPolicy(QSizePolicy.MinimumExpanding)
@@ -219,8 +323,15 @@ class ProcessOutputTabWidget(QWidget):
         sub_layout = QHBoxLayout(self)
         self.chb_clear_on_start = QCheckBox(self, text="Clear on start")
         self.chb_clear_on_start.setChecked(True)
+        self.cmb_stream = QComboBox(self)
+        self.cmb_stream.addItem("stdout + stderr", None)
+        self.cmb_stream.addItem("stdout", OutputEvent.STDOUT)
+        self.cmb_stream.addItem("stderr", OutputEvent.STDERR)
+        self.chb_timestamps = QCheckBox(self, text="Timestamps")
         self.btn_clear = QPushButton(self, text="Clear output")
         sub_layout.addWidget(self.chb_clear_on_start)
+        sub_layout.addWidget(self.cmb_stream)
+        sub_layout.addWidget(self.chb_timestamps)
         sub_layout.addStretch()
         sub_layout.addWidget(self.btn_clear)
 
@@ -228,14 +339,64 @@ class ProcessOutputTabWidget(QWidget):
         self.setLayout(self.layout)
         self.txt_output.setReadOnly(True)
 
+        self.stdout_format = QTextCharFormat()
+        self.stderr_format = QTextCharFormat()
+        self.stderr_format.setForeground(QColor(180, 0, 0))
+
         self.btn_clear.clicked.connect(self.clear)
+        self.cmb_stream.currentIndexChanged.connect(self.render)
+        self.chb_timestamps.toggled.connect(self.render)
 
     def clear(self) -> None:
+        self.buffer.clear()
         self.txt_output.clear()
 
+    def load(self, buffer: OutputBuffer) -> None:
+        for stream, wall, output in buffer.chunks():
+            self.buffer.append(stream, wall, output)
+        self.render()
+
     def append(self, output: str):
-        self.txt_output.moveCursor(QTextCursor.End)
-        self.txt_output.insertPlainText(output)
+        self.buffer.append(0, 0, output)
+        self._insert([(0, 0, output)])
+
+    def append_event(self, event: OutputEvent):
+        stream = self.cmb_stream.currentData()
+        chunks = []
+        for chunk_stream, wall, _, output in event.iter_chunks():
+            self.buffer.append(chunk_stream, wall, output)
+            if stream is None or chunk_stream in (stream, 0):
+                chunks.append((chunk_stream, wall, output))
+
+        if chunks:
+            self._insert(chunks)
+
+    def render(self) -> None:
+        # re-create the document from the buffer, e.g. after a filter change
+        self.txt_output.clear()
+        self._insert(self.buffer.chunks(self.cmb_stream.currentData()))
+
+    def _insert(self, chunks) -> None:
+        scrollbar = self.txt_output.verticalScrollBar()
+        follow = scrollbar.value() == scrollbar.maximum()
+        timestamps = self.chb_timestamps.isChecked()
+
+        cursor = QTextCursor(self.txt_output.document())
+        cursor.movePosition(QTextCursor.End)
+        # a single edit block only lays out the document once
+        cursor.beginEditBlock()
+        for chunk_stream, wall, output in chunks:
+            if timestamps and wall:
+                prefix = QtCore.QDateTime.fromMSecsSinceEpoch(int(wall * 1000)).toString("hh:mm:ss.zzz ")
+                output = "".join(prefix + line for line in output.splitlines(True))
+
+            text_format = self.stderr_format if chunk_stream == OutputEvent.STDERR else self.stdout_format
+            cursor.insertText(output, text_format)
+        cursor.endEditBlock()
+
+        # only follow the output if the view was scrolled to the end
+        if follow:
+            scrollbar.setValue(scrollbar.maximum())
 
     def process_state_changed(self, state: str) -> None:
         if state == ProcessData.STARTED:
@@ -0,0 +1,170 @@
+import logging
+from typing import List, Dict, Optional
+
+from PySide2 import QtWebSockets
+from PySide2.QtCore import QObject, Signal, Slot, QTimer, QUrl
+
+from wsmonitor.format import JsonFormattable
+from wsmonitor.process.data import OutputEvent, ProcessSummaryEvent, StateBatchEvent
+from wsmonitor.resume import Backoff, ResumeState
+from wsmonitor.util import from_json
+from wsmonitor.wire import FEATURE_BINARY, FEATURE_BATCH, decode_frame, with_features
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+class WebsocketWorker(QObject):
+    """
+    Owns the websocket and decodes the incoming messages, meant to be moved
+    to its own QThread. The decoded events are collected and delivered as
+    batches to the UI at most frame_rate times per second.
+    A lost connection is re-established with a jittered backoff and resumes
+    the session, only the missed events are received again.
+    """
+    connected = Signal()
+    disconnected = Signal()
+    reconnecting = Signal(float)
+    error = Signal(str)
+    events_received = Signal(list)
+
+    def __init__(self, frame_rate: int = 30, backoff: Optional[Backoff] = None):
+        super().__init__()
+        self.frame_rate = frame_rate
+        self.backoff = Backoff() if backoff is None else backoff
+        self.resume = ResumeState()
+        self.client: Optional[QtWebSockets.QWebSocket] = None
+        self._server_url: Optional[str] = None
+        self._closing = False
+        self._timer: Optional[QTimer] = None
+        self._reconnect_timer: Optional[QTimer] = None
+        self._batch: List[JsonFormattable] = []
+        self._pending_output: Dict[str, OutputEvent] = {}
+
+    @Slot()
+    def setup(self):
+        # Called once the thread has been started, the objects have to be
+        # created in the worker thread
+        self.client = QtWebSockets.QWebSocket("", QtWebSockets.QWebSocketProtocol.Version13, self)
+        self.client.error.connect(self.on_error)
+        self.client.connected.connect(self.on_connected)
+        self.client.disconnected.connect(self.on_disconnected)
+        self.client.textMessageReceived.connect(self.on_message)
+        self.client.binaryMessageReceived.connect(self.on_binary_message)
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(int(1000 / self.frame_rate))
+        self._timer.timeout.connect(self.flush)
+
+        self._reconnect_timer = QTimer(self)
+        self._reconnect_timer.setSingleShot(True)
+        self._reconnect_timer.timeout.connect(self._reopen)
+
+    @Slot(str)
+    def open(self, server_url: str):
+        if server_url != self._server_url:
+            # another server, nothing to resume
+            self.resume = ResumeState()
+        self._server_url = server_url
+        self._closing = False
+        self._reconnect_timer.stop()
+        self._reopen()
+
+    def _reopen(self):
+        # the output is received as binary frames, state changes in batches
+        server_url = with_features(self.resume.url(self._server_url), [FEATURE_BINARY, FEATURE_BATCH])
+        logger.info("Connecting to: %s", server_url)
+        self.client.open(QUrl(server_url))
+
+    @Slot()
+    def close(self):
+        self._closing = True
+        if self._reconnect_timer is not None:
+            self._reconnect_timer.stop()
+        if self.client is not None:
+            self.client.close()
+        if self._timer is not None:
+            self._timer.stop()
+
+    def on_connected(self):
+        self.backoff.reset()
+        self.connected.emit()
+
+    def on_disconnected(self):
+        self.disconnected.emit()
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        # a failed connection attempt may report the error and disconnect
+        if self._closing or self._server_url is None or self._reconnect_timer.isActive():
+            return
+
+        delay = self.backoff.next_delay()
+        logger.info("Reconnecting in %.1fs", delay)
+        self.reconnecting.emit(delay)
+        self._reconnect_timer.start(int(delay * 1000))
+
+    @Slot(str)
+    def send(self, message: str):
+        self.client.sendTextMessage(message)
+
+    def on_error(self, error_code):
+        error_msg = self.client.errorString()
+        logger.error("WS Error, code: %s: %s", error_code, error_msg)
+        self.client.close()
+        self.error.emit(error_msg)
+        self._schedule_reconnect()
+
+    def on_message(self, message: str):
+        event = from_json(message)
+        if event is None:
+            logger.error("Failed to decode message: %s", message[:200])
+            return
+        if isinstance(event, StateBatchEvent):
+            for state_event in event.events:
+                self._on_event(state_event)
+            return
+        self._on_event(event)
+
+    def on_binary_message(self, message):
+        event = decode_frame(message.data())
+        if event is not None:
+            self._on_event(event)
+
+    def _on_event(self, event: JsonFormattable):
+        if not self.resume.accept(event):
+            return
+
+        self._add_to_batch(event)
+        # the first event of a batch arms the timer
+        if not self._timer.isActive():
+            self._timer.start()
+
+    def _add_to_batch(self, event: JsonFormattable):
+        if isinstance(event, OutputEvent):
+            # merge output into the pending event of the process, unless
+            # another event for the process came in between
+            pending = self._pending_output.get(event.uid, None)
+            if pending is not None:
+                pending.extend(event)
+                return
+            self._pending_output[event.uid] = event
+
+        elif isinstance(event, ProcessSummaryEvent):
+            self._pending_output.clear()
+
+        elif hasattr(event, "uid"):
+            self._pending_output.pop(event.uid, None)
+
+        self._batch.append(event)
+
+    @Slot()
+    def flush(self):
+        if not self._batch:
+            return
+
+        batch = self._batch
+        self._batch = []
+        self._pending_output.clear()
+        self.events_received.emit(batch)
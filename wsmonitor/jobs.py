@@ -0,0 +1,180 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from typing import Dict, Any, Callable, Optional, List, Union
+
+from wsmonitor.process.data import JobEvent
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# where the function of a job runs
+LOOP = "loop"
+THREAD = "thread"
+PROCESS = "process"
+EXECUTORS = (LOOP, THREAD, PROCESS)
+
+# the client which started a job and the event to send to it
+JobEventCallback = Callable[[Any, JobEvent], None]
+
+
+class Job:
+    """
+    A running job, passed to the job function as its first argument to
+    report progress and to check for cancellation. Functions on a thread
+    pool cannot be interrupted, they should return once is_cancelled().
+    """
+    RUNNING = "running"
+
+    def __init__(self, job_id: int, action: str, client: Any,
+                 loop: asyncio.AbstractEventLoop, on_progress: Callable[['Job'], None]):
+        self.id = job_id
+        self.action = action
+        self.client = client
+        self.state = Job.RUNNING
+        self.progress_data: Any = None
+        self.result: Any = None
+        self.started = time.time()
+        self.ended: Optional[float] = None
+        self.future: Optional[asyncio.Future] = None
+        self._loop = loop
+        self._on_progress = on_progress
+        self._cancelled = threading.Event()
+        self._progress_pending = False
+
+    def progress(self, data: Any) -> None:
+        """
+        Reports the progress, may be called from any thread. Only the latest
+        progress is sent if it is reported faster than it can be sent.
+        """
+        self.progress_data = data
+        if not self._progress_pending:
+            self._progress_pending = True
+            self._loop.call_soon_threadsafe(self._send_progress)
+
+    def _send_progress(self) -> None:
+        self._progress_pending = False
+        if self.state == Job.RUNNING:
+            self._on_progress(self)
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def to_json(self) -> Dict[str, Any]:
+        return {"job": self.id, "action": self.action, "state": self.state,
+                "progress": self.progress_data, "result": self.result,
+                "started": self.started, "ended": self.ended}
+
+
+class JobManager:
+    """
+    Runs the functions of job actions without blocking the action handling:
+    coroutines on the loop, other functions on a thread or process pool.
+    The pools are created on first use with thread_workers and
+    process_workers, None for the defaults of concurrent.futures. Finished
+    jobs are kept until keep_finished newer ones ended.
+    """
+
+    def __init__(self, on_event: JobEventCallback, thread_workers: Optional[int] = None,
+                 process_workers: Optional[int] = None, keep_finished: int = 100):
+        self.thread_workers = thread_workers
+        self.process_workers = process_workers
+        self.keep_finished = keep_finished
+        self._on_event = on_event
+        self._jobs: Dict[int, Job] = {}
+        self._finished: List[int] = []
+        self._next_id = 0
+        self._thread_pool: Optional[ThreadPoolExecutor] = None
+        self._process_pool: Optional[ProcessPoolExecutor] = None
+
+    def _executor(self, executor: Union[str, Executor]) -> Executor:
+        if isinstance(executor, Executor):
+            return executor
+        if executor == THREAD:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPoolExecutor(self.thread_workers, thread_name_prefix="wsmonitor-job")
+            return self._thread_pool
+        if self._process_pool is None:
+            self._process_pool = ProcessPoolExecutor(self.process_workers)
+        return self._process_pool
+
+    def start(self, action: str, func: Callable, args: List[Any],
+              executor: Union[str, Executor] = LOOP, client: Any = None) -> Job:
+        """
+        Runs func with the job and args. Functions on a process pool only
+        get the args, they cannot report progress.
+        """
+        loop = asyncio.get_event_loop()
+        self._next_id += 1
+        job = Job(self._next_id, action, client, loop,
+                  lambda progressed: self._send(progressed, JobEvent.PROGRESS, progressed.progress_data))
+        self._jobs[job.id] = job
+
+        if executor == LOOP:
+            job.future = asyncio.ensure_future(func(job, *args))
+        else:
+            pool = self._executor(executor)
+            call = partial(func, *args) if isinstance(pool, ProcessPoolExecutor) else partial(func, job, *args)
+            job.future = loop.run_in_executor(pool, call)
+        job.future.add_done_callback(partial(self._on_done, job))
+        logger.info("Job %d: started %s", job.id, action)
+        return job
+
+    def _on_done(self, job: Job, future: asyncio.Future) -> None:
+        job.ended = time.time()
+        if future.cancelled() or job.is_cancelled():
+            job.state = JobEvent.CANCELLED
+        elif future.exception() is not None:
+            logger.warning("Job %d: %s failed", job.id, job.action, exc_info=future.exception())
+            job.state = JobEvent.FAILED
+            job.result = f"{future.exception().__class__.__name__}: {future.exception()}"
+        else:
+            result = future.result()
+            try:
+                json.dumps(result)
+                job.state = JobEvent.DONE
+                job.result = result
+            except (TypeError, ValueError) as excpt:
+                job.state = JobEvent.FAILED
+                job.result = f"The result cannot be sent: {excpt}"
+
+        logger.info("Job %d: %s %s", job.id, job.action, job.state)
+        self._send(job, job.state, job.result)
+        self._finished.append(job.id)
+        while len(self._finished) > self.keep_finished:
+            self._jobs.pop(self._finished.pop(0), None)
+
+    def _send(self, job: Job, state: str, data: Any) -> None:
+        if job.client is not None:
+            self._on_event(job.client, JobEvent(job.id, job.action, state, data))
+
+    def cancel(self, job_id: int) -> Union[str, Job]:
+        job = self._jobs.get(job_id, None)
+        if job is None:
+            return f"Unknown job: {job_id}"
+        if job.state != Job.RUNNING:
+            return f"Job {job_id} already {job.state}"
+        job._cancelled.set()
+        # a running function of a pool is not interrupted, its result is
+        # dropped
+        job.future.cancel()
+        return job
+
+    def get_jobs(self) -> List[Job]:
+        return list(self._jobs.values())
+
+    def running(self) -> int:
+        return sum(1 for job in self._jobs.values() if job.state == Job.RUNNING)
+
+    def shutdown(self) -> None:
+        for job in self._jobs.values():
+            if job.state == Job.RUNNING:
+                self.cancel(job.id)
+        for pool in (self._thread_pool, self._process_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        self._thread_pool = self._process_pool = None
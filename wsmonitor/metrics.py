@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from typing import Dict, Tuple, Callable, List, Any, Union, Optional
+
+logger = logging.getLogger(__name__)
+
+Labels = Tuple[Tuple[str, str], ...]
+GaugeValue = Union[float, Dict[Labels, float]]
+
+# seconds, from 100us to 10s
+DEFAULT_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10.)
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[int]:
+        total = 0
+        result = []
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (key + '="' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+               for key, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+class Metrics:
+    """
+    Registry of counters, histograms and gauges. Counters and histograms are
+    plain objects which callers look up once and keep, updating them is a
+    single addition. Gauges are callables evaluated when the metrics are read.
+    """
+
+    def __init__(self):
+        self._counters: Dict[str, Dict[Labels, Counter]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._gauges: Dict[str, Callable[[], GaugeValue]] = {}
+        self._descriptions: Dict[str, str] = {}
+
+    def counter(self, name: str, description: str = "", **labels) -> Counter:
+        series = self._counters.setdefault(name, {})
+        key = _labels(labels)
+        counter = series.get(key, None)
+        if counter is None:
+            counter = series[key] = Counter()
+            self._descriptions.setdefault(name, description)
+        return counter
+
+    def histogram(self, name: str, description: str = "", buckets=DEFAULT_BUCKETS, **labels) -> Histogram:
+        series = self._histograms.setdefault(name, {})
+        key = _labels(labels)
+        histogram = series.get(key, None)
+        if histogram is None:
+            histogram = series[key] = Histogram(buckets)
+            self._descriptions.setdefault(name, description)
+        return histogram
+
+    def gauge(self, name: str, func: Callable[[], GaugeValue], description: str = "") -> None:
+        self._gauges[name] = func
+        self._descriptions.setdefault(name, description)
+
+    def remove(self, name: str, **labels) -> None:
+        key = _labels(labels)
+        for metrics in (self._counters, self._histograms):
+            if name in metrics:
+                metrics[name].pop(key, None)
+
+    def _gauge_values(self, name: str) -> Dict[Labels, float]:
+        try:
+            value = self._gauges[name]()
+        except Exception as excpt:  # pylint: disable=broad-except
+            logger.warning("Gauge %s failed: %s", name, excpt)
+            return {}
+        return value if isinstance(value, dict) else {(): value}
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Returns the metrics as json compatible dict, series are keyed by
+        their labels formatted like "key=value,key=value". Metrics without
+        labels map to their value directly.
+        """
+        def series_dict(series: Dict[Labels, Any]) -> Any:
+            if len(series) == 1 and () in series:
+                return series[()]
+            return {",".join(f"{name}={value}" for name, value in labels): value
+                    for labels, value in series.items()}
+
+        result: Dict[str, Any] = {}
+        for name, series in self._counters.items():
+            result[name] = series_dict({labels: counter.value for labels, counter in series.items()})
+        for name in self._gauges:
+            result[name] = series_dict(self._gauge_values(name))
+        for name, series in self._histograms.items():
+            result[name] = series_dict({labels: {"count": histogram.count, "sum": histogram.sum,
+                                                 "buckets": list(histogram.buckets), "counts": histogram.counts}
+                                        for labels, histogram in series.items()})
+        return result
+
+    def prometheus_text(self) -> str:
+        lines = []
+
+        def header(name: str, metric_type: str):
+            if self._descriptions.get(name):
+                lines.append(f"# HELP {name} {self._descriptions[name]}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+        for name, series in self._counters.items():
+            header(name, "counter")
+            lines.extend(f"{name}{_format_labels(labels)} {counter.value}" for labels, counter in series.items())
+
+        for name in self._gauges:
+            header(name, "gauge")
+            lines.extend(f"{name}{_format_labels(labels)} {value}"
+                         for labels, value in self._gauge_values(name).items())
+
+        for name, series in self._histograms.items():
+            header(name, "histogram")
+            for labels, histogram in series.items():
+                bounds = [str(bound) for bound in histogram.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, histogram.cumulative()):
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {count}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+async def measure_loop_lag(metrics: Metrics, interval: float = .5) -> None:
+    """
+    Measures how late the event loop wakes up from a sleep, runs until cancelled.
+    """
+    histogram = metrics.histogram("wsmonitor_event_loop_lag_seconds", "Delay of scheduled callbacks")
+    last_lag = [0.]
+    metrics.gauge("wsmonitor_event_loop_lag_last_seconds", lambda: last_lag[0], "Last measured event loop lag")
+
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = max(time.monotonic() - start - interval, 0.)
+        last_lag[0] = lag
+        histogram.observe(lag)
+
+
+async def serve_prometheus(metrics: Metrics, host: str = "127.0.0.1", port: int = 9766) -> Optional[asyncio.AbstractServer]:
+    """
+    Serves the metrics in the Prometheus text format over plain HTTP.
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await reader.readline()
+            # skip the headers
+            while (await reader.readline()).strip():
+                pass
+
+            if request.split(b" ")[0] != b"GET":
+                status, body = "405 Method Not Allowed", b""
+            else:
+                status, body = "200 OK", metrics.prometheus_text().encode()
+
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    try:
+        server = await asyncio.start_server(handle, host, port)
+    except OSError as excpt:
+        logger.error("Failed to start the metrics endpoint: %s", excpt)
+        return None
+
+    logger.info("Serving metrics on http://%s:%d/metrics", host, port)
+    return server
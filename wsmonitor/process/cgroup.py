@@ -0,0 +1,220 @@
+import logging
+import os
+from typing import Optional, Dict, Any, Union
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+CGROUP_MOUNT = "/sys/fs/cgroup"
+CONTROLLERS = ("cpu", "memory", "pids")
+# the limits of a process config and the files they are written to
+LIMIT_FILES = {"memory_max": "memory.max", "cpu_max": "cpu.max", "pids_max": "pids.max"}
+CPU_PERIOD = 100000
+
+
+def check_limits(limits: Any) -> Optional[str]:
+    """
+    Returns the reason why limits are invalid, None if they are valid.
+    """
+    if limits is None:
+        return None
+    if not isinstance(limits, dict):
+        return "limits must be an object"
+    unknown = set(limits) - set(LIMIT_FILES)
+    if unknown:
+        return f"Unknown limits {sorted(unknown)}, expected {sorted(LIMIT_FILES)}"
+    for key, value in limits.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            return f"Invalid value for {key}: {value!r}"
+    return None
+
+
+def format_limit(key: str, value: Union[int, float, str]) -> str:
+    # cpu_max is given in CPUs, e.g. 0.5, or as "<quota> <period>"
+    if key == "cpu_max" and not isinstance(value, str):
+        return f"{max(int(value * CPU_PERIOD), 1000)} {CPU_PERIOD}"
+    # memory_max in bytes or with a suffix, e.g. "512M"
+    return str(value)
+
+
+def own_cgroup() -> Optional[str]:
+    # the cgroup v2 path of this process below the mount point
+    try:
+        with open("/proc/self/cgroup", "r") as cgroup_file:
+            for line in cgroup_file:
+                if line.startswith("0::"):
+                    return line[3:].strip()
+    except OSError:
+        pass
+    return None
+
+
+def delegated_root() -> Optional[str]:
+    """
+    Returns the cgroup of this process if it is a cgroup v2 which this user
+    may manage, e.g. one created by systemd-run --user --scope -p Delegate=yes.
+    """
+    path = own_cgroup()
+    if path is None:
+        return None
+    root = os.path.join(CGROUP_MOUNT, path.lstrip("/"))
+    if not os.path.exists(os.path.join(root, "cgroup.controllers")):
+        return None
+    if not os.access(root, os.W_OK) or not os.access(os.path.join(root, "cgroup.subtree_control"), os.W_OK):
+        return None
+    return root
+
+
+class Cgroup:
+    """
+    The cgroup of one process, it is kept across restarts.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def place_self(self) -> None:
+        # called in the child before exec, moves it into the cgroup
+        with open(os.path.join(self.path, "cgroup.procs"), "w") as procs_file:
+            procs_file.write("0")
+
+    def set_limits(self, limits: Dict[str, Any]) -> None:
+        # limits which are not configured are reset
+        for key, filename in LIMIT_FILES.items():
+            path = os.path.join(self.path, filename)
+            if not os.path.exists(path):
+                if key in limits:
+                    logger.warning("Cannot set %s, the controller is not enabled in %s", key, self.path)
+                continue
+            value = format_limit(key, limits[key]) if key in limits else \
+                "max" if key != "cpu_max" else f"max {CPU_PERIOD}"
+            with open(path, "w") as limit_file:
+                limit_file.write(value)
+
+    def _read(self, filename: str) -> Optional[str]:
+        try:
+            with open(os.path.join(self.path, filename), "r") as stat_file:
+                return stat_file.read()
+        except OSError:
+            return None
+
+    def _read_keyed(self, filename: str) -> Dict[str, int]:
+        # files with "<key> <value>" lines like cpu.stat
+        content = self._read(filename)
+        if content is None:
+            return {}
+        return {key: int(value) for key, value in (line.split() for line in content.splitlines() if line)}
+
+    def _read_int(self, filename: str) -> Optional[int]:
+        content = self._read(filename)
+        return int(content) if content is not None and content.strip().isdigit() else None
+
+    def cpu_usec(self) -> Optional[int]:
+        return self._read_keyed("cpu.stat").get("usage_usec", None)
+
+    def memory_bytes(self) -> Optional[int]:
+        return self._read_int("memory.current")
+
+    def usage(self) -> Dict[str, int]:
+        """
+        The accounting of the cgroup: cpu_usec, cpu_user_usec,
+        cpu_system_usec and throttled_usec from cpu.stat, memory_bytes,
+        memory_peak_bytes, oom_kills and pids. Missing files are left out.
+        """
+        usage = {}
+        cpu_stat = self._read_keyed("cpu.stat")
+        for key, name in (("usage_usec", "cpu_usec"), ("user_usec", "cpu_user_usec"),
+                          ("system_usec", "cpu_system_usec"), ("throttled_usec", "throttled_usec")):
+            if key in cpu_stat:
+                usage[name] = cpu_stat[key]
+        for filename, name in (("memory.current", "memory_bytes"), ("memory.peak", "memory_peak_bytes"),
+                               ("pids.current", "pids")):
+            value = self._read_int(filename)
+            if value is not None:
+                usage[name] = value
+        events = self._read_keyed("memory.events")
+        if "oom_kill" in events:
+            usage["oom_kills"] = events["oom_kill"]
+        return usage
+
+    def remove(self) -> bool:
+        # only possible once all of its processes exited
+        try:
+            os.rmdir(self.path)
+            return True
+        except OSError as excpt:
+            logger.warning("Failed to remove cgroup %s: %s", self.path, excpt)
+            return False
+
+
+class CgroupManager:
+    """
+    Creates a cgroup per process below a delegated cgroup v2 root. The
+    server moves itself into a leaf "monitor" if it is a member of the root,
+    as only cgroups without processes can enable controllers for children.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self._cgroups: Dict[str, Cgroup] = {}
+
+    def enable(self) -> Union[str, bool]:
+        """
+        Enables the controllers for the process cgroups, returns the reason
+        if the root cannot be used.
+        """
+        try:
+            with open(os.path.join(self.root, "cgroup.controllers"), "r") as controllers_file:
+                available = controllers_file.read().split()
+        except OSError as excpt:
+            return f"{self.root} is not a cgroup v2: {excpt}"
+
+        try:
+            with open(os.path.join(self.root, "cgroup.procs"), "r") as procs_file:
+                members = procs_file.read().split()
+            if str(os.getpid()) in members:
+                leaf = os.path.join(self.root, "monitor")
+                os.makedirs(leaf, exist_ok=True)
+                Cgroup(leaf).place_self()
+
+            with open(os.path.join(self.root, "cgroup.subtree_control"), "r") as control_file:
+                enabled = control_file.read().split()
+            missing = [controller for controller in CONTROLLERS
+                       if controller in available and controller not in enabled]
+            if missing:
+                with open(os.path.join(self.root, "cgroup.subtree_control"), "w") as control_file:
+                    control_file.write(" ".join("+" + controller for controller in missing))
+        except OSError as excpt:
+            return f"Cannot manage cgroups below {self.root}: {excpt}"
+
+        logger.info("Processes are placed in cgroups below %s", self.root)
+        return True
+
+    def prepare(self, uid: str, limits: Optional[Dict[str, Any]]) -> Optional[Cgroup]:
+        """
+        Creates the cgroup of a process and sets its limits before it is
+        started. Returns None if that fails, the process runs without one.
+        """
+        cgroup = self._cgroups.get(uid, None)
+        try:
+            if cgroup is None:
+                cgroup = Cgroup(os.path.join(self.root, "proc-" + quote(uid, safe="")))
+                os.makedirs(cgroup.path, exist_ok=True)
+                self._cgroups[uid] = cgroup
+            cgroup.set_limits(limits or {})
+        except OSError as excpt:
+            logger.warning("Process[%s]: running without cgroup: %s", uid, excpt)
+            return None
+        return cgroup
+
+    def get(self, uid: str) -> Optional[Cgroup]:
+        return self._cgroups.get(uid, None)
+
+    def remove(self, uid: str) -> None:
+        cgroup = self._cgroups.pop(uid, None)
+        if cgroup is not None:
+            cgroup.remove()
+
+    def cgroups(self) -> Dict[str, Cgroup]:
+        return self._cgroups
@@ -12,11 +12,12 @@ class ProcessData(JsonFormattable):
     ENDED = "Ended"
 
     __slots__ = ('uid', 'command', 'as_process_group', 'state', 'exit_code',
-                 'command_kwargs')
+                 'command_kwargs', 'labels', 'limits')
 
     def __init__(self, uid: str, command: str, as_process_group=False,
                  state="Initialized", exit_code=None,
-                 command_kwargs=None) -> None:
+                 command_kwargs=None, labels: Optional[Dict[str, str]] = None,
+                 limits: Optional[Dict[str, Any]] = None) -> None:
         JsonFormattable.__init__(self)
         self.uid = uid
         self.command: str = command
@@ -24,6 +25,11 @@ class ProcessData(JsonFormattable):
         self.as_process_group: bool = as_process_group
         self.state: str = state
         self.exit_code: Optional[int] = exit_code
+        # free form key/value pairs, e.g. {"team": "x"}, to query processes
+        self.labels = labels
+        # resource limits, applied if the process runs in a cgroup, e.g.
+        # {"memory_max": "512M", "cpu_max": 0.5, "pids_max": 100}
+        self.limits = limits
 
     def get_command(self, **command_kwargs: str) -> str:
         if self.command_kwargs is None:
@@ -88,32 +94,166 @@ class ProcessSummaryEvent(JsonFormattable):
 
 
 class StateChangedEvent(JsonFormattable):
-    __slots__ = ("uid", 'state', 'exit_code')
+    __slots__ = ("uid", 'state', 'exit_code', 'seq')
 
-    def __init__(self, uid: str, state: str, exit_code: Optional[int] = None):
+    def __init__(self, uid: str, state: str, exit_code: Optional[int] = None,
+                 seq: Optional[int] = None):
         super().__init__()
         self.uid = uid
         self.state = state
         self.exit_code = exit_code
+        # sequence number of the state change, set by the server
+        self.seq = seq
+
+
+class StateBatchEvent(JsonFormattable):
+    """
+    State changes of several processes, sent to clients with the batch
+    feature. Each change is sent as [uid, state, exit code, seq].
+    """
+    __slots__ = ('events',)
+
+    def __init__(self, events: List[StateChangedEvent]):
+        super().__init__()
+        self.events = events
+
+    def to_json(self):
+        return {"type": self.__class__.__name__,
+                "data": [[event.uid, event.state, event.exit_code, event.seq] for event in self.events]}
+
+    @classmethod
+    def from_json(cls, json_data):
+        return StateBatchEvent([StateChangedEvent(*entry) for entry in json_data])
 
 
 class OutputEvent(JsonFormattable):
-    __slots__ = ('uid', 'output')
+    STDOUT = 1
+    STDERR = 2
+    STREAMS = {"stdout": STDOUT, "stderr": STDERR}
 
-    def __init__(self, uid: str, output: str):
+    __slots__ = ('uid', 'output', 'chunks', 'offset')
+
+    def __init__(self, uid: str, output: str, chunks: Optional[List[int]] = None,
+                 offset: Optional[int] = None):
         super().__init__()
         self.uid = uid
         self.output = output
+        # Flat list with four entries per chunk of the output: its length,
+        # stream id, wall clock time in ms and monotonic time in us
+        self.chunks = chunks
+        # position of the event in the output stream of the server
+        self.offset = offset
+
+    @classmethod
+    def from_chunk(cls, uid: str, output: str, stream: int, wall: float,
+                   mono: float) -> 'OutputEvent':
+        return cls(uid, output, [len(output), stream, int(wall * 1e3), int(mono * 1e6)])
+
+    def extend(self, other: 'OutputEvent') -> None:
+        if self.chunks is not None:
+            self.chunks.extend(other.iter_chunk_info())
+        self.output += other.output
+
+    def iter_chunk_info(self):
+        if self.chunks is not None:
+            return iter(self.chunks)
+        # output of older servers has no chunk information
+        return iter((len(self.output), 0, 0, 0))
+
+    def iter_chunks(self):
+        """
+        Yields (stream, wall clock time in s, monotonic time in s, output)
+        for each chunk, older servers send a single chunk with stream 0.
+        """
+        info = list(self.iter_chunk_info())
+        start = 0
+        for idx in range(0, len(info), 4):
+            length, stream, wall, mono = info[idx:idx + 4]
+            yield stream, wall / 1e3, mono / 1e6, self.output[start:start + length]
+            start += length
+
+    def filter_stream(self, stream: int) -> 'OutputEvent':
+        chunks = []
+        output = []
+        for chunk_stream, wall, mono, text in self.iter_chunks():
+            if chunk_stream == stream:
+                chunks.extend((len(text), chunk_stream, int(wall * 1e3), int(mono * 1e6)))
+                output.append(text)
+        return OutputEvent(self.uid, "".join(output), chunks, self.offset)
+
+
+class SyncEvent(JsonFormattable):
+    """
+    First message of a connection. Tells the client the session of the
+    server and its current state sequence and output offset, resumed is set
+    if only the missed events follow instead of a full summary.
+    """
+    __slots__ = ('session', 'seq', 'offset', 'resumed')
+
+    def __init__(self, session: str, seq: int, offset: int, resumed: bool = False):
+        super().__init__()
+        self.session = session
+        self.seq = seq
+        self.offset = offset
+        self.resumed = resumed
+
+
+class HandlesEvent(JsonFormattable):
+    """
+    Numeric handles of processes as [handle, uid] pairs. Only sent to
+    clients with the handles feature, which receive state changes and output
+    with the handle instead of the uid.
+    """
+    __slots__ = ('handles',)
+
+    def __init__(self, handles: List[List]):
+        super().__init__()
+        self.handles = handles
+
+
+class MatchEvent(JsonFormattable):
+    __slots__ = ('uid', 'rule', 'action', 'line')
+
+    def __init__(self, uid: str, rule: str, action: str, line: str):
+        super().__init__()
+        self.uid = uid
+        self.rule = rule
+        self.action = action
+        self.line = line
+
+
+class JobEvent(JsonFormattable):
+    """
+    Progress and end of a job started by a job action, only sent to the
+    client which started it. The data is the progress or, once the job
+    ended, the result or the reason it failed.
+    """
+    __slots__ = ('job', 'action', 'state', 'data')
+
+    PROGRESS = "progress"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, job: int, action: str, state: str, data: Any = None):
+        super().__init__()
+        self.job = job
+        self.action = action
+        self.state = state
+        self.data = data
 
 
 class ActionResponse(JsonFormattable):
-    __slots__ = ('uid', 'action', 'success', 'data')
+    __slots__ = ('uid', 'action', 'success', 'data', 'request_id')
 
-    def __init__(self, uid: str, action: str, success=True, data: Any = None):
+    def __init__(self, uid: str, action: str, success=True, data: Any = None,
+                 request_id: Optional[int] = None):
         self.action = action
         self.success = success
         self.uid = uid
         self.data = data
+        # the id of the request, if the client sent one
+        self.request_id = request_id
 
     def __str__(self):
         verb = "succeeded" if self.success else "failed"
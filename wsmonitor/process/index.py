@@ -0,0 +1,140 @@
+import bisect
+import logging
+from typing import Dict, Set, Tuple, List, Optional, Iterable, Any
+
+from wsmonitor.process.data import ProcessData
+
+logger = logging.getLogger(__name__)
+
+
+def check_labels(labels: Any) -> Optional[str]:
+    """
+    Returns the reason why labels are invalid, None if they are valid.
+    """
+    if labels is None:
+        return None
+    if not isinstance(labels, dict) or not all(isinstance(key, str) and isinstance(value, str)
+                                               for key, value in labels.items()):
+        return "labels must be an object with string values"
+    return None
+
+
+def is_failed(data: ProcessData) -> bool:
+    return data.state == ProcessData.ENDED and data.exit_code != 0
+
+
+def matches(data: ProcessData, states: Optional[Iterable[str]] = None,
+            labels: Optional[Dict[str, str]] = None, prefix: Optional[str] = None,
+            failed: Optional[bool] = None) -> bool:
+    if states is not None and data.state not in states:
+        return False
+    if prefix is not None and not data.uid.startswith(prefix):
+        return False
+    if labels:
+        process_labels = data.labels or {}
+        if any(process_labels.get(key, None) != value for key, value in labels.items()):
+            return False
+    return failed is None or is_failed(data) == failed
+
+
+class ProcessIndex:
+    """
+    Secondary indexes of the processes of a monitor: the uids by state, by
+    label and sorted for prefix lookups. The states are updated by the
+    monitor, query checks the candidates against the current data.
+    """
+
+    def __init__(self):
+        self._data: Dict[str, ProcessData] = {}
+        self._uids: List[str] = []
+        self._states: Dict[str, str] = {}
+        self._by_state: Dict[str, Set[str]] = {}
+        self._labels: Dict[str, Dict[str, str]] = {}
+        self._by_label: Dict[Tuple[str, str], Set[str]] = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def add(self, data: ProcessData) -> None:
+        # adds the process or updates its entries
+        if data.uid not in self._data:
+            bisect.insort(self._uids, data.uid)
+        self._data[data.uid] = data
+        self.update_state(data)
+        self.update_labels(data)
+
+    def remove(self, uid: str) -> None:
+        if self._data.pop(uid, None) is None:
+            return
+        del self._uids[bisect.bisect_left(self._uids, uid)]
+        self._discard(self._by_state, self._states.pop(uid), uid)
+        for item in self._labels.pop(uid).items():
+            self._discard(self._by_label, item, uid)
+
+    def update_state(self, data: ProcessData) -> None:
+        previous = self._states.get(data.uid, None)
+        if previous == data.state:
+            return
+        if previous is not None:
+            self._discard(self._by_state, previous, data.uid)
+        self._states[data.uid] = data.state
+        self._by_state.setdefault(data.state, set()).add(data.uid)
+
+    def update_labels(self, data: ProcessData) -> None:
+        labels = dict(data.labels or {})
+        previous = self._labels.get(data.uid, {})
+        for item in previous.items() - labels.items():
+            self._discard(self._by_label, item, data.uid)
+        for item in labels.items() - previous.items():
+            self._by_label.setdefault(item, set()).add(data.uid)
+        self._labels[data.uid] = labels
+
+    @staticmethod
+    def _discard(index: Dict[Any, Set[str]], key: Any, uid: str) -> None:
+        uids = index.get(key, None)
+        if uids is not None:
+            uids.discard(uid)
+            if not uids:
+                del index[key]
+
+    def _prefixed(self, prefix: Optional[str]) -> List[str]:
+        if not prefix:
+            return self._uids
+        first = bisect.bisect_left(self._uids, prefix)
+        # every uid with the prefix sorts before prefix + the last code point
+        last = bisect.bisect_left(self._uids, prefix + "\U0010ffff", first)
+        return self._uids[first:last]
+
+    def query(self, states: Optional[Iterable[str]] = None,
+              labels: Optional[Dict[str, str]] = None, prefix: Optional[str] = None,
+              failed: Optional[bool] = None) -> List[ProcessData]:
+        """
+        Returns the matching processes sorted by uid, see matches.
+        """
+        if states is not None:
+            states = set(states)
+        if failed:
+            states = {ProcessData.ENDED} if states is None else states & {ProcessData.ENDED}
+
+        candidates: List[Set[str]] = []
+        if states is not None:
+            candidates.append(set().union(*(self._by_state.get(state, ()) for state in states)))
+        for item in (labels or {}).items():
+            candidates.append(self._by_label.get(item, set()))
+
+        prefixed = self._prefixed(prefix)
+        if not candidates:
+            uids = prefixed
+        else:
+            # intersect starting with the smallest set
+            candidates.sort(key=len)
+            uids = set(candidates[0])
+            for other in candidates[1:]:
+                uids &= other
+            if len(prefixed) < len(uids):
+                uids = [uid for uid in prefixed if uid in uids]
+            else:
+                uids = sorted(uid for uid in uids if prefix is None or uid.startswith(prefix))
+
+        return [self._data[uid] for uid in uids
+                if matches(self._data[uid], states, labels, prefix, failed)]
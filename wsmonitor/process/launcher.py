@@ -0,0 +1,316 @@
+import asyncio
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+from typing import Dict, Optional, List, Any
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# requests are small, the command is the largest part
+MAX_MESSAGE_SIZE = 256 * 1024
+SHELL = "/bin/sh"
+
+
+def _exec_child(request: Dict[str, Any], stdout: int, stderr: int) -> None:
+    # runs in the forked child of the helper, never returns
+    try:
+        os.dup2(stdout, 1)
+        os.dup2(stderr, 2)
+        for fd in (stdout, stderr):
+            if fd > 2:
+                os.close(fd)
+        # the helper ignores these, the defaults of a Popen child
+        for signum in (signal.SIGINT, signal.SIGPIPE, signal.SIGXFSZ):
+            signal.signal(signum, signal.SIG_DFL)
+        if request.get("cgroup", None) is not None:
+            try:
+                with open(os.path.join(request["cgroup"], "cgroup.procs"), "w") as procs_file:
+                    procs_file.write("0")
+            except OSError as excpt:
+                # started without the cgroup, as by Process
+                os.write(2, f"[wsmonitor] running without cgroup: {excpt}\n".encode())
+        if request.get("group", False):
+            os.setsid()
+        os.execv(SHELL, [SHELL, "-c", request["command"]])
+    except BaseException as excpt:
+        try:
+            os.write(2, f"{excpt}\n".encode())
+        finally:
+            os._exit(127)
+
+
+def _spawn(request: Dict[str, Any], fds: List[int]) -> Dict[str, Any]:
+    reply: Dict[str, Any] = {"id": request["id"]}
+    try:
+        if len(fds) != 2:
+            reply["error"] = f"Expected the stdout and stderr pipes, got {len(fds)} fds"
+            return reply
+        try:
+            pid = os.fork()
+        except OSError as excpt:
+            reply["error"] = f"fork failed: {excpt}"
+            return reply
+        if pid == 0:
+            _exec_child(request, *fds)
+        reply["pid"] = pid
+        return reply
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def _reap(sock: socket.socket) -> None:
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+        sock.send(json.dumps({"pid": pid, "exit_code": os.waitstatus_to_exitcode(status)}).encode())
+
+
+def serve(sock: socket.socket) -> None:
+    """
+    The loop of the helper process: forks a child for every request and
+    reports the exit codes of its children, until the server closes the
+    socket.
+    """
+    # the server handles the signals of the terminal and closes the socket
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    while True:
+        readable, _, _ = select.select([sock, wakeup_read], [], [])
+        if wakeup_read in readable:
+            os.read(wakeup_read, 4096)
+            _reap(sock)
+        if sock in readable:
+            message, fds, _, _ = socket.recv_fds(sock, MAX_MESSAGE_SIZE, 2)
+            if not message:
+                return
+            sock.send(json.dumps(_spawn(json.loads(message), fds)).encode())
+
+
+class LaunchedProcess:
+    """
+    Stands in for asyncio.subprocess.Process for a child of the launcher,
+    the helper reports its exit code.
+    """
+
+    def __init__(self, pid: int, stdout: asyncio.StreamReader,
+                 stderr: asyncio.StreamReader, exited: asyncio.Future):
+        self.pid = pid
+        self.stdout = stdout
+        self.stderr = stderr
+        self._exited = exited
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self._exited.result() if self._exited.done() else None
+
+    async def wait(self) -> int:
+        return await asyncio.shield(self._exited)
+
+    def kill(self) -> None:
+        if self._exited.done():
+            return
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+class Launcher:
+    """
+    Starts the processes from a small helper process instead of forking the
+    server, whose large address space makes fork() slow. The helper is
+    started once and receives the commands and the output pipes over a unix
+    socket. If it is gone the processes are started directly again.
+    """
+
+    def __init__(self):
+        self._socket: Optional[socket.socket] = None
+        self._helper: Optional[subprocess.Popen] = None
+        self._next_id = 0
+        self._spawns: Dict[int, asyncio.Future] = {}
+        # exit codes by pid, -1 if the helper is gone before the exit
+        self._exits: Dict[int, asyncio.Future] = {}
+        self._writable: Optional[asyncio.Future] = None
+
+    def start(self) -> bool:
+        server_socket, helper_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            self._helper = subprocess.Popen(
+                [sys.executable, "-I", os.path.abspath(__file__), str(helper_socket.fileno())],
+                pass_fds=(helper_socket.fileno(),))
+        except OSError as excpt:
+            logger.warning("Failed to start the launcher, processes are started directly: %s", excpt)
+            server_socket.close()
+            return False
+        finally:
+            helper_socket.close()
+
+        server_socket.setblocking(False)
+        self._socket = server_socket
+        asyncio.get_event_loop().add_reader(server_socket.fileno(), self._on_readable)
+        logger.info("Processes are started by the launcher (pid %d)", self._helper.pid)
+        return True
+
+    def is_running(self) -> bool:
+        return self._socket is not None
+
+    async def spawn(self, command: str, as_process_group: bool = False,
+                    cgroup: Optional[str] = None) -> LaunchedProcess:
+        """
+        Runs the command with /bin/sh in a child of the helper, raises an
+        OSError if the helper cannot start it.
+        """
+        if self._socket is None:
+            raise ConnectionError("The launcher is not running")
+
+        loop = asyncio.get_event_loop()
+        stdout_read, stdout_write = os.pipe()
+        stderr_read, stderr_write = os.pipe()
+        self._next_id += 1
+        request_id = self._next_id
+        future = loop.create_future()
+        self._spawns[request_id] = future
+        try:
+            try:
+                await self._send(json.dumps({"id": request_id, "command": command,
+                                             "group": as_process_group, "cgroup": cgroup}).encode(),
+                                 [stdout_write, stderr_write])
+            finally:
+                # the helper received its own copies
+                os.close(stdout_write)
+                os.close(stderr_write)
+            reply = await future
+            if "error" in reply:
+                raise OSError(reply["error"])
+            stdout = await self._connect(stdout_read)
+            stdout_read = None
+            stderr = await self._connect(stderr_read)
+            stderr_read = None
+        except BaseException:
+            for fd in (stdout_read, stderr_read):
+                if fd is not None:
+                    os.close(fd)
+            raise
+        finally:
+            self._spawns.pop(request_id, None)
+
+        return LaunchedProcess(reply["pid"], stdout, stderr, reply["exited"])
+
+    async def _send(self, message: bytes, fds: List[int]) -> None:
+        while True:
+            if self._socket is None:
+                raise ConnectionError("The launcher is gone")
+            try:
+                socket.send_fds(self._socket, [message], fds)
+                return
+            except BlockingIOError:
+                pass
+            # many concurrent starts, wait until the helper caught up
+            if self._writable is None:
+                loop = asyncio.get_event_loop()
+                self._writable = loop.create_future()
+                loop.add_writer(self._socket.fileno(), self._on_writable)
+            await asyncio.shield(self._writable)
+
+    def _on_writable(self) -> None:
+        asyncio.get_event_loop().remove_writer(self._socket.fileno())
+        writable, self._writable = self._writable, None
+        if writable is not None and not writable.done():
+            writable.set_result(None)
+
+    @staticmethod
+    async def _connect(fd: int) -> asyncio.StreamReader:
+        # the same as the pipes of asyncio.subprocess
+        loop = asyncio.get_event_loop()
+        reader = asyncio.StreamReader(limit=2 ** 16)
+        # the transport owns and closes the file
+        pipe = os.fdopen(fd, "rb", 0)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+        return reader
+
+    def _on_readable(self) -> None:
+        while self._socket is not None:
+            try:
+                message = self._socket.recv(MAX_MESSAGE_SIZE)
+            except BlockingIOError:
+                return
+            except OSError as excpt:
+                logger.warning("Lost the connection to the launcher: %s", excpt)
+                message = b""
+            if not message:
+                self._on_lost()
+                return
+
+            reply = json.loads(message)
+            if "id" in reply:
+                if "pid" in reply:
+                    # registered before the exit can be reported
+                    reply["exited"] = self._exits[reply["pid"]] = asyncio.get_event_loop().create_future()
+                future = self._spawns.get(reply["id"], None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+            else:
+                exited = self._exits.pop(reply["pid"], None)
+                if exited is not None and not exited.done():
+                    exited.set_result(reply["exit_code"])
+
+    def _on_lost(self) -> None:
+        if self._socket is None:
+            return
+        logger.warning("The launcher exited, processes are started directly")
+        self._close_socket()
+        for future in self._spawns.values():
+            if not future.done():
+                future.set_exception(ConnectionError("The launcher is gone"))
+        for exited in self._exits.values():
+            if not exited.done():
+                exited.set_result(-1)
+        self._exits.clear()
+        if self._helper is not None:
+            self._helper.poll()
+
+    def _close_socket(self) -> None:
+        loop = asyncio.get_event_loop()
+        loop.remove_reader(self._socket.fileno())
+        if self._writable is not None:
+            loop.remove_writer(self._socket.fileno())
+            # the waiting senders find the socket closed
+            self._writable.set_result(None)
+            self._writable = None
+        self._socket.close()
+        self._socket = None
+
+    async def close(self, timeout: float = 2.) -> None:
+        # the helper exits once its socket is closed
+        if self._socket is not None:
+            self._close_socket()
+        if self._helper is None:
+            return
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, self._helper.wait, timeout)
+        except subprocess.TimeoutExpired:
+            logger.warning("The launcher did not exit, killing it")
+            self._helper.kill()
+            self._helper.wait()
+
+
+if __name__ == "__main__":
+    # started as a script, nothing of the server is imported
+    os.set_inheritable(int(sys.argv[1]), False)
+    serve(socket.socket(fileno=int(sys.argv[1])))
@@ -0,0 +1,258 @@
+import re
+from collections import deque
+from typing import Optional, Dict, Any, List, Tuple, Deque
+
+from wsmonitor.process.data import OutputEvent
+
+_LINE = re.compile(rb"[^\n]*\n|[^\n]+\Z")
+
+
+def _human(value: float, units: Tuple[str, ...], base: int = 1000) -> str:
+    for unit in units[:-1]:
+        if value < base:
+            return f"{value:.0f}{unit}" if unit == units[0] else f"{value:.1f}{unit}"
+        value /= base
+    return f"{value:.1f}{units[-1]}"
+
+
+def suppressed_marker(lines: int, size: int) -> bytes:
+    return (f"[wsmonitor] suppressed {_human(lines, ('', 'K', 'M', 'G'))} lines "
+            f"({_human(size, (' B', ' KB', ' MB', ' GB'), 1024)})\n").encode()
+
+
+def _count_lines(output: bytes) -> int:
+    # a trailing partial line counts as well
+    return output.count(b"\n") + (1 if output and not output.endswith(b"\n") else 0)
+
+
+def _line_end(output: bytes, lines: int) -> int:
+    # the end of the first lines of output
+    position = 0
+    for _ in range(lines):
+        end = output.find(b"\n", position)
+        if end < 0:
+            return len(output)
+        position = end + 1
+    return position
+
+
+def _last_lines(output: bytes, lines: int) -> List[bytes]:
+    result = []
+    end = len(output)
+    while end > 0 and len(result) < lines:
+        start = output.rfind(b"\n", 0, end - 1) + 1
+        result.append(output[start:end])
+        end = start
+    result.reverse()
+    return result
+
+
+class OutputLimit:
+    """
+    The output limits of a process: rates in lines and bytes per second
+    with a burst of that many seconds, keeping only every sample-th line and
+    only the first head and last tail lines of a run. Suppressed lines are
+    summarized by markers at most every marker_interval seconds.
+    """
+
+    def __init__(self, lines_per_second: Optional[float] = None,
+                 bytes_per_second: Optional[float] = None, burst: float = 1.,
+                 sample: int = 1, head: Optional[int] = None,
+                 tail: Optional[int] = None, marker_interval: float = 1.):
+        for name, value in (("lines_per_second", lines_per_second), ("bytes_per_second", bytes_per_second),
+                            ("head", head), ("tail", tail)):
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0):
+                raise ValueError(f"Invalid output limit {name}: {value!r}")
+        if not isinstance(sample, int) or isinstance(sample, bool) or sample < 1:
+            raise ValueError(f"Invalid output limit sample: {sample!r}, expected a positive integer")
+        if not isinstance(burst, (int, float)) or burst <= 0:
+            raise ValueError(f"Invalid output limit burst: {burst!r}")
+        if lines_per_second is not None and lines_per_second * burst < 1:
+            raise ValueError("The output limit must allow at least one line per burst")
+
+        self.lines_per_second = lines_per_second
+        self.bytes_per_second = bytes_per_second
+        self.burst = burst
+        self.sample = sample
+        self.head = None if head is None else int(head)
+        self.tail = None if tail is None else int(tail)
+        self.marker_interval = marker_interval
+
+    def is_active(self) -> bool:
+        return self.lines_per_second is not None or self.bytes_per_second is not None or \
+            self.sample > 1 or self.head is not None or self.tail is not None
+
+    def to_config(self) -> Dict[str, Any]:
+        # the "output_limit" entry of a process config
+        config = {"lines_per_second": self.lines_per_second, "bytes_per_second": self.bytes_per_second,
+                  "head": self.head, "tail": self.tail}
+        config = {key: value for key, value in config.items() if value is not None}
+        return dict(config, burst=self.burst, sample=self.sample, marker_interval=self.marker_interval)
+
+    def __str__(self):
+        return f"{self.__class__.__name__}({self.lines_per_second} lines/s, {self.bytes_per_second} B/s, " \
+               f"sample={self.sample}, head={self.head}, tail={self.tail})"
+
+
+def output_limit_from_config(config: Optional[Dict[str, Any]]) -> OutputLimit:
+    """
+    Creates the limit from the "output_limit" entry of a process config, e.g.
+    {"lines_per_second": 100, "bytes_per_second": 65536, "sample": 10}.
+    A missing entry limits nothing.
+    """
+    if not config:
+        return OutputLimit()
+    if not isinstance(config, dict):
+        raise ValueError(f"Invalid output limit {config}, expected an object")
+
+    try:
+        return OutputLimit(**config)
+    except TypeError as excpt:
+        raise ValueError(f"Invalid output limit {config}: {excpt}") from excpt
+
+
+class OutputLimiter:
+    """
+    Applies the OutputLimit to the output of a process as it is read, the
+    pipes are drained in any case. Lines are sampled first, then the head and
+    tail are kept and the remaining lines are rate limited with token
+    buckets. The tail is passed on when the process ended.
+    """
+
+    def __init__(self, limit: OutputLimit):
+        self.limit = limit
+        # totals across runs
+        self.suppressed_lines = 0
+        self.suppressed_bytes = 0
+        self.reset()
+
+    def reset(self) -> None:
+        # at the start of a run
+        limit = self.limit
+        self._line_tokens = None if limit.lines_per_second is None else limit.lines_per_second * limit.burst
+        self._byte_tokens = None if limit.bytes_per_second is None else limit.bytes_per_second * limit.burst
+        self._refilled: Optional[float] = None
+        self._sampled = 0
+        self._head_left = limit.head if limit.head is not None else (0 if limit.tail is not None else None)
+        self._tail: Optional[Deque[Tuple[int, bytes]]] = None if limit.tail is None else deque()
+        # suppressed since the last marker
+        self._pending_lines = 0
+        self._pending_bytes = 0
+        self._pending_stream = OutputEvent.STDOUT
+        self._last_marker: Optional[float] = None
+
+    def filter(self, output: bytes, stream: int, mono: float) -> List[Tuple[int, bytes]]:
+        """
+        Returns the output to pass on by stream, including the markers.
+        """
+        if self.limit.sample > 1:
+            output = self._sample(output, stream)
+        if self._head_left is not None and output:
+            output = self._head_tail(output, stream)
+        if (self._line_tokens is not None or self._byte_tokens is not None) and output:
+            output = self._rate(output, stream, mono)
+
+        result = [(stream, output)] if output else []
+        return result + self.flush(mono)
+
+    def flush(self, mono: float) -> List[Tuple[int, bytes]]:
+        # the marker of the suppressed lines if one is due
+        if not self._pending_lines or (self._last_marker is not None and
+                                       mono - self._last_marker < self.limit.marker_interval):
+            return []
+        return self._marker(mono)
+
+    def finish(self, mono: float) -> List[Tuple[int, bytes]]:
+        """
+        Returns the marker and the tail once the process ended.
+        """
+        result = self._marker(mono) if self._pending_lines else []
+        for stream, line in self._tail or ():
+            if result and result[-1][0] == stream:
+                result[-1] = (stream, result[-1][1] + line)
+            else:
+                result.append((stream, line))
+        if self._tail is not None:
+            self._tail.clear()
+        return result
+
+    def _marker(self, mono: float) -> List[Tuple[int, bytes]]:
+        marker = suppressed_marker(self._pending_lines, self._pending_bytes)
+        self._pending_lines = self._pending_bytes = 0
+        self._last_marker = mono
+        return [(self._pending_stream, marker)]
+
+    def _suppress(self, lines: int, size: int, stream: int) -> None:
+        if not lines:
+            return
+        self.suppressed_lines += lines
+        self.suppressed_bytes += size
+        self._pending_lines += lines
+        self._pending_bytes += size
+        self._pending_stream = stream
+
+    def _sample(self, output: bytes, stream: int) -> bytes:
+        # keeps the lines whose number in the run is a multiple of sample
+        lines = _LINE.findall(output)
+        sample = self.limit.sample
+        kept = lines[(-self._sampled) % sample::sample]
+        self._sampled = (self._sampled + len(lines)) % sample
+        if len(kept) == len(lines):
+            return output
+        result = b"".join(kept)
+        self._suppress(len(lines) - len(kept), len(output) - len(result), stream)
+        return result
+
+    def _head_tail(self, output: bytes, stream: int) -> bytes:
+        passed = b""
+        if self._head_left:
+            end = _line_end(output, self._head_left)
+            passed, output = output[:end], output[end:]
+            self._head_left -= _count_lines(passed)
+            if not output:
+                return passed
+
+        if self._tail is None:
+            self._suppress(_count_lines(output), len(output), stream)
+            return passed
+
+        # only the last lines of the chunk can end up in the tail
+        last = _last_lines(output, self.limit.tail)
+        self._suppress(_count_lines(output) - len(last), len(output) - sum(map(len, last)), stream)
+        for line in last:
+            if len(self._tail) == self.limit.tail:
+                _, evicted = self._tail.popleft()
+                self._suppress(1, len(evicted), stream)
+            self._tail.append((stream, line))
+        return passed
+
+    def _rate(self, output: bytes, stream: int, mono: float) -> bytes:
+        limit = self.limit
+        if self._refilled is not None:
+            elapsed = mono - self._refilled
+            if self._line_tokens is not None:
+                self._line_tokens = min(self._line_tokens + elapsed * limit.lines_per_second,
+                                        limit.lines_per_second * limit.burst)
+            if self._byte_tokens is not None:
+                self._byte_tokens = min(self._byte_tokens + elapsed * limit.bytes_per_second,
+                                        limit.bytes_per_second * limit.burst)
+        self._refilled = mono
+
+        lines = _count_lines(output)
+        if (self._line_tokens is None or lines <= self._line_tokens) and \
+                (self._byte_tokens is None or len(output) <= self._byte_tokens):
+            end = len(output)
+        else:
+            # the whole lines within both budgets
+            end = len(output) if self._line_tokens is None else _line_end(output, int(self._line_tokens))
+            if self._byte_tokens is not None and end > self._byte_tokens:
+                end = output.rfind(b"\n", 0, int(self._byte_tokens)) + 1
+            passed_lines = _count_lines(output[:end])
+            self._suppress(lines - passed_lines, len(output) - end, stream)
+            lines = passed_lines
+
+        if self._line_tokens is not None:
+            self._line_tokens -= lines
+        if self._byte_tokens is not None:
+            self._byte_tokens -= end
+        return output[:end]
@@ -0,0 +1,314 @@
+import bisect
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# line number, wall clock timestamp and byte offset of an indexed position
+INDEX_ENTRY = struct.Struct("<QdQ")
+
+
+class LogSegment:
+
+    def __init__(self, log_path: str, first_line: int, created: float):
+        self.log_path = log_path
+        self.index_path = log_path[:-len(".log")] + ".idx"
+        self.first_line = first_line
+        self.created = created
+        self.size = 0
+        self.lines = 0
+        self.index: List[Tuple[int, float, int]] = []
+        self._index_lines: List[int] = []
+        self._index_times: List[float] = []
+
+    def add_index_entries(self, entries: List[Tuple[int, float, int]]) -> None:
+        self.index.extend(entries)
+        self._index_lines.extend(entry[0] for entry in entries)
+        self._index_times.extend(entry[1] for entry in entries)
+
+    def offset_of_line(self, line: int) -> Tuple[int, int]:
+        # returns the closest indexed (line, offset) before the given line
+        pos = max(bisect.bisect_right(self._index_lines, line) - 1, 0)
+        return self.index[pos][0], self.index[pos][2]
+
+    def line_at_time(self, timestamp: float) -> int:
+        pos = max(bisect.bisect_right(self._index_times, timestamp) - 1, 0)
+        return self.index[pos][0]
+
+    def end_line(self) -> int:
+        return self.first_line + self.lines
+
+    @staticmethod
+    def load(log_path: str) -> Optional['LogSegment']:
+        index_path = log_path[:-len(".log")] + ".idx"
+        try:
+            with open(index_path, "rb") as index_file:
+                data = index_file.read()
+        except OSError:
+            return None
+
+        entries = [INDEX_ENTRY.unpack_from(data, offset) for offset in
+                   range(0, len(data) - len(data) % INDEX_ENTRY.size, INDEX_ENTRY.size)]
+        if not entries:
+            return None
+
+        segment = LogSegment(log_path, entries[0][0], entries[0][1])
+        segment.add_index_entries(entries)
+        segment.size = os.path.getsize(log_path)
+
+        # count the lines after the last indexed position
+        last_line, _, last_offset = entries[-1]
+        segment.lines = last_line - segment.first_line
+        if segment.size > last_offset:
+            with open(log_path, "rb") as log_file:
+                with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    segment.lines += count_lines(mapped, last_offset, segment.size)
+        return segment
+
+
+def count_lines(mapped: mmap.mmap, start: int, end: int) -> int:
+    lines = 0
+    position = mapped.find(b"\n", start, end)
+    while position >= 0:
+        lines += 1
+        position = mapped.find(b"\n", position + 1, end)
+    return lines
+
+
+class OutputLog:
+    """
+    Append-only on-disk output of a single process, split into segment files
+    which are rotated by size and age. Each segment has a sparse index mapping
+    line numbers and timestamps to byte offsets, so arbitrary ranges can be
+    read via mmap without loading whole files.
+
+    append() only buffers and is meant to be called from the event loop,
+    flush() and the read methods do the file I/O and should run in an executor.
+    """
+
+    def __init__(self, directory: str, uid: str,
+                 max_segment_size: int = 16 * 1024 * 1024,
+                 max_segment_age: float = 3600, max_segments: int = 8,
+                 index_interval: int = 64 * 1024):
+        # percent encode the uid, leading dots must not create '..' paths
+        name = quote(uid, safe="")
+        if name.startswith("."):
+            name = "%2E" + name[1:]
+
+        self.directory = os.path.join(directory, name)
+        self.uid = uid
+        self.max_segment_size = max_segment_size
+        self.max_segment_age = max_segment_age
+        self.max_segments = max_segments
+        self.index_interval = index_interval
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: List[Tuple[float, bytes]] = []
+        self._segments: List[LogSegment] = []
+        self._log_file = None
+        self._index_file = None
+        self._last_indexed = 0
+        # the existing segments are loaded by the first flush, which runs
+        # off the event loop
+        self._loaded = False
+
+    def _load_segments(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        names = sorted(name for name in os.listdir(self.directory) if name.endswith(".log"))
+        segments = []
+        for name in names:
+            segment = LogSegment.load(os.path.join(self.directory, name))
+            if segment is not None:
+                segments.append(segment)
+
+        with self._lock:
+            self._segments = segments
+        self._loaded = True
+        if segments:
+            logger.info("Output log[%s]: found %d segments with %d lines", self.uid,
+                        len(segments), segments[-1].end_line())
+
+    def append(self, data: bytes, timestamp: Optional[float] = None) -> None:
+        with self._lock:
+            self._pending.append((time.time() if timestamp is None else timestamp, data))
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            if not self._loaded:
+                self._load_segments()
+            with self._lock:
+                batch, self._pending = self._pending, []
+
+            if batch:
+                self._write_batch(batch)
+
+    def _write_batch(self, batch: List[Tuple[float, bytes]]) -> None:
+        segment = self._current_segment(batch[0][0])
+        buffers: List[bytes] = []
+        entries = []
+        size, lines = segment.size, segment.lines
+
+        for timestamp, data in batch:
+            # segments are named after their first line, one without a
+            # complete line is continued
+            if lines > 0 and (size >= self.max_segment_size or
+                              timestamp - segment.created >= self.max_segment_age):
+                self._commit(segment, buffers, entries, size, lines)
+                segment = self._rotate(segment.end_line(), timestamp)
+                buffers, entries = [], []
+                size, lines = segment.size, segment.lines
+
+            if size - self._last_indexed >= self.index_interval:
+                entries.append((segment.first_line + lines, timestamp, size))
+                self._last_indexed = size
+
+            buffers.append(data)
+            size += len(data)
+            lines += data.count(b"\n")
+
+        self._commit(segment, buffers, entries, size, lines)
+
+    def _commit(self, segment: LogSegment, buffers: List[bytes],
+                entries: List[Tuple[int, float, int]], size: int, lines: int) -> None:
+        if buffers:
+            # one write per batch and segment
+            self._log_file.write(b"".join(buffers))
+            self._log_file.flush()
+        if entries:
+            self._index_file.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in entries))
+            self._index_file.flush()
+
+        with self._lock:
+            segment.add_index_entries(entries)
+            segment.size = size
+            segment.lines = lines
+
+    def _current_segment(self, timestamp: float) -> LogSegment:
+        if self._log_file is not None:
+            return self._segments[-1]
+
+        if self._segments:
+            # continue the last segment of a previous run
+            segment = self._segments[-1]
+            self._log_file = open(segment.log_path, "ab")
+            self._index_file = open(segment.index_path, "ab")
+            self._last_indexed = segment.index[-1][2]
+            return segment
+
+        return self._rotate(0, timestamp)
+
+    def _rotate(self, first_line: int, timestamp: float) -> LogSegment:
+        self._close_files()
+
+        log_path = os.path.join(self.directory, f"{first_line:016d}.log")
+        segment = LogSegment(log_path, first_line, timestamp)
+        self._log_file = open(segment.log_path, "ab")
+        self._index_file = open(segment.index_path, "ab")
+
+        # every segment starts with an index entry at offset 0
+        entry = (first_line, timestamp, 0)
+        self._index_file.write(INDEX_ENTRY.pack(*entry))
+        segment.add_index_entries([entry])
+        self._last_indexed = 0
+
+        with self._lock:
+            self._segments.append(segment)
+            removed = self._segments[:-self.max_segments] if self.max_segments > 0 else []
+            self._segments = self._segments[len(removed):]
+
+        for old_segment in removed:
+            logger.debug("Output log[%s]: removing segment %s", self.uid, old_segment.log_path)
+            for path in (old_segment.log_path, old_segment.index_path):
+                try:
+                    os.remove(path)
+                except OSError as excpt:
+                    logger.warning("Failed to remove log segment: %s", excpt)
+
+        return segment
+
+    def _close_files(self) -> None:
+        for log_file in (self._log_file, self._index_file):
+            if log_file is not None:
+                log_file.close()
+        self._log_file = None
+        self._index_file = None
+
+    def close(self) -> None:
+        self.flush()
+        with self._flush_lock:
+            self._close_files()
+
+    def line_count(self) -> int:
+        with self._lock:
+            return self._segments[-1].end_line() if self._segments else 0
+
+    def line_at_time(self, timestamp: float) -> int:
+        """
+        Returns the first line of the indexed position closest before the
+        timestamp, the precision depends on the index interval.
+        """
+        with self._lock:
+            segments = list(self._segments)
+
+        times = [segment.created for segment in segments]
+        pos = bisect.bisect_right(times, timestamp) - 1
+        if pos < 0:
+            return segments[0].first_line if segments else 0
+        return segments[pos].line_at_time(timestamp)
+
+    def read_lines(self, start: int, count: int, max_bytes: int = 1024 * 1024) -> Tuple[int, bytes]:
+        """
+        Returns the number of the first returned line and up to count lines.
+        Lines which have already been removed by the retention are skipped.
+        """
+        with self._lock:
+            segments = [(segment, segment.size, segment.end_line()) for segment in self._segments]
+
+        if not segments:
+            return 0, b""
+
+        start = max(start, segments[0][0].first_line)
+        first_line = start
+        output: List[bytes] = []
+        output_size = 0
+
+        for segment, size, end_line in segments:
+            if end_line <= start or size == 0:
+                continue
+            if count <= 0 or output_size >= max_bytes:
+                break
+
+            data = self._read_segment(segment, size, start, count, max_bytes - output_size)
+            start = end_line
+            count -= data.count(b"\n")
+            output_size += len(data)
+            output.append(data)
+
+        return first_line, b"".join(output)
+
+    @staticmethod
+    def _read_segment(segment: LogSegment, size: int, start: int, count: int, max_bytes: int) -> bytes:
+        line, position = segment.offset_of_line(start)
+        with open(segment.log_path, "rb") as log_file:
+            with mmap.mmap(log_file.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+                # skip the lines between the indexed position and the start
+                while line < start and position < size:
+                    position = mapped.find(b"\n", position, size)
+                    position = size if position < 0 else position + 1
+                    line += 1
+
+                end = position
+                while count > 0 and end < size and end - position < max_bytes:
+                    end = mapped.find(b"\n", end, size)
+                    end = size if end < 0 else end + 1
+                    count -= 1
+
+                return mapped[position:end]
@@ -2,11 +2,15 @@ import asyncio
 import logging
 import os
 import signal
+import time
 from asyncio import CancelledError
 from asyncio.subprocess import PIPE
-from typing import Union, Callable, Optional
+from subprocess import SubprocessError
+from typing import Union, Callable, Optional, List, Tuple, Dict, Any
 
-from wsmonitor.process.data import ProcessData
+from wsmonitor.process.cgroup import Cgroup
+from wsmonitor.process.data import ProcessData, OutputEvent
+from wsmonitor.process.launcher import Launcher, LaunchedProcess
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -25,43 +29,120 @@ class ProcessOutput:
         self.exit_code = None
 
 
+async def wait_for_pid_exit(pid: int, interval: float = 1.) -> None:
+    # We cannot wait() for processes which are not our children, use a pidfd
+    # where available and poll otherwise
+    loop = asyncio.get_event_loop()
+    pidfd = None
+    if hasattr(os, "pidfd_open"):
+        try:
+            pidfd = os.pidfd_open(pid)
+        except OSError:
+            pidfd = None
+
+    if pidfd is not None:
+        exited = loop.create_future()
+        loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+        try:
+            await exited
+        finally:
+            loop.remove_reader(pidfd)
+            os.close(pidfd)
+        return
+
+    while True:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return
+        await asyncio.sleep(interval)
+
+
 StateChangeCallback = Callable[['Process'], None]
-OutputCallback = Callable[['Process', bytes], None]
+# process, output, stream id, wall clock and monotonic time of the read
+OutputCallback = Callable[['Process', bytes, int, float, float], None]
 
 
 class Process:
+    read_chunk_size = 64 * 1024
+
     def __init__(self, process_data: ProcessData) -> None:
         self._data = process_data
-        self._asyncio_process: Optional[
-            asyncio.subprocess.Process] = None  # pylint: disable=no-member
+        self._asyncio_process: Optional[Union[
+            asyncio.subprocess.Process, LaunchedProcess]] = None  # pylint: disable=no-member
         self._process_task: Optional[asyncio.Task] = None
+        self._stream_future: Optional[asyncio.Future] = None
+        self._adopted_pid: Optional[int] = None
         self._state_change_listener: Optional[StateChangeCallback] = None
         self._output_listener: Optional[OutputCallback] = None
+        self._output_observers: List[OutputCallback] = []
+        self._state_waiters: List[Tuple[Tuple[str, ...], asyncio.Future]] = []
+        self._cgroup: Optional[Cgroup] = None
+        self._launcher: Optional[Launcher] = None
 
     def set_state_listener(self, listener: StateChangeCallback) -> None:
         self._state_change_listener = listener
 
+    def set_cgroup(self, cgroup: Optional[Cgroup]) -> None:
+        # the cgroup the process is placed in by the next start
+        self._cgroup = cgroup
+
+    def get_cgroup(self) -> Optional[Cgroup]:
+        return self._cgroup
+
+    def set_launcher(self, launcher: Optional[Launcher]) -> None:
+        # starts the process instead of forking the server
+        self._launcher = launcher
+
     def set_output_listener(self, listener: OutputCallback) -> None:
         self._output_listener = listener
 
+    def add_output_observer(self, observer: OutputCallback) -> None:
+        # Observers see the output in addition to the output listener,
+        # e.g. to wait for a process to become ready
+        self._output_observers.append(observer)
+
+    def remove_output_observer(self, observer: OutputCallback) -> None:
+        if observer in self._output_observers:
+            self._output_observers.remove(observer)
+
+    def wait_for_state(self, *states: str) -> asyncio.Future:
+        future = asyncio.get_event_loop().create_future()
+        if self._data.is_in_state(*states):
+            future.set_result(self._data.state)
+        else:
+            self._state_waiters.append((states, future))
+        return future
+
     async def _run_process(self, **kwargs) -> int:
-        preexec_fn = None
-        if self._data.as_process_group:
-            # Run process in a new process group
-            # https://stackoverflow.com/questions/4789837/how-to-terminate-a-python-subprocess-launched-with-shell-true
-            preexec_fn = os.setsid
+        as_process_group = self._data.as_process_group
+        cgroup = self._cgroup
 
         command = self._data.get_command(**kwargs)
         logger.debug("Process[%s]: starting command: %s", self._data.uid, command)
+        self._asyncio_process = None
+        if self._launcher is not None and self._launcher.is_running():
+            try:
+                self._asyncio_process = await self._launcher.spawn(
+                    command, as_process_group, None if cgroup is None else cgroup.path)
+            except OSError as excpt:
+                logger.warning("Process[%s]: the launcher failed, starting directly: %s",
+                               self.uid(), excpt)
         try:
-
-            self._asyncio_process = await asyncio.create_subprocess_shell(
-                command, stdout=PIPE, stderr=PIPE,
-                preexec_fn=preexec_fn, bufsize=0)
+            if self._asyncio_process is None:
+                try:
+                    self._asyncio_process = await self._create_subprocess(command, as_process_group, cgroup)
+                except SubprocessError as excpt:
+                    if cgroup is None:
+                        raise
+                    # e.g. the cgroup was removed or the delegation revoked
+                    logger.warning("Process[%s]: cannot be placed in %s, starting it without cgroup: %s",
+                                   self.uid(), cgroup.path, excpt)
+                    self._asyncio_process = await self._create_subprocess(command, as_process_group, None)
         except Exception as excpt:
             logger.warning(f"Failed to start process[{self.uid()}: {excpt}")
-            if self._output_listener is not None:
-                self._output_listener(self, f"{excpt}\n".encode('ascii'))
+            self._on_output(self._output_listener, f"{excpt}\n".encode(),
+                            OutputEvent.STDERR)
 
             self._state_changed(ProcessData.ENDED)
             return -1
@@ -72,9 +153,9 @@ class Process:
         # Schedule the read tasks and after that signal the state change
         self._stream_future = asyncio.gather(
             self._read_stream(self._asyncio_process.stdout,
-                              self._output_listener),
+                              self._output_listener, OutputEvent.STDOUT),
             self._read_stream(self._asyncio_process.stderr,
-                              self._output_listener)
+                              self._output_listener, OutputEvent.STDERR)
         )
         self._state_changed(ProcessData.STARTED)
 
@@ -94,20 +175,37 @@ class Process:
 
         return self._data.exit_code
 
+    @staticmethod
+    async def _create_subprocess(command: str, as_process_group: bool,
+                                 cgroup: Optional[Cgroup]) -> asyncio.subprocess.Process:
+        def prepare_child():
+            if cgroup is not None:
+                # before exec, all of its children are in the cgroup
+                cgroup.place_self()
+            if as_process_group:
+                # Run process in a new process group
+                # https://stackoverflow.com/questions/4789837/how-to-terminate-a-python-subprocess-launched-with-shell-true
+                os.setsid()
+
+        # a failing preexec_fn raises a SubprocessError
+        preexec_fn = prepare_child if as_process_group or cgroup is not None else None
+        return await asyncio.create_subprocess_shell(
+            command, stdout=PIPE, stderr=PIPE,
+            preexec_fn=preexec_fn, bufsize=0)
+
     async def stop(self, int_timeout: float = 2, term_timeout: float = 2) -> \
             Union[int, str]:
 
         if not self.is_running():
             return f"'{self.uid()}' is not running, cannot stop it"
 
-        logger.debug("Process[%s](%d): stopping...", self.uid(),
-                     self._asyncio_process.pid)
+        logger.debug("Process[%s](%d): stopping...", self.uid(), self.pid())
         self._state_changed(ProcessData.STOPPING)
 
         try:
             # deal with process or process group
             kill_fn = os.kill
-            pid = self._asyncio_process.pid
+            pid = self.pid()
 
             if self._data.as_process_group:
                 pid = os.getpgid(pid)
@@ -134,19 +232,48 @@ class Process:
         # reset process state
         self._data.reset()
         self._asyncio_process = None
+        self._adopted_pid = None
         self._process_task = None
 
         return self.start_as_task(**kwargs)
 
     async def _read_stream(self, stream: asyncio.StreamReader,
-                           handler: Callable) -> None:
+                           handler: Callable, stream_id: int) -> None:
+        # Read whatever is available instead of single lines, but only pass on
+        # complete lines unless a single line exceeds the chunk size
+        pending = b""
         while True:
-            line = await stream.readline()
-            if not line:
+            chunk = await stream.read(self.read_chunk_size)
+            if not chunk:
+                if pending:
+                    self._on_output(handler, pending, stream_id)
                 break
 
-            if handler is not None:
-                handler(self, line)
+            if pending:
+                chunk = pending + chunk
+                pending = b""
+
+            end = chunk.rfind(b"\n") + 1
+            if end == 0 and len(chunk) < self.read_chunk_size:
+                pending = chunk
+                continue
+
+            if 0 < end < len(chunk):
+                pending = chunk[end:]
+                chunk = chunk[:end]
+
+            self._on_output(handler, chunk, stream_id)
+
+    def _on_output(self, handler: Optional[Callable], output: bytes,
+                   stream_id: int) -> None:
+        # Both streams are read by the same loop, so taking the timestamps
+        # here keeps the order in which the output arrived
+        wall, mono = time.time(), time.monotonic()
+        if handler is not None:
+            handler(self, output, stream_id, wall, mono)
+
+        for observer in self._output_observers:
+            observer(self, output, stream_id, wall, mono)
 
     def start_as_task(self, **kwargs) -> Union[asyncio.Future, str]:
         if self._data.is_in_state(ProcessData.ENDED):
@@ -154,6 +281,7 @@ class Process:
             # reset process state
             self._data.reset()
             self._asyncio_process = None
+            self._adopted_pid = None
             self._process_task = None
 
         if not self._data.is_in_state(ProcessData.INITIALIZED):
@@ -169,6 +297,31 @@ class Process:
     def get_start_task(self) -> asyncio.Task:
         return self._process_task
 
+    def adopt(self, pid: int) -> asyncio.Future:
+        # Takes over a still running process started by a previous server run.
+        # Its output pipes are gone and its exit code cannot be retrieved.
+        self._data.reset()
+        self._data.state = ProcessData.STARTING
+        self._asyncio_process = None
+        self._adopted_pid = pid
+        self._process_task = asyncio.ensure_future(self._watch_adopted(pid))
+        return self._process_task
+
+    async def _watch_adopted(self, pid: int) -> int:
+        logger.info("Process[%s](%d): adopted", self.uid(), pid)
+        self._state_changed(ProcessData.STARTED)
+        await wait_for_pid_exit(pid)
+
+        self._data.ensure_exit_code(-1)
+        logger.debug("Process[%s]: adopted process has exited", self.uid())
+        self._state_changed(ProcessData.ENDED)
+        return self._data.exit_code
+
+    def pid(self) -> Optional[int]:
+        if self._asyncio_process is not None:
+            return self._asyncio_process.pid
+        return self._adopted_pid
+
     def has_exit_code(self) -> bool:
         return self._data.exit_code is not None
 
@@ -183,6 +336,17 @@ class Process:
         if self._state_change_listener is not None:
             self._state_change_listener(self)
 
+        if self._state_waiters:
+            waiting = []
+            for states, future in self._state_waiters:
+                if future.done():
+                    continue
+                if state in states:
+                    future.set_result(state)
+                else:
+                    waiting.append((states, future))
+            self._state_waiters = waiting
+
     def __hash__(self):
         return self._data.uid.__hash__()
 
@@ -241,7 +405,8 @@ class Process:
         except:
             pass
         finally:
-            self._asyncio_process.kill()
+            if self._asyncio_process is not None:
+                self._asyncio_process.kill()
 
         # Make sure we are no longer reading (maybe call this earlier?)
         if self._stream_future is not None:
@@ -253,7 +418,10 @@ class Process:
 
         return self.exit_code()
 
-    def update_data(self, command: str, as_process_group: bool) -> None:
+    def update_data(self, command: str, as_process_group: bool,
+                    labels: Optional[Dict[str, str]] = None,
+                    command_kwargs: Optional[Dict[str, str]] = None,
+                    limits: Optional[Dict[str, Any]] = None) -> None:
         if not self._data.is_in_state(ProcessData.INITIALIZED,
                                       ProcessData.ENDED):
             logger.warning("Cannot change process data while it is active")
@@ -261,3 +429,9 @@ class Process:
 
         self._data.command = command
         self._data.as_process_group = as_process_group
+        if labels is not None:
+            self._data.labels = labels
+        if command_kwargs is not None:
+            self._data.command_kwargs = command_kwargs
+        if limits is not None:
+            self._data.limits = limits
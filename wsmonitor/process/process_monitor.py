@@ -1,10 +1,21 @@
 import asyncio
 import logging
+import os
+import time
 from asyncio.tasks import Task
-from typing import Dict, Union, Optional, List
+from typing import Dict, Union, Optional, List, Any, Tuple
 
+from wsmonitor.metrics import Metrics, Counter, measure_loop_lag
 from wsmonitor.process.process import Process
-from wsmonitor.process.data import ProcessData, OutputEvent, StateChangedEvent
+from wsmonitor.process.cgroup import CgroupManager, check_limits
+from wsmonitor.process.data import ProcessData, OutputEvent, StateChangedEvent, MatchEvent
+from wsmonitor.process.index import ProcessIndex, check_labels
+from wsmonitor.process.launcher import Launcher
+from wsmonitor.process.output_limit import OutputLimit, OutputLimiter, output_limit_from_config
+from wsmonitor.process.output_log import OutputLog
+from wsmonitor.process.registry import ProcessRegistry, is_same_process_alive
+from wsmonitor.process.startup import StartupGraph, ReadyCondition, ready_condition_from_config
+from wsmonitor.process.watch import WatchRule, OutputWatcher, watch_rules_from_config
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -12,30 +23,104 @@ logger.setLevel(logging.INFO)
 
 class ProcessMonitor:
 
-    def __init__(self) -> None:
+    def __init__(self, metrics: Optional[Metrics] = None) -> None:
         self._is_monitor_running = False
         self._processes: Dict[str, Process] = {}
+        self._index = ProcessIndex()
+        # the entries of the process config by uid as they were last applied,
+        # see config.reload_processes
+        self.config_entries: Dict[str, Dict[str, Any]] = {}
         self._state_event_queue = asyncio.Queue()
         self._output_event_queue = asyncio.Queue()
         self._gather_monitoring_tasks_future: Optional[Task] = None
+        self._startup_graph = StartupGraph()
+        self._watchers: Dict[str, OutputWatcher] = {}
+        self._limiters: Dict[str, OutputLimiter] = {}
+        self.output_limit_marker_interval = 1.
+        self._output_logs: Dict[str, OutputLog] = {}
+        self._output_log_options: Optional[Dict[str, Any]] = None
+        self.output_log_flush_interval = .5
+        self._registry: Optional[ProcessRegistry] = None
+        self.registry_flush_interval = .5
+        self._cgroups: Optional[CgroupManager] = None
+        self._launcher: Optional[Launcher] = None
+
+        self.metrics = Metrics() if metrics is None else metrics
+        # bytes and lines read per process
+        self._output_counters: Dict[str, Tuple[Counter, Counter]] = {}
+        self.metrics.gauge("wsmonitor_queue_depth", lambda: {
+            (("queue", "state"),): self._state_event_queue.qsize(),
+            (("queue", "output"),): self._output_event_queue.qsize()}, "Events waiting to be handled")
+        self.metrics.gauge("wsmonitor_processes", lambda: len(self._processes), "Registered processes")
+        self.metrics.gauge("wsmonitor_processes_running", lambda: sum(
+            1 for process in self._processes.values() if process.is_running()), "Running processes")
+        self.metrics.gauge("wsmonitor_output_suppressed_lines_total", lambda: {
+            (("uid", uid),): limiter.suppressed_lines for uid, limiter in self._limiters.items()},
+            "Output lines suppressed by the output limit of the process")
+
+    def add_process(self, uid: str, command: str, as_process_group: bool = True, command_kwargs=None,
+                    depends_on: Optional[List[str]] = None,
+                    ready: Optional[ReadyCondition] = None,
+                    watch_rules: Optional[List[WatchRule]] = None,
+                    labels: Optional[Dict[str, str]] = None,
+                    limits: Optional[Dict[str, Any]] = None,
+                    output_limit: Optional[OutputLimit] = None) -> Union[str, Process]:
+        if uid in self._processes and self._processes[uid].is_running():
+            msg = f"Process with name '{uid}' already known and running"
+            logger.error(msg)
+            return msg
+        invalid = check_labels(labels) or check_limits(limits)
+        if invalid is not None:
+            return invalid
+
+        if watch_rules is not None:
+            self.set_watch_rules(uid, watch_rules)
+        if output_limit is not None:
+            self.set_output_limit(uid, output_limit)
+        if depends_on is not None or ready is not None:
+            self._startup_graph.add(uid, depends_on, ready)
 
-    def add_process(self, uid: str, command: str, as_process_group: bool = True, command_kwargs=None) -> Union[str, Process]:
         if uid in self._processes:
             process = self._processes[uid]
-            if process.is_running():
-                msg = f"Process with name '{uid}' already known and running"
-                logger.error(msg)
-                return msg
-            else:
-                process.update_data(command, as_process_group)
-                logger.info("Updated process %s: %s", uid, process.get_data())
-                return process
+            process.update_data(command, as_process_group, labels, command_kwargs, limits)
+            logger.info("Updated process %s: %s", uid, process.get_data())
+        else:
+            process = Process(ProcessData(uid, command, as_process_group, command_kwargs=command_kwargs,
+                                          labels=labels, limits=limits))
+            self._processes[uid] = process
+            logger.info("Added new process %s", uid)
+        self._index.add(process.get_data())
 
-        process = Process(ProcessData(uid, command, as_process_group, command_kwargs=command_kwargs))
-        self._processes[uid] = process
-        logger.info("Added new process %s", uid)
+        if self._registry is not None:
+            self._registry.record_add(process.get_data(), self._process_options(uid))
         return process
 
+    def _process_options(self, uid: str) -> Dict[str, Any]:
+        # the arguments of add_process besides the ProcessData as in the
+        # process config, persisted with the process
+        options: Dict[str, Any] = {}
+        watcher = self._watchers.get(uid, None)
+        if watcher is not None:
+            options["watch"] = [rule.to_config() for rule in watcher.rules]
+        limiter = self._limiters.get(uid, None)
+        if limiter is not None:
+            options["output_limit"] = limiter.limit.to_config()
+        condition = self._startup_graph.condition_of(uid)
+        if condition is not None:
+            options["depends_on"] = self._startup_graph.dependencies_of(uid)
+            options["ready"] = condition.to_config()
+        return options
+
+    def _restore_options(self, uid: str, options: Dict[str, Any]) -> None:
+        try:
+            self.set_watch_rules(uid, watch_rules_from_config(options.get("watch", None)))
+            self.set_output_limit(uid, output_limit_from_config(options.get("output_limit", None)))
+            if "ready" in options:
+                self._startup_graph.add(uid, options.get("depends_on", None),
+                                        ready_condition_from_config(options["ready"]))
+        except ValueError as excpt:
+            logger.error("Failed to restore the options of process %s: %s", uid, excpt)
+
     def remove_process(self, uid: str) -> Union[str, bool]:
         if uid not in self._processes:
             return f"Unknown process: '{uid}'"
@@ -45,6 +130,22 @@ class ProcessMonitor:
             return f"Process '{uid}' is running. It cannot be removed in the running state."
 
         del self._processes[uid]
+        self._index.remove(uid)
+        self.config_entries.pop(uid, None)
+        if self._cgroups is not None:
+            self._cgroups.remove(uid)
+        self._startup_graph.remove(uid)
+        self._watchers.pop(uid, None)
+        self._limiters.pop(uid, None)
+        if self._output_counters.pop(uid, None) is not None:
+            self.metrics.remove("wsmonitor_output_bytes_total", uid=uid)
+            self.metrics.remove("wsmonitor_output_lines_total", uid=uid)
+        output_log = self._output_logs.pop(uid, None)
+        if output_log is not None:
+            # closing writes the buffered output
+            asyncio.get_event_loop().run_in_executor(None, self._close_output_logs, [output_log])
+        if self._registry is not None:
+            self._registry.record_remove(uid)
         logger.info("Removed process %s", uid)
         return True
 
@@ -57,13 +158,293 @@ class ProcessMonitor:
         if process.is_running():
             return "Process '%s' is already running" % uid
 
-        process.set_state_listener(
-            lambda process: self._state_event_queue.put_nowait(
-                StateChangedEvent(process.uid(), process.state(), process.exit_code())))
-        process.set_output_listener(
-            lambda proc, output: self._output_event_queue.put_nowait(OutputEvent(proc.uid(), output.decode())))
+        self._attach(process)
+        self._prepare_cgroup(process)
+        if uid in self._watchers:
+            self._watchers[uid].reset()
+
+        result = process.start_as_task(**kwargs)
+        # the state is changed without an event
+        self._index.update_state(process.get_data())
+        return result
+
+    def enable_cgroups(self, root: str) -> bool:
+        """
+        Starts the processes in cgroups below the delegated cgroup v2 root
+        with the limits of their config. Returns False if the root cannot
+        be used, the processes run without cgroups then.
+        """
+        cgroups = CgroupManager(root)
+        result = cgroups.enable()
+        if isinstance(result, str):
+            logger.warning("%s, processes run without cgroups and limits", result)
+            return False
+
+        self._cgroups = cgroups
+        self.metrics.gauge("wsmonitor_process_cpu_seconds_total", lambda: {
+            (("uid", uid),): usec / 1e6 for uid, usec in
+            ((uid, cgroup.cpu_usec()) for uid, cgroup in cgroups.cgroups().items()) if usec is not None},
+            "CPU time of the process and its children from its cgroup")
+        self.metrics.gauge("wsmonitor_process_memory_bytes", lambda: {
+            (("uid", uid),): value for uid, value in
+            ((uid, cgroup.memory_bytes()) for uid, cgroup in cgroups.cgroups().items()) if value is not None},
+            "Memory of the process and its children from its cgroup")
+        return True
+
+    def _prepare_cgroup(self, process: Process) -> None:
+        if self._cgroups is not None:
+            process.set_cgroup(self._cgroups.prepare(process.uid(), process.get_data().limits))
+
+    def get_usage(self, uid: str) -> Union[str, Dict[str, int]]:
+        """
+        The cpu and memory accounting of the cgroup of the process, see
+        Cgroup.usage.
+        """
+        if uid not in self._processes:
+            return f"Unknown process: '{uid}'"
+        cgroup = self._processes[uid].get_cgroup()
+        if cgroup is None:
+            return f"Process '{uid}' does not run in a cgroup"
+        return cgroup.usage()
+
+    def enable_launcher(self) -> bool:
+        """
+        Starts the processes from a launcher helper process, which keeps
+        fork() cheap for frequently started short jobs. Returns False if it
+        cannot be started, the processes are started directly then.
+        """
+        launcher = Launcher()
+        if not launcher.start():
+            return False
+        self._launcher = launcher
+        for process in self._processes.values():
+            process.set_launcher(launcher)
+        return True
+
+    def _attach(self, process: Process) -> None:
+        process.set_state_listener(self._on_process_state)
+        process.set_output_listener(self._on_process_output)
+        process.set_launcher(self._launcher)
+
+    def _on_process_state(self, process: Process) -> None:
+        self._index.update_state(process.get_data())
+        limiter = self._limiters.get(process.uid(), None)
+        if limiter is not None:
+            if process.state() == ProcessData.STARTED:
+                limiter.reset()
+            elif process.has_completed():
+                self._forward_limited(process.uid(), limiter.finish(time.monotonic()))
+        self._state_event_queue.put_nowait(
+            StateChangedEvent(process.uid(), process.state(), process.exit_code()))
+
+        if self._registry is not None and process.get_data().is_in_state(ProcessData.STARTED, ProcessData.ENDED):
+            pid = process.pid() if process.is_running() else None
+            pgid = None
+            if pid is not None and process.get_data().as_process_group:
+                try:
+                    pgid = os.getpgid(pid)
+                except OSError:
+                    pass
+            self._registry.record_state(process.get_data(), pid, pgid)
+
+    def enable_registry(self, directory: str, **registry_options) -> None:
+        # Registered processes are persisted, see restore_registry. The
+        # changes are written every registry_flush_interval, see ProcessRegistry.
+        self._registry = ProcessRegistry(directory, **registry_options)
+
+    def restore_registry(self, adopt: bool = False) -> int:
+        """
+        Restores the processes of the previous server run. With adopt still
+        running processes are taken over, otherwise they are reset.
+        Returns the number of restored processes.
+        """
+        adopted = 0
+        entries = self._registry.load()
+        for entry in entries:
+            data = ProcessData.from_json(entry["data"])
+            process = Process(data)
+            self._processes[data.uid] = process
+            self._restore_options(data.uid, entry.get("options", {}))
+
+            if data.is_in_state(ProcessData.INITIALIZED, ProcessData.ENDED):
+                self._index.add(data)
+                continue
+
+            pid = entry.get("pid", None)
+            if adopt and pid is not None and self._is_adoptable(data, pid, entry):
+                self._attach(process)
+                process.adopt(pid)
+                adopted += 1
+            else:
+                data.reset()
+            self._index.add(data)
+
+        logger.info("Restored %d processes from the registry, adopted %d running ones", len(entries), adopted)
+        return len(entries)
+
+    @staticmethod
+    def _is_adoptable(data: ProcessData, pid: int, entry: Dict[str, Any]) -> bool:
+        if not is_same_process_alive(pid, entry.get("start_time", None)):
+            return False
+        if data.as_process_group and entry.get("pgid", None) is not None:
+            try:
+                return os.getpgid(pid) == entry["pgid"]
+            except OSError:
+                return False
+        return True
+
+    def set_watch_rules(self, uid: str, rules: List[WatchRule]) -> None:
+        if rules:
+            self._watchers[uid] = OutputWatcher(rules)
+        else:
+            self._watchers.pop(uid, None)
+
+    def set_output_limit(self, uid: str, limit: OutputLimit) -> None:
+        if limit.is_active():
+            self._limiters[uid] = OutputLimiter(limit)
+        else:
+            self._limiters.pop(uid, None)
+
+    def enable_output_logs(self, directory: str, **log_options) -> None:
+        # The output of every process is appended to an OutputLog,
+        # see OutputLog for the available options
+        self._output_log_options = dict(log_options, directory=directory)
+
+    def _get_output_log(self, uid: str) -> Optional[OutputLog]:
+        if self._output_log_options is None:
+            return None
 
-        return process.start_as_task(**kwargs)
+        output_log = self._output_logs.get(uid, None)
+        if output_log is None:
+            output_log = OutputLog(uid=uid, **self._output_log_options)
+            self._output_logs[uid] = output_log
+        return output_log
+
+    def _flush_output_logs(self) -> None:
+        for output_log in list(self._output_logs.values()):
+            try:
+                output_log.flush()
+            except OSError as excpt:
+                logger.error("Failed to write output log of %s: %s", output_log.uid, excpt)
+
+    @staticmethod
+    def _close_output_logs(output_logs: List[OutputLog]) -> None:
+        for output_log in output_logs:
+            try:
+                output_log.close()
+            except OSError as excpt:
+                logger.error("Failed to close output log of %s: %s", output_log.uid, excpt)
+
+    async def _periodic_output_log_flush(self) -> None:
+        loop = asyncio.get_event_loop()
+        while self._is_monitor_running:
+            await asyncio.sleep(self.output_log_flush_interval)
+            # batched writes of all logs, off the event loop
+            await loop.run_in_executor(None, self._flush_output_logs)
+
+    async def _periodic_registry_flush(self) -> None:
+        while self._is_monitor_running:
+            await asyncio.sleep(self.registry_flush_interval)
+            # the registry writes on its own thread, in order
+            await self._registry.flush()
+
+    async def get_output_history(self, uid: str, start: Optional[int] = None, count: int = 100,
+                                 since: Optional[float] = None) -> Union[str, Dict[str, Any]]:
+        if self._output_log_options is None:
+            return "Output logs are not enabled"
+        if uid not in self._processes:
+            return f"Unknown process: '{uid}'"
+
+        output_log = self._get_output_log(uid)
+
+        def read():
+            output_log.flush()
+            first = start
+            if since is not None:
+                first = output_log.line_at_time(since)
+            elif first is None:
+                # the last lines by default
+                first = max(output_log.line_count() - count, 0)
+            elif first < 0:
+                first = max(output_log.line_count() + first, 0)
+            return output_log.read_lines(first, count)
+
+        try:
+            first_line, output = await asyncio.get_event_loop().run_in_executor(None, read)
+        except OSError as excpt:
+            # e.g. a segment removed by the retention while reading
+            logger.warning("Failed to read output log of %s: %s", uid, excpt)
+            return f"Failed to read the output log of '{uid}': {excpt}"
+        return {"uid": uid, "line": first_line, "lines": output.count(b"\n"),
+                "output": output.decode(errors="replace")}
+
+    def _on_process_output(self, process: Process, output: bytes, stream: int,
+                           wall: float, mono: float) -> None:
+        counters = self._output_counters.get(process.uid(), None)
+        if counters is None:
+            counters = self._output_counters[process.uid()] = (
+                self.metrics.counter("wsmonitor_output_bytes_total", "Output bytes read", uid=process.uid()),
+                self.metrics.counter("wsmonitor_output_lines_total", "Output lines read", uid=process.uid()))
+        counters[0].inc(len(output))
+        counters[1].inc(output.count(b"\n"))
+
+        # the rules see all output, the limit only applies to what is kept
+        watcher = self._watchers.get(process.uid(), None)
+        if watcher is not None:
+            for rule, line in watcher.scan(output):
+                self._on_match(process.uid(), rule, line)
+
+        limiter = self._limiters.get(process.uid(), None)
+        if limiter is not None:
+            self._forward_limited(process.uid(), limiter.filter(output, stream, mono), wall, mono)
+        else:
+            self._forward_output(process.uid(), output, stream, wall, mono)
+
+    def _forward_output(self, uid: str, output: bytes, stream: int, wall: float, mono: float) -> None:
+        self._queue_output(uid, output, stream, wall, mono)
+
+        output_log = self._get_output_log(uid)
+        if output_log is not None:
+            output_log.append(output, wall)
+
+    def _forward_limited(self, uid: str, chunks: List[Tuple[int, bytes]],
+                         wall: Optional[float] = None, mono: Optional[float] = None) -> None:
+        if chunks and wall is None:
+            wall, mono = time.time(), time.monotonic()
+        for stream, output in chunks:
+            self._forward_output(uid, output, stream, wall, mono)
+
+    async def _periodic_output_limit_markers(self) -> None:
+        # markers of processes which went quiet after a burst
+        while self._is_monitor_running:
+            await asyncio.sleep(self.output_limit_marker_interval)
+            mono = time.monotonic()
+            for uid, limiter in list(self._limiters.items()):
+                self._forward_limited(uid, limiter.flush(mono))
+
+    def _queue_output(self, uid: str, output: bytes, stream: int, wall: float, mono: float) -> None:
+        self._output_event_queue.put_nowait(
+            OutputEvent.from_chunk(uid, output.decode(errors="replace"), stream, wall, mono))
+
+    def _on_match(self, uid: str, rule: WatchRule, line: bytes) -> None:
+        logger.info("Process[%s]: output matched %s", uid, rule)
+        self._state_event_queue.put_nowait(MatchEvent(uid, rule.name, rule.action, line.decode(errors="replace")))
+
+        if rule.action == WatchRule.READY:
+            self.mark_ready(uid)
+        elif rule.action == WatchRule.STOP:
+            asyncio.ensure_future(self.stop_process(uid))
+        elif rule.action == WatchRule.RESTART:
+            asyncio.ensure_future(self.restart_process(uid, ignore_stop_failure=True))
+
+    def start_processes_ordered(self, uids: List[str],
+                                delays: Optional[Dict[str, float]] = None) -> Union[str, asyncio.Future]:
+        # Starts the processes and their dependencies, each one as soon as
+        # all of its dependencies are ready
+        return self._startup_graph.start(self, uids, delays)
+
+    def mark_ready(self, uid: str) -> bool:
+        return self._startup_graph.mark_ready(uid)
 
     async def stop_process(self, uid: str) -> Union[int, str]:
         if uid not in self._processes:
@@ -78,13 +459,22 @@ class ProcessMonitor:
             return f"Failed to stop process, cannot restart: {result}"
 
         process = self._processes[uid]
-        return process.restart_ended_process(**kwargs)
+        self._prepare_cgroup(process)
+        result = process.restart_ended_process(**kwargs)
+        self._index.update_state(process.get_data())
+        return result
 
     def _get_monitor_tasks(self) -> List[asyncio.Future]:
         # TODO: combine output events?
         state_task = asyncio.ensure_future(self._process_queue(self._state_event_queue, self.on_state_event))
         output_task = asyncio.ensure_future(self._process_queue(self._output_event_queue, self.on_output_event))
-        return [state_task, output_task]
+        tasks = [state_task, output_task, asyncio.ensure_future(measure_loop_lag(self.metrics))]
+        if self._output_log_options is not None:
+            tasks.append(asyncio.ensure_future(self._periodic_output_log_flush()))
+        if self._registry is not None:
+            tasks.append(asyncio.ensure_future(self._periodic_registry_flush()))
+        tasks.append(asyncio.ensure_future(self._periodic_output_limit_markers()))
+        return tasks
 
     def start_monitor(self):
         self._is_monitor_running = True
@@ -106,21 +496,45 @@ class ProcessMonitor:
         running = list(filter(lambda proc: proc.is_running(), self._processes.values()))
         logger.info("Initiating monitor shutdown, stopping %d running processes", len(running))
 
-        for process in running:
-            logger.info("Stopping process: %s", process.uid())
-            await process.stop()  # will cancel all process tasks as well
+        # stop dependents before their dependencies
+        await self._startup_graph.stop(running)
 
         # stop or cancel the monitor tasks
         self._is_monitor_running = False
         await asyncio.sleep(.1)
 
-        self._gather_monitoring_tasks_future.cancel()
-        try:
-            await self._gather_monitoring_tasks_future
-        except asyncio.CancelledError:
-            pass
+        # not started if the server failed to start
+        if self._gather_monitoring_tasks_future is not None:
+            self._gather_monitoring_tasks_future.cancel()
+            try:
+                await self._gather_monitoring_tasks_future
+            except asyncio.CancelledError:
+                pass
+
+        await asyncio.get_event_loop().run_in_executor(None, self._close_output_logs,
+                                                       list(self._output_logs.values()))
+        if self._registry is not None:
+            await self._registry.close()
+        if self._launcher is not None:
+            await self._launcher.close()
 
         logger.info("Monitor shutdown complete, all processes stopped")
 
     def get_processes(self) -> List[ProcessData]:
         return [proc.get_data() for proc in self._processes.values()]
+
+    def query_processes(self, states: Optional[List[str]] = None,
+                        labels: Optional[Dict[str, str]] = None, prefix: Optional[str] = None,
+                        failed: Optional[bool] = None) -> List[ProcessData]:
+        """
+        Returns the processes in one of the states, with all of the labels
+        and the uid prefix sorted by uid. Failed processes ended with an exit
+        code other than 0.
+        """
+        return self._index.query(states, labels, prefix, failed)
+
+    def get_process(self, uid: str) -> Optional[Process]:
+        return self._processes.get(uid, None)
+
+    def get_uids(self) -> List[str]:
+        return list(self._processes.keys())
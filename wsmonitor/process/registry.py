@@ -0,0 +1,229 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, List, Tuple
+
+from wsmonitor.process.data import ProcessData
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def process_start_time(pid: int) -> Optional[int]:
+    # The start time (field 22 of /proc/<pid>/stat) tells a re-used pid apart
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as stat_file:
+            stat = stat_file.read()
+    except OSError:
+        return None
+
+    # the command name may contain spaces, the fields start after the last ')'
+    fields = stat[stat.rfind(b")") + 2:].split()
+    try:
+        return int(fields[19])
+    except (IndexError, ValueError):
+        return None
+
+
+def is_same_process_alive(pid: int, start_time: Optional[int]) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return False
+
+    if start_time is None:
+        return True
+    current = process_start_time(pid)
+    return current is None or current == start_time
+
+
+class ProcessRegistry:
+    """
+    Durable record of the registered processes: every change is appended to a
+    journal, which is periodically compacted into a snapshot. Loading reads
+    the snapshot and replays the journal. Changes are buffered and written
+    with flush() on a single thread, off the event loop and in order.
+    Changes since the last flush, at most registry_flush_interval of the
+    ProcessMonitor, are lost if the server dies, also with sync, which
+    only makes the flushed records survive a crash of the system.
+    """
+    SNAPSHOT = "registry.snapshot"
+    JOURNAL = "registry.journal"
+
+    def __init__(self, directory: str, compact_after: int = 1000, sync: bool = False):
+        self.directory = directory
+        self.compact_after = compact_after
+        self.sync = sync
+        # entries are replaced on every change, never modified, so that the
+        # snapshot can be written while the loop goes on
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._pending: List[Dict[str, Any]] = []
+        self._journal = None
+        self._journal_records = 0
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="wsmonitor-registry")
+
+        os.makedirs(directory, exist_ok=True)
+        self._snapshot_path = os.path.join(directory, ProcessRegistry.SNAPSHOT)
+        self._journal_path = os.path.join(directory, ProcessRegistry.JOURNAL)
+
+    def load(self) -> List[Dict[str, Any]]:
+        """
+        Returns the entries with the keys "data" (the ProcessData json),
+        "options" (see record_add), "pid", "pgid" and "start_time" of the
+        last known run.
+        """
+        self._entries = {}
+        if os.path.exists(self._snapshot_path):
+            with open(self._snapshot_path, "r") as snapshot_file:
+                for entry in json.load(snapshot_file):
+                    self._entries[entry["data"]["uid"]] = entry
+
+        replayed = 0
+        if os.path.exists(self._journal_path):
+            with open(self._journal_path, "r") as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a partially written last record after a crash
+                        logger.warning("Skipping invalid registry record: %s", line.strip())
+                        continue
+                    self._apply(record)
+                    replayed += 1
+
+        logger.info("Loaded %d registered processes (%d journal records)", len(self._entries), replayed)
+        # start with a fresh journal
+        self._write([], list(self._entries.values()))
+        return list(self._entries.values())
+
+    def _apply(self, record: Dict[str, Any]) -> None:
+        operation = record["op"]
+        uid = record["uid"]
+        if operation == "add":
+            entry = self._entries.get(uid, {"pid": None, "pgid": None, "start_time": None})
+            self._entries[uid] = dict(entry, data=record["data"], options=record.get("options", {}))
+        elif operation == "remove":
+            self._entries.pop(uid, None)
+        elif operation == "state" and uid in self._entries:
+            entry = self._entries[uid]
+            self._entries[uid] = dict(
+                entry, data=dict(entry["data"], state=record["state"], exit_code=record["exit_code"]),
+                pid=record.get("pid", None), pgid=record.get("pgid", None),
+                start_time=record.get("start_time", None))
+
+    def _append(self, record: Dict[str, Any]) -> None:
+        self._apply(record)
+        self._pending.append(record)
+
+    def record_add(self, data: ProcessData, options: Optional[Dict[str, Any]] = None) -> None:
+        # options are the json arguments of add_process besides the
+        # ProcessData, e.g. "watch" and "ready" as in the process config
+        self._append({"op": "add", "uid": data.uid, "data": data.to_json()["data"],
+                      "options": options or {}})
+
+    def record_remove(self, uid: str) -> None:
+        self._append({"op": "remove", "uid": uid})
+
+    def record_state(self, data: ProcessData, pid: Optional[int] = None,
+                     pgid: Optional[int] = None) -> None:
+        # the start time is read when the record is written
+        record = {"op": "state", "uid": data.uid, "state": data.state,
+                  "exit_code": data.exit_code}
+        if pid is not None:
+            record.update(pid=pid, pgid=pgid)
+        self._append(record)
+
+    def _take_pending(self, compact: bool = False) -> Tuple[List[Dict[str, Any]], Optional[List[Dict[str, Any]]]]:
+        # the records to write and the entries if a snapshot is due, which
+        # replaces the journal
+        records, self._pending = self._pending, []
+        self._journal_records += len(records)
+        if not compact and self._journal_records < self.compact_after:
+            return records, None
+        self._journal_records = 0
+        return records, list(self._entries.values())
+
+    def _write(self, records: List[Dict[str, Any]],
+               snapshot: Optional[List[Dict[str, Any]]]) -> Dict[str, Tuple[int, Optional[int]]]:
+        # runs on the executor, returns the start times of the recorded runs
+        start_times = {}
+        for record in records:
+            if record.get("pid", None) is not None:
+                record["start_time"] = process_start_time(record["pid"])
+                start_times[record["uid"]] = (record["pid"], record["start_time"])
+
+        try:
+            if snapshot is None:
+                self._write_journal(records)
+            else:
+                self._write_snapshot([self._with_start_time(entry, start_times) for entry in snapshot])
+        except OSError as excpt:
+            logger.error("Failed to write the process registry: %s", excpt)
+        return start_times
+
+    @staticmethod
+    def _with_start_time(entry: Dict[str, Any],
+                         start_times: Dict[str, Tuple[int, Optional[int]]]) -> Dict[str, Any]:
+        pid, start_time = start_times.get(entry["data"]["uid"], (None, None))
+        if pid is None or entry["pid"] != pid:
+            return entry
+        return dict(entry, start_time=start_time)
+
+    def _apply_start_times(self, start_times: Dict[str, Tuple[int, Optional[int]]]) -> None:
+        for uid, (pid, start_time) in start_times.items():
+            entry = self._entries.get(uid, None)
+            if entry is not None and entry["pid"] == pid:
+                self._entries[uid] = dict(entry, start_time=start_time)
+
+    def _on_written(self, future: asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is None:
+            self._apply_start_times(future.result())
+
+    def _write_journal(self, records: List[Dict[str, Any]]) -> None:
+        if self._journal is None:
+            self._journal = open(self._journal_path, "a")
+
+        self._journal.write("".join(json.dumps(record) + "\n" for record in records))
+        self._journal.flush()
+        if self.sync:
+            os.fsync(self._journal.fileno())
+
+    def _write_snapshot(self, entries: List[Dict[str, Any]]) -> None:
+        tmp_path = self._snapshot_path + ".tmp"
+        with open(tmp_path, "w") as snapshot_file:
+            json.dump(entries, snapshot_file)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(tmp_path, self._snapshot_path)
+
+        # the snapshot contains everything, start a new journal
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self._journal_path, "w")
+
+    async def flush(self, compact: bool = False) -> None:
+        """
+        Writes the buffered changes, compacted into a snapshot every
+        compact_after records or with compact.
+        """
+        records, snapshot = self._take_pending(compact)
+        if not records and snapshot is None:
+            return
+        future = asyncio.get_event_loop().run_in_executor(self._executor, self._write, records, snapshot)
+        # the start times are kept even if the caller is cancelled
+        future.add_done_callback(self._on_written)
+        await asyncio.shield(future)
+
+    def _close_journal(self) -> None:
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    async def close(self) -> None:
+        await self.flush(compact=True)
+        await asyncio.get_event_loop().run_in_executor(self._executor, self._close_journal)
+        self._executor.shutdown()
@@ -0,0 +1,376 @@
+import asyncio
+import logging
+import os
+import re
+from typing import Dict, List, Optional, Union, Any, Awaitable, Set, TYPE_CHECKING
+
+from wsmonitor.process.data import ProcessData
+from wsmonitor.process.process import Process
+
+if TYPE_CHECKING:
+    from wsmonitor.process.process_monitor import ProcessMonitor
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class ReadyCondition:
+    """
+    Decides when a started process is ready to be used by its dependents.
+    wait() has to start observing the process immediately, as the process
+    is started right after it has been called.
+    """
+    # the type in the config, see ready_condition_from_config
+    TYPE: str
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.timeout = timeout
+
+    def wait(self, process: Process) -> Awaitable:
+        raise NotImplementedError()
+
+    def to_config(self) -> Dict[str, Any]:
+        # the "ready" entry of a process config, see ready_condition_from_config
+        config: Dict[str, Any] = {"type": self.TYPE}
+        if self.timeout is not None:
+            config["timeout"] = self.timeout
+        return config
+
+    def __str__(self):
+        return self.__class__.__name__
+
+
+class StartedCondition(ReadyCondition):
+    TYPE = "started"
+
+    def wait(self, process: Process) -> Awaitable:
+        return process.wait_for_state(ProcessData.STARTED)
+
+
+class OutputCondition(ReadyCondition):
+    TYPE = "output"
+
+    def __init__(self, pattern: str, timeout: Optional[float] = None):
+        super().__init__(timeout)
+        self.pattern = re.compile(pattern.encode())
+
+    def wait(self, process: Process) -> Awaitable:
+        future = asyncio.get_event_loop().create_future()
+
+        def observer(_, output: bytes, *_args):
+            if not future.done() and self.pattern.search(output):
+                future.set_result(True)
+
+        process.add_output_observer(observer)
+        future.add_done_callback(
+            lambda _: process.remove_output_observer(observer))
+        return future
+
+    def to_config(self) -> Dict[str, Any]:
+        return dict(super().to_config(), pattern=self.pattern.pattern.decode())
+
+    def __str__(self):
+        return f"{self.__class__.__name__}({self.pattern.pattern!r})"
+
+
+class WatchCondition(ReadyCondition):
+    # Ready once a watch rule with the "ready" action matched the output
+    TYPE = "watch"
+
+    def wait(self, process: Process) -> Awaitable:
+        return asyncio.get_event_loop().create_future()
+
+
+class PollingCondition(ReadyCondition):
+
+    def __init__(self, interval: float = .2, timeout: Optional[float] = None):
+        super().__init__(timeout)
+        self.interval = interval
+
+    def wait(self, process: Process) -> Awaitable:
+        return asyncio.ensure_future(self._poll(process))
+
+    async def _poll(self, process: Process):
+        await process.wait_for_state(ProcessData.STARTED)
+        while not await self.is_ready():
+            await asyncio.sleep(self.interval)
+        return True
+
+    async def is_ready(self) -> bool:
+        raise NotImplementedError()
+
+    def to_config(self) -> Dict[str, Any]:
+        return dict(super().to_config(), interval=self.interval)
+
+
+class PortCondition(PollingCondition):
+    TYPE = "port"
+
+    def __init__(self, port: int, host: str = "127.0.0.1", interval: float = .2,
+                 timeout: Optional[float] = None):
+        super().__init__(interval, timeout)
+        self.host = host
+        self.port = port
+
+    async def is_ready(self) -> bool:
+        try:
+            _, writer = await asyncio.open_connection(self.host, self.port)
+        except OSError:
+            return False
+
+        writer.close()
+        return True
+
+    def to_config(self) -> Dict[str, Any]:
+        return dict(super().to_config(), port=self.port, host=self.host)
+
+    def __str__(self):
+        return f"{self.__class__.__name__}({self.host}:{self.port})"
+
+
+class FileCondition(PollingCondition):
+    TYPE = "file"
+
+    def __init__(self, path: str, interval: float = .2,
+                 timeout: Optional[float] = None):
+        super().__init__(interval, timeout)
+        self.path = path
+
+    async def is_ready(self) -> bool:
+        return os.path.exists(self.path)
+
+    def to_config(self) -> Dict[str, Any]:
+        return dict(super().to_config(), path=self.path)
+
+    def __str__(self):
+        return f"{self.__class__.__name__}({self.path})"
+
+
+def ready_condition_from_config(config: Union[None, str, Dict[str, Any]]) -> ReadyCondition:
+    """
+    Creates the condition from the "ready" entry of a process config, e.g.
+    "started", {"type": "output", "pattern": "Listening on"},
+    {"type": "port", "port": 5432}, {"type": "file", "path": "/tmp/ready"}
+    or "watch" to wait for a watch rule with the "ready" action
+    """
+    if config is None:
+        return StartedCondition()
+
+    if isinstance(config, str):
+        config = {"type": config}
+
+    kwargs = dict(config)
+    condition_type = kwargs.pop("type", "started")
+    condition_types = {
+        "started": StartedCondition,
+        "output": OutputCondition,
+        "port": PortCondition,
+        "file": FileCondition,
+        "watch": WatchCondition,
+    }
+
+    if condition_type not in condition_types:
+        raise ValueError(f"Unknown ready condition: '{condition_type}'")
+
+    try:
+        return condition_types[condition_type](**kwargs)
+    except TypeError as excpt:
+        raise ValueError(f"Invalid ready condition {config}: {excpt}") from excpt
+
+
+class StartupNode:
+
+    def __init__(self, uid: str, depends_on: List[str],
+                 condition: ReadyCondition):
+        self.uid = uid
+        self.depends_on = depends_on
+        self.condition = condition
+        self.ready: Optional[asyncio.Future] = None
+
+
+class StartupGraph:
+    """
+    Starts processes as soon as all of their dependencies are ready and stops
+    them in the reverse order.
+    """
+
+    def __init__(self):
+        self._nodes: Dict[str, StartupNode] = {}
+
+    def add(self, uid: str, depends_on: Optional[List[str]] = None,
+            condition: Optional[ReadyCondition] = None) -> None:
+        self._nodes[uid] = StartupNode(uid, list(depends_on or []),
+                                       condition or StartedCondition())
+
+    def remove(self, uid: str) -> None:
+        self._nodes.pop(uid, None)
+
+    def get_node(self, uid: str) -> StartupNode:
+        if uid not in self._nodes:
+            self._nodes[uid] = StartupNode(uid, [], StartedCondition())
+        return self._nodes[uid]
+
+    def dependencies_of(self, uid: str) -> List[str]:
+        node = self._nodes.get(uid, None)
+        return [] if node is None else node.depends_on
+
+    def condition_of(self, uid: str) -> Optional[ReadyCondition]:
+        node = self._nodes.get(uid, None)
+        return None if node is None else node.condition
+
+    def with_dependencies(self, uids: List[str]) -> List[str]:
+        result: List[str] = []
+        seen: Set[str] = set()
+        pending = list(uids)
+        while pending:
+            uid = pending.pop()
+            if uid in seen:
+                continue
+            seen.add(uid)
+            result.append(uid)
+            pending.extend(self.dependencies_of(uid))
+        return result
+
+    def validate(self, uids: List[str], known: Set[str]) -> Optional[str]:
+        unknown = [uid for uid in uids if uid not in known]
+        if unknown:
+            return f"Unknown processes in startup graph: {unknown}"
+
+        # Kahn's algorithm, anything not sorted is part of a cycle
+        remaining = {uid: set(self.dependencies_of(uid)) for uid in uids}
+        ready = [uid for uid, deps in remaining.items() if not deps]
+        dependents: Dict[str, List[str]] = {uid: [] for uid in uids}
+        for uid, deps in remaining.items():
+            for dep in deps:
+                dependents[dep].append(uid)
+
+        sorted_count = 0
+        while ready:
+            uid = ready.pop()
+            sorted_count += 1
+            for dependent in dependents[uid]:
+                remaining[dependent].discard(uid)
+                if not remaining[dependent]:
+                    ready.append(dependent)
+
+        if sorted_count != len(uids):
+            cyclic = sorted(uid for uid, deps in remaining.items() if deps)
+            return f"Dependency cycle between processes: {cyclic}"
+
+        return None
+
+    def start(self, monitor: 'ProcessMonitor', uids: List[str],
+              delays: Optional[Dict[str, float]] = None) -> Union[str, asyncio.Future]:
+        uids = self.with_dependencies(uids)
+        error = self.validate(uids, set(monitor.get_uids()))
+        if error is not None:
+            logger.error(error)
+            return error
+
+        loop = asyncio.get_event_loop()
+        nodes = [self.get_node(uid) for uid in uids]
+        for node in nodes:
+            node.ready = loop.create_future()
+
+        delays = delays or {}
+        logger.info("Starting %d processes in dependency order", len(nodes))
+        return asyncio.gather(*(self._start_node(monitor, node, delays.get(node.uid, 0))
+                                for node in nodes))
+
+    def mark_ready(self, uid: str) -> bool:
+        node = self._nodes.get(uid, None)
+        if node is None or node.ready is None or node.ready.done():
+            return False
+
+        node.ready.set_result(True)
+        return True
+
+    async def _start_node(self, monitor: 'ProcessMonitor', node: StartupNode,
+                          delay: float) -> bool:
+        dependencies = [self._nodes[dep].ready for dep in node.depends_on]
+        if dependencies and not all(await asyncio.gather(*dependencies)):
+            logger.warning("Process[%s]: not started, a dependency failed",
+                           node.uid)
+            return self._set_ready(node, False)
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        process = monitor.get_process(node.uid)
+        waiting = node.condition.wait(process)
+        if process.get_data().is_in_state(ProcessData.INITIALIZED,
+                                          ProcessData.ENDED):
+            result = monitor.start_process(node.uid)
+            if isinstance(result, str):
+                logger.warning("Process[%s]: failed to start: %s", node.uid,
+                               result)
+                asyncio.ensure_future(waiting).cancel()
+                return self._set_ready(node, False)
+
+        condition_future = asyncio.ensure_future(waiting)
+        pending = {condition_future, node.ready}
+        if process.get_start_task() is not None:
+            pending.add(process.get_start_task())
+
+        done, _ = await asyncio.wait(pending, timeout=node.condition.timeout,
+                                     return_when=asyncio.FIRST_COMPLETED)
+
+        if node.ready.done():
+            ready = node.ready.result()
+        elif condition_future in done and not condition_future.cancelled():
+            ready = condition_future.exception() is None
+        else:
+            # The process ended before becoming ready, or we timed out.
+            # A completed one-shot process (e.g. a migration) counts as ready.
+            ready = process.get_data().has_ended_successfully()
+
+        condition_future.cancel()
+        if ready:
+            logger.info("Process[%s]: ready (%s)", node.uid, node.condition)
+        else:
+            logger.warning("Process[%s]: did not become ready (%s)", node.uid,
+                           node.condition)
+        return self._set_ready(node, ready)
+
+    @staticmethod
+    def _set_ready(node: StartupNode, ready: bool) -> bool:
+        if not node.ready.done():
+            node.ready.set_result(ready)
+        return node.ready.result()
+
+    async def stop(self, processes: List[Process]) -> None:
+        # Every process waits for its running dependents to stop first,
+        # independent processes are stopped in parallel
+        running = {process.uid(): process for process in processes}
+        dependents: Dict[str, List[str]] = {uid: [] for uid in running}
+        for uid in running:
+            for dep in self.dependencies_of(uid):
+                if dep in running:
+                    dependents[dep].append(uid)
+
+        tasks: Dict[str, asyncio.Future] = {}
+        visiting: Set[str] = set()
+
+        def stop_task(uid: str) -> asyncio.Future:
+            if uid in tasks:
+                return tasks[uid]
+
+            visiting.add(uid)
+            before = [stop_task(dependent) for dependent in dependents[uid]
+                      if dependent not in visiting]
+            tasks[uid] = asyncio.ensure_future(
+                self._stop_after(running[uid], before))
+            return tasks[uid]
+
+        for uid in running:
+            stop_task(uid)
+
+        await asyncio.gather(*tasks.values())
+
+    @staticmethod
+    async def _stop_after(process: Process, before: List[asyncio.Future]):
+        if before:
+            await asyncio.wait(before)
+
+        logger.info("Stopping process: %s", process.uid())
+        await process.stop()  # will cancel all process tasks as well
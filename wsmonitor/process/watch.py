@@ -0,0 +1,107 @@
+import re
+from typing import List, Optional, Dict, Any, Tuple
+
+
+class WatchRule:
+    ALERT = "alert"
+    READY = "ready"
+    RESTART = "restart"
+    STOP = "stop"
+    ACTIONS = (ALERT, READY, RESTART, STOP)
+
+    def __init__(self, pattern: str, action: str = ALERT,
+                 name: Optional[str] = None, once: bool = False):
+        if action not in WatchRule.ACTIONS:
+            raise ValueError(f"Unknown watch action '{action}', expected one of {WatchRule.ACTIONS}")
+
+        try:
+            regex = re.compile(pattern.encode())
+        except (re.error, AttributeError) as excpt:
+            raise ValueError(f"Invalid watch pattern {pattern!r}: {excpt}") from excpt
+        if regex.search(b"") is not None:
+            # would match every line
+            raise ValueError(f"Watch pattern {pattern!r} matches the empty string")
+
+        self.pattern = pattern
+        self.regex = regex
+        self.action = action
+        self.name = pattern if name is None else name
+        self.once = once
+
+    def to_config(self) -> Dict[str, Any]:
+        return {"pattern": self.pattern, "action": self.action, "name": self.name, "once": self.once}
+
+    def __str__(self):
+        return f"{self.__class__.__name__}({self.name}: {self.action})"
+
+
+def watch_rules_from_config(config: Optional[List[Dict[str, Any]]]) -> List[WatchRule]:
+    """
+    Creates the rules from the "watch" entry of a process config, e.g.
+    [{"pattern": "Listening on", "action": "ready"}, {"pattern": "Traceback"}]
+    """
+    if not config:
+        return []
+
+    try:
+        return [WatchRule(**rule) for rule in config]
+    except TypeError as excpt:
+        raise ValueError(f"Invalid watch rules {config}: {excpt}") from excpt
+
+
+class OutputWatcher:
+    """
+    Matches all rules of a process at once: the patterns are combined into a
+    single regex which is run on whole output chunks instead of every line,
+    only the lines it finds are matched with the pattern of every rule.
+    Patterns match within a single line and must not contain named groups or
+    back references.
+    """
+
+    def __init__(self, rules: List[WatchRule]):
+        self.rules = list(rules)
+        self._done = set()
+
+        # The plain alternation keeps the literal prefix optimizations of the
+        # regex engine and is used to find candidate lines. It finds one
+        # alternative per position, the rules are matched separately as their
+        # matches may overlap.
+        patterns = [rule.pattern.encode() for rule in self.rules]
+        try:
+            self._prefilter = re.compile(b"|".join(patterns), re.MULTILINE)
+        except re.error as excpt:
+            raise ValueError(f"Invalid watch pattern: {excpt}") from excpt
+
+    def scan(self, chunk: bytes) -> List[Tuple[WatchRule, bytes]]:
+        """
+        Returns the matching rules together with the line they matched.
+        """
+        matches = []
+        if not self.rules:
+            return matches
+
+        position = 0
+        while True:
+            candidate = self._prefilter.search(chunk, position)
+            if candidate is None:
+                return matches
+
+            line_start = chunk.rfind(b"\n", 0, candidate.start()) + 1
+            line_end = chunk.find(b"\n", candidate.end())
+            if line_end < 0:
+                line_end = len(chunk)
+
+            line = chunk[line_start:line_end]
+            for rule in self.rules:
+                if rule.once and rule in self._done:
+                    continue
+                if rule.regex.search(line) is not None:
+                    self._done.add(rule)
+                    matches.append((rule, line))
+
+            if line_end >= len(chunk):
+                return matches
+            position = line_end + 1
+
+    def reset(self) -> None:
+        self._done.clear()
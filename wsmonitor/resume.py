@@ -0,0 +1,86 @@
+import random
+from typing import Optional
+from urllib.parse import urlencode, parse_qs, urlsplit
+
+from wsmonitor.process.data import SyncEvent, StateChangedEvent, OutputEvent
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter: the n-th delay is a random value
+    between 0 and min(maximum, initial * factor ** n), which spreads the
+    reconnects of many clients after a server restart.
+    """
+
+    def __init__(self, initial: float = .5, maximum: float = 30., factor: float = 2.):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.attempts = 0
+
+    def next_delay(self) -> float:
+        limit = min(self.maximum, self.initial * self.factor ** self.attempts)
+        self.attempts += 1
+        return random.uniform(0, limit)
+
+    def reset(self) -> None:
+        self.attempts = 0
+
+
+class ResumeState:
+    """
+    The position of a client in the event streams of a server session. It is
+    sent when reconnecting so that the server only sends the missed events.
+    """
+
+    def __init__(self):
+        self.session: Optional[str] = None
+        self.seq = 0
+        self.offset = 0
+
+    def accept(self, event) -> bool:
+        """
+        Updates the position, returns False for events which have already
+        been received before.
+        """
+        if isinstance(event, SyncEvent):
+            if not event.resumed or event.session != self.session:
+                self.session = event.session
+                self.seq = event.seq
+                self.offset = event.offset
+            return True
+
+        if isinstance(event, StateChangedEvent) and event.seq is not None:
+            if event.seq <= self.seq:
+                return False
+            self.seq = event.seq
+
+        elif isinstance(event, OutputEvent) and event.offset is not None:
+            if event.offset <= self.offset:
+                return False
+            self.offset = event.offset
+
+        return True
+
+    def query(self) -> str:
+        if self.session is None:
+            return ""
+        return "?" + urlencode({"session": self.session, "seq": self.seq, "offset": self.offset})
+
+    def url(self, server_url: str) -> str:
+        return server_url.split("?", 1)[0] + self.query()
+
+    @staticmethod
+    def from_path(path: str) -> Optional['ResumeState']:
+        query = parse_qs(urlsplit(path or "").query)
+        if "session" not in query:
+            return None
+
+        state = ResumeState()
+        try:
+            state.session = query["session"][0]
+            state.seq = int(query.get("seq", ["0"])[0])
+            state.offset = int(query.get("offset", ["0"])[0])
+        except ValueError:
+            return None
+        return state
@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import zlib
+from typing import List, Dict, Any, Optional, Tuple, Union
+
+from wsmonitor.config import load_processes, schedule_autostart
+from wsmonitor.process.registry import ProcessRegistry, is_same_process_alive
+from wsmonitor.upstream import Upstream, UpstreamProcessMonitor
+from wsmonitor.util import run, set_loop_backend
+from wsmonitor.ws_process_monitor import WebsocketProcessMonitor
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def shard_for(uid: str, shards: int) -> int:
+    # stable across runs, unlike hash()
+    return zlib.crc32(uid.encode()) % shards
+
+
+def _exit_with_parent(parent_pid: int):
+    async def watch():
+        while os.getppid() == parent_pid:
+            await asyncio.sleep(1)
+        logger.warning("Front process %d is gone, shutting down", parent_pid)
+        os.kill(os.getpid(), signal.SIGTERM)
+    return asyncio.ensure_future(watch())
+
+
+def run_shard_worker(options: Dict[str, Any]) -> None:
+    """
+    Entry point of a worker process: a WebsocketProcessMonitor which only
+    listens on its unix socket.
+    """
+    # signals of the terminal go to the front, which stops the workers
+    os.setpgrp()
+    set_loop_backend(options["loop_backend"])
+
+    wpm = WebsocketProcessMonitor(options["output_timeout"])
+    if options["cgroup_root"] is not None:
+        # the front moved itself out of the root already
+        wpm.enable_cgroups(options["cgroup_root"])
+    if options["launcher"]:
+        wpm.enable_launcher()
+    if options["log_dir"] is not None:
+        wpm.enable_output_logs(options["log_dir"], **options["log_options"])
+    if options["registry_dir"] is not None:
+        wpm.enable_registry(os.path.join(options["registry_dir"], f"shard-{options['index']}"))
+        wpm.restore_registry(options["adopt"])
+    schedule_autostart(wpm, load_processes(wpm, options["processes"]))
+
+    watch_task = _exit_with_parent(options["parent_pid"])
+
+    async def shutdown():
+        watch_task.cancel()
+        await wpm.shutdown()
+
+    run(wpm.run(port=None, socket_path=options["socket_path"]), shutdown)
+
+
+class ShardWorker(Upstream):
+
+    def __init__(self, index: int, socket_path: str):
+        super().__init__(f"shard-{index}")
+        self.index = index
+        self.socket_path = socket_path
+        self.process: Optional[multiprocessing.Process] = None
+
+
+class ShardedProcessMonitor(UpstreamProcessMonitor):
+    """
+    Front of a sharded server: the processes are supervised by worker
+    processes, each one owns the processes whose uid hashes to it. The front
+    holds the websocket clients, routes the actions to the workers and
+    broadcasts their events, the protocol is the same as for a single
+    WebsocketProcessMonitor. Workers are reached via unix sockets.
+    """
+
+    def __init__(self, shards: int, output_broadcast_timeout=.5, worker_output_timeout=.05,
+                 log_dir: Optional[str] = None, log_options: Optional[Dict[str, Any]] = None,
+                 registry_dir: Optional[str] = None, adopt: bool = False,
+                 loop_backend: str = "default", cgroup_root: Optional[str] = None,
+                 launcher: bool = False, **kwargs):
+        super().__init__(output_broadcast_timeout, **kwargs)
+        if cgroup_root is not None and not self.enable_cgroups(cgroup_root):
+            cgroup_root = None
+        self.socket_dir = tempfile.mkdtemp(prefix="wsmonitor-")
+        os.chmod(self.socket_dir, 0o700)
+        self.workers = [ShardWorker(index, os.path.join(self.socket_dir, f"shard-{index}.sock"))
+                        for index in range(shards)]
+        for worker in self.workers:
+            self.add_upstream(worker)
+        # the process config of each shard, loaded by every run of its worker
+        self._shard_processes: List[List[Dict[str, Any]]] = [[] for _ in range(shards)]
+        # The workers always keep a registry, a restarted worker adopts the
+        # processes of its predecessor with adopt, otherwise they are killed
+        self._worker_options = {"output_timeout": worker_output_timeout, "log_dir": log_dir,
+                                "log_options": log_options or {},
+                                "registry_dir": self.socket_dir if registry_dir is None else registry_dir,
+                                "adopt": adopt, "loop_backend": loop_backend, "cgroup_root": cgroup_root,
+                                "launcher": launcher}
+        self._watch_task: Optional[asyncio.Task] = None
+
+    def locate(self, uid: str) -> Optional[Tuple[Upstream, str]]:
+        return self.workers[shard_for(uid, len(self.workers))], uid
+
+    def add_initial_processes(self, processes: List[Dict[str, Any]]) -> None:
+        # The initial configuration is loaded by the workers. Dependencies
+        # can only be resolved within a shard.
+        for process_config in processes:
+            self._shard_processes[shard_for(process_config["uid"], len(self.workers))].append(process_config)
+
+    async def _reload_processes(self, processes: List[Dict[str, Any]],
+                                restart: bool) -> Union[str, Dict[str, List[str]]]:
+        # every worker reloads its part of the config
+        parts: List[List[Dict[str, Any]]] = [[] for _ in self.workers]
+        for process_config in processes:
+            if not isinstance(process_config, dict) or not isinstance(process_config.get("uid", None), str):
+                return f"Invalid process config {process_config}"
+            parts[shard_for(process_config["uid"], len(self.workers))].append(process_config)
+
+        responses = await asyncio.gather(*(worker.client.request("reload", processes=part, restart=restart)
+                                           for worker, part in zip(self.workers, parts)))
+        result: Dict[str, List[str]] = {}
+        failures = []
+        for worker, response in zip(self.workers, responses):
+            if not response.success:
+                failures.append(f"{worker.name}: {response.data}")
+                continue
+            for key, uids in response.data.items():
+                result.setdefault(key, []).extend(uids)
+        for worker, part, response in zip(self.workers, parts, responses):
+            if response.success:
+                self._shard_processes[worker.index] = part
+        if failures:
+            return "Failed to reload the process config of " + ", ".join(failures)
+        return result
+
+    def _start_worker(self, worker: ShardWorker) -> None:
+        options = dict(self._worker_options, index=worker.index, socket_path=worker.socket_path,
+                       processes=self._shard_processes[worker.index], parent_pid=os.getpid())
+        worker.process = multiprocessing.get_context("spawn").Process(
+            target=run_shard_worker, args=(options,), name=f"wsmonitor-shard-{worker.index}", daemon=False)
+        worker.process.start()
+        logger.info("Started shard worker %d (pid %d)", worker.index, worker.process.pid)
+
+    def _kill_orphans(self, worker: ShardWorker) -> None:
+        # The processes of a dead worker are not supervised anymore. Those
+        # without a process group of their own are in the group of the worker.
+        groups = {worker.process.pid}
+        registry = ProcessRegistry(os.path.join(self._worker_options["registry_dir"], f"shard-{worker.index}"))
+        for entry in registry.load():
+            pid = entry.get("pid", None)
+            if pid is not None and is_same_process_alive(pid, entry.get("start_time", None)):
+                groups.add(pid if entry.get("pgid", None) is None else entry["pgid"])
+
+        for group in groups:
+            try:
+                os.killpg(group, signal.SIGKILL)
+            except OSError:
+                pass
+        logger.warning("Killed %d process groups of shard worker %d", len(groups), worker.index)
+
+    async def _watch_workers(self) -> None:
+        # restarts workers which died, their clients reconnect on their own
+        loop = asyncio.get_event_loop()
+        while self._is_monitor_running:
+            await asyncio.sleep(1)
+            for worker in self.workers:
+                if worker.process is not None and not worker.process.is_alive():
+                    logger.error("Shard worker %d exited with %s, restarting it",
+                                 worker.index, worker.process.exitcode)
+                    if not self._worker_options["adopt"]:
+                        await loop.run_in_executor(None, self._kill_orphans, worker)
+                    self._start_worker(worker)
+
+    async def run(self, host="127.0.0.1", port=8766, socket_path: Optional[str] = None,
+                  socket_mode: int = 0o600):
+        for worker in self.workers:
+            self._start_worker(worker)
+        await asyncio.gather(*(worker.client.connect_with_backoff(path=worker.socket_path)
+                               for worker in self.workers))
+        logger.info("Connected to %d shard workers", len(self.workers))
+
+        result = await super().run(host, port, socket_path, socket_mode)
+        self._watch_task = asyncio.ensure_future(self._watch_workers())
+        return result
+
+    async def shutdown(self):
+        # closes the connections to the workers
+        await super().shutdown()
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+
+        # the workers stop their processes on SIGTERM
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                os.kill(worker.process.pid, signal.SIGTERM)
+
+        loop = asyncio.get_event_loop()
+        for worker in self.workers:
+            if worker.process is not None:
+                await loop.run_in_executor(None, worker.process.join, 30)
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
@@ -0,0 +1,164 @@
+import asyncio
+import logging
+from typing import List, Dict, Any, Optional, Set, Tuple, Union
+
+from wsmonitor.process.data import ProcessData, ProcessSummaryEvent, StateChangedEvent, OutputEvent, \
+    ActionResponse, ActionFailure, MatchEvent
+from wsmonitor.process.index import matches
+from wsmonitor.ws_client import WSMonitorClient
+from wsmonitor.ws_monitor import ForwardClientAction, CallbackClientAction
+from wsmonitor.ws_process_monitor import WebsocketProcessMonitor
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# sent to an upstream on (re)connect
+_RESUBSCRIBE = object()
+
+
+class Upstream:
+
+    def __init__(self, name: str):
+        self.name = name
+        self.client = WSMonitorClient(reconnect=True, batch=True)
+        # the processes of the upstream by their uid on the front
+        self.processes: Dict[str, ProcessData] = {}
+        # the upstream uids whose output is forwarded, None for all
+        self.subscription: Any = None
+
+
+class UpstreamProcessMonitor(WebsocketProcessMonitor):
+    """
+    Re-exposes the processes of other servers: their processes, state
+    changes and output are merged and broadcast, actions for a process are
+    forwarded to its upstream. Every upstream is one persistent connection
+    on which requests are multiplexed. Upstreams only send the output
+    which the clients of this server subscribed to.
+    Subclasses define where a process lives with locate and front_uid.
+    """
+    ROUTED_ACTIONS = ("add", "remove", "start", "restart", "stop", "history", "usage")
+
+    def __init__(self, output_broadcast_timeout=.5, **kwargs):
+        super().__init__(output_broadcast_timeout, **kwargs)
+        self.upstreams: List[Upstream] = []
+
+        for action in self.ROUTED_ACTIONS:
+            self.known_actions[action] = ForwardClientAction(action, self._route)
+        self.known_actions["stats"] = CallbackClientAction("stats", [], self._stats_action)
+        self.metrics.gauge("wsmonitor_upstreams_connected", lambda: sum(
+            1 for upstream in self.upstreams if upstream.client.is_connected), "Connected upstream servers")
+
+    def locate(self, uid: str) -> Optional[Tuple[Upstream, str]]:
+        """
+        Returns the upstream of the process and its uid there.
+        """
+        raise NotImplementedError
+
+    def front_uid(self, upstream: Upstream, uid: str) -> str:
+        return uid
+
+    def add_upstream(self, upstream: Upstream) -> None:
+        upstream.client._on_event = lambda event: self._on_upstream_event(upstream, event)
+        upstream.client._on_connected = lambda: self._subscribe(upstream, _RESUBSCRIBE)
+        self.upstreams.append(upstream)
+
+    def get_processes(self) -> List[ProcessData]:
+        return [data for upstream in self.upstreams for data in upstream.processes.values()]
+
+    def query_processes(self, states: Optional[List[str]] = None,
+                        labels: Optional[Dict[str, str]] = None, prefix: Optional[str] = None,
+                        failed: Optional[bool] = None) -> List[ProcessData]:
+        # scans the cached processes of the upstreams
+        return sorted((data for data in self.get_processes() if matches(data, states, labels, prefix, failed)),
+                      key=lambda data: data.uid)
+
+    async def shutdown(self):
+        await super().shutdown()
+        for upstream in self.upstreams:
+            await upstream.client.close()
+
+    async def on_subscriptions_changed(self) -> None:
+        uids = self.subscribed_uids()
+        wanted: Dict[Upstream, Optional[Set[str]]] = {upstream: None if uids is None else set()
+                                                      for upstream in self.upstreams}
+        for uid in uids or ():
+            located = self.locate(uid)
+            if located is not None:
+                wanted[located[0]].add(located[1])
+
+        await asyncio.gather(*(self._subscribe(upstream, subscription)
+                               for upstream, subscription in wanted.items()))
+
+    async def _subscribe(self, upstream: Upstream, subscription) -> None:
+        if subscription is _RESUBSCRIBE:
+            subscription = upstream.subscription
+        elif subscription == upstream.subscription:
+            return
+
+        upstream.subscription = subscription
+        if not upstream.client.is_connected:
+            # sent once connected
+            return
+        response = await upstream.client.request(
+            "subscribe", uids=None if subscription is None else sorted(subscription))
+        if not response.success:
+            logger.warning("Failed to subscribe to the output of %s: %s", upstream.name, response.data)
+
+    async def _on_upstream_event(self, upstream: Upstream, event) -> None:
+        if isinstance(event, ProcessSummaryEvent):
+            processes = {}
+            for data in event.processes:
+                data.uid = self.front_uid(upstream, data.uid)
+                processes[data.uid] = data
+            if processes.keys() != upstream.processes.keys():
+                # processes were added or removed, send a summary and make
+                # resuming clients fetch it
+                self._next_state_seq(None)
+                self.trigger_periodic_event.set()
+            upstream.processes = processes
+
+        elif isinstance(event, StateChangedEvent):
+            event.uid = self.front_uid(upstream, event.uid)
+            data = upstream.processes.get(event.uid, None)
+            if data is not None:
+                data.state = event.state
+                data.exit_code = event.exit_code
+            # numbered again by the front
+            event.seq = None
+            self._state_event_queue.put_nowait(event)
+
+        elif isinstance(event, MatchEvent):
+            event.uid = self.front_uid(upstream, event.uid)
+            self._state_event_queue.put_nowait(event)
+
+        elif isinstance(event, OutputEvent):
+            event.uid = self.front_uid(upstream, event.uid)
+            event.offset = None
+            self._output_event_queue.put_nowait(event)
+
+    async def _route(self, action: str, data: Dict[str, Any]) -> ActionResponse:
+        uid = data.get("uid", None)
+        if not isinstance(uid, str):
+            return ActionFailure(None, action, "Missing keys: {'uid'}")
+
+        located = self.locate(uid)
+        if located is None:
+            return ActionFailure(uid, action, f"No upstream for process '{uid}'")
+
+        upstream, upstream_uid = located
+        response = await upstream.client.request(action, **dict(data, uid=upstream_uid))
+        response.uid = uid
+        response.request_id = None
+        return response
+
+    async def _reload_processes(self, processes: List[Dict[str, Any]],
+                                restart: bool) -> Union[str, Dict[str, List[str]]]:
+        # the processes are configured on the upstreams
+        return "Reloading the process config is not supported by this server"
+
+    async def _stats_action(self) -> ActionResponse:
+        responses = await asyncio.gather(*(upstream.client.request("stats") for upstream in self.upstreams))
+        return ActionResponse(None, "stats", True, {
+            "front": self.metrics.snapshot(),
+            "upstreams": {upstream.name: response.data if response.success else None
+                          for upstream, response in zip(self.upstreams, responses)}})
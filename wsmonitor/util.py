@@ -7,15 +7,50 @@ from typing import Coroutine, List, Type, Callable, Optional
 
 from wsmonitor.format import JsonFormattable
 from wsmonitor.process.data import ProcessSummaryEvent, StateChangedEvent, \
-    OutputEvent, ActionResponse
+    OutputEvent, ActionResponse, MatchEvent, SyncEvent, HandlesEvent, StateBatchEvent, JobEvent
 
 logger = logging.getLogger(__name__)
 
+LOOP_BACKENDS = ("default", "uvloop", "auto")
 
-def run(run: Coroutine, shutdown: Optional[Callable[[], Coroutine]] = None):
+
+def set_loop_backend(backend: str = "default") -> str:
+    """
+    Installs the event loop policy of the backend, "auto" uses uvloop if it
+    is installed. Falls back to the default loop if uvloop is missing and
+    returns the backend in use. Has to be called before the loop is created.
+    """
+    if backend in ("uvloop", "auto"):
+        try:
+            import uvloop
+        except ImportError:
+            if backend == "uvloop":
+                logger.warning("uvloop is not installed, using the default event loop")
+            backend = "default"
+        else:
+            if not isinstance(asyncio.get_event_loop_policy(), uvloop.EventLoopPolicy):
+                asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+                # uvloop does not create a loop in get_event_loop
+                asyncio.set_event_loop(asyncio.new_event_loop())
+            return "uvloop"
+
+    if backend != "default":
+        raise ValueError(f"Unknown event loop backend: {backend}")
+    if type(asyncio.get_event_loop_policy()) is not asyncio.DefaultEventLoopPolicy:
+        asyncio.set_event_loop_policy(asyncio.DefaultEventLoopPolicy())
+        asyncio.set_event_loop(asyncio.new_event_loop())
+    return backend
+
+
+def run(run: Coroutine, shutdown: Optional[Callable[[], Coroutine]] = None,
+        loop_backend: Optional[str] = None,
+        reload: Optional[Callable[[], Coroutine]] = None):
     # Similar to asyncio.run but we need to register signal_handlers as well
-    # and make sure to call our custom shutdown methods
+    # and make sure to call our custom shutdown methods, reload is called on
+    # SIGHUP
 
+    if loop_backend is not None:
+        logger.info("Using the %s event loop", set_loop_backend(loop_backend))
     loop = asyncio.get_event_loop()
     # loop.set_debug(True)
     main_task = asyncio.ensure_future(run)
@@ -35,15 +70,25 @@ def run(run: Coroutine, shutdown: Optional[Callable[[], Coroutine]] = None):
         except asyncio.CancelledError:
             pass
         except Exception as e:
-            logger.warning("Main task raised", exc_info=e)
+            # raised again by run
+            logger.debug("Main task raised", exc_info=e)
 
         loop.stop()
 
     def signal_handler():
         loop.create_task(initiate_shutdown())
 
+    def on_main_done(task: asyncio.Future):
+        # e.g. the server failed to start, the error is raised by run
+        if not task.cancelled() and task.exception() is not None:
+            loop.create_task(initiate_shutdown())
+
+    main_task.add_done_callback(on_main_done)
+
     loop.add_signal_handler(signal.SIGINT, signal_handler)
     loop.add_signal_handler(signal.SIGTERM, signal_handler)
+    if reload is not None:
+        loop.add_signal_handler(signal.SIGHUP, lambda: loop.create_task(reload()))
 
     try:
         logger.debug("Starting loop")
@@ -63,7 +108,9 @@ def run(run: Coroutine, shutdown: Optional[Callable[[], Coroutine]] = None):
 
 MESSAGE_TYPES: List[Type[JsonFormattable]] = [ProcessSummaryEvent,
                                               StateChangedEvent, OutputEvent,
-                                              ActionResponse]
+                                              ActionResponse, MatchEvent,
+                                              SyncEvent, HandlesEvent,
+                                              StateBatchEvent, JobEvent]
 
 
 def from_json(json_str: str):
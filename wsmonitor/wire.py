@@ -0,0 +1,167 @@
+import json
+import logging
+import struct
+from typing import Optional, Set, Iterable, Dict, List, Union, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from wsmonitor.process.data import OutputEvent, StateChangedEvent
+
+logger = logging.getLogger(__name__)
+
+# Optional protocol features, requested by a client in the query of the
+# connection url, e.g. ws://host:port/?features=binary. Clients which do not
+# request a feature never see it.
+FEATURE_BINARY = "binary"
+FEATURE_HANDLES = "handles"
+FEATURE_BATCH = "batch"
+FEATURES = {FEATURE_BINARY, FEATURE_HANDLES, FEATURE_BATCH}
+
+# Clients with the handles feature receive state changes and json output as
+# arrays: [kind, handle, state, exit code, seq] and
+# [kind, handle, output, chunks, offset], with the batch feature as well
+# state batches: [kind, [[handle, state, exit code, seq], ...]]
+KIND_STATE = "s"
+KIND_OUTPUT = "o"
+KIND_STATES = "S"
+
+FRAME_OUTPUT = 1
+
+# frame type, flags, uid length, chunk count, payload length, offset
+HEADER = struct.Struct("!BBHIIQ")
+# length in bytes, stream id, wall clock time in ms, monotonic time in us
+CHUNK = struct.Struct("!IBqq")
+
+
+def features_from_path(path: Optional[str]) -> Set[str]:
+    query = parse_qs(urlsplit(path or "").query)
+    requested = {feature for value in query.get("features", []) for feature in value.split(",")}
+    return requested & FEATURES
+
+
+def with_features(url: str, features: Iterable[str]) -> str:
+    features = ",".join(sorted(features))
+    if not features:
+        return url
+    return url + ("&" if "?" in url else "?") + "features=" + features
+
+
+class OutputFrame:
+    """
+    Output of a process as binary websocket frame. The raw output is
+    appended to the frame as it is read, the header and the chunk table are
+    written once the frame is complete:
+    header | uid | output | chunk table
+    """
+    __slots__ = ('uid', 'buffer', 'chunks', 'offset', '_payload_start')
+
+    def __init__(self, uid: str):
+        self.uid = uid
+        self.buffer = bytearray(HEADER.size)
+        self.buffer += uid.encode()
+        self._payload_start = len(self.buffer)
+        self.chunks = []
+        self.offset: Optional[int] = None
+
+    def __len__(self):
+        return len(self.buffer) - self._payload_start
+
+    def append(self, output: bytes, stream: int, wall: float, mono: float) -> None:
+        self.buffer += output
+        self.chunks.append((len(output), stream, int(wall * 1e3), int(mono * 1e6)))
+
+    def extend(self, event: OutputEvent) -> None:
+        for stream, wall, mono, output in event.iter_chunks():
+            self.append(output.encode(), stream, wall, mono)
+
+    @classmethod
+    def from_event(cls, event: OutputEvent) -> 'OutputFrame':
+        frame = cls(event.uid)
+        frame.extend(event)
+        return frame
+
+    def finish(self, offset: Optional[int]) -> bytearray:
+        """
+        Completes the frame, no output can be appended afterwards.
+        """
+        self.offset = offset
+        HEADER.pack_into(self.buffer, 0, FRAME_OUTPUT, 0, self._payload_start - HEADER.size,
+                         len(self.chunks), len(self), offset or 0)
+        for chunk in self.chunks:
+            self.buffer += CHUNK.pack(*chunk)
+        return self.buffer
+
+    def to_event(self) -> OutputEvent:
+        return _decode_output(self.uid, memoryview(self.buffer), self._payload_start, self.chunks, self.offset)
+
+
+def _decode_output(uid: str, view: memoryview, start: int, chunks, offset: Optional[int]) -> OutputEvent:
+    # the lengths of the event's chunks are in characters
+    texts = []
+    info = []
+    for length, stream, wall, mono in chunks:
+        text = str(view[start:start + length], "utf-8", "replace")
+        start += length
+        texts.append(text)
+        info.extend((len(text), stream, wall, mono))
+    return OutputEvent(uid, "".join(texts), info, offset)
+
+
+def decode_frame(data: bytes) -> Optional[OutputEvent]:
+    try:
+        frame_type, _, uid_length, chunk_count, payload_length, offset = HEADER.unpack_from(data, 0)
+        if frame_type != FRAME_OUTPUT:
+            logger.warning("Unknown frame type %d", frame_type)
+            return None
+
+        view = memoryview(data)
+        uid = str(view[HEADER.size:HEADER.size + uid_length], "utf-8")
+        start = HEADER.size + uid_length
+        table = start + payload_length
+        chunks = [CHUNK.unpack_from(data, table + idx * CHUNK.size) for idx in range(chunk_count)]
+    except (struct.error, UnicodeDecodeError) as excpt:
+        logger.warning("Invalid frame: %s", excpt)
+        return None
+    return _decode_output(uid, view, start, chunks, offset or None)
+
+
+def encode_compact(handle: int, event: Union[StateChangedEvent, OutputEvent]) -> str:
+    if isinstance(event, StateChangedEvent):
+        return json.dumps([KIND_STATE, handle, event.state, event.exit_code, event.seq])
+    return json.dumps([KIND_OUTPUT, handle, event.output, event.chunks, event.offset])
+
+
+def encode_compact_batch(entries: List[Tuple[int, StateChangedEvent]]) -> str:
+    return json.dumps([KIND_STATES, [[handle, event.state, event.exit_code, event.seq]
+                                     for handle, event in entries]])
+
+
+def split_compact_batch(message: list) -> List[list]:
+    # the single compact messages of a batch
+    return [[KIND_STATE] + entry for entry in message[1]]
+
+
+class HandleTable:
+    """
+    The uids of the handles a client received from the server.
+    """
+
+    def __init__(self):
+        self.uids: Dict[int, str] = {}
+
+    def update(self, handles: List[List]) -> None:
+        for handle, uid in handles:
+            self.uids[handle] = uid
+
+    def clear(self) -> None:
+        self.uids.clear()
+
+    def decode(self, message: list) -> Optional[Union[StateChangedEvent, OutputEvent]]:
+        """
+        Returns the event of a compact message, None if its handle is unknown.
+        """
+        uid = self.uids.get(message[1], None)
+        if uid is None:
+            return None
+        if message[0] == KIND_STATE:
+            return StateChangedEvent(uid, *message[2:5])
+        return OutputEvent(uid, *message[2:5])
@@ -1,14 +1,20 @@
 import asyncio
 import json
 import logging
+import time
 from asyncio import CancelledError
-from typing import Optional
+from collections import deque
+from typing import Optional, Dict, Deque, Set, Callable, Any, List, Union
 
 import websockets
 
 from wsmonitor import util
-from wsmonitor.process.data import ActionResponse, OutputEvent
+from wsmonitor.process.data import ActionResponse, OutputEvent, ActionFailure, HandlesEvent, SyncEvent, \
+    StateBatchEvent, JobEvent
+from wsmonitor.resume import Backoff, ResumeState
 from wsmonitor.util import from_json
+from wsmonitor.wire import FEATURE_BINARY, FEATURE_HANDLES, FEATURE_BATCH, KIND_STATES, decode_frame, \
+    with_features, split_compact_batch, HandleTable
 
 logger = logging.getLogger(__name__)
 
@@ -32,18 +38,56 @@ class AwaitedResponse:
 
 class WSMonitorClient:
 
-    def __init__(self):
+    def __init__(self, reconnect: bool = False, backoff: Optional[Backoff] = None,
+                 binary: bool = False, handles: bool = False, batch: bool = False):
         self.is_running = False
         self.is_connected = False
         self.websocket: Optional[websockets.WebSocketClientProtocol] = None
+        # reconnect automatically if the connection is lost
+        self.reconnect = reconnect
+        self.backoff = Backoff() if backoff is None else backoff
+        self.resume = ResumeState()
+        # receive the output as binary frames
+        self.binary = binary
+        # receive state changes and output with numeric handles
+        self.handles = handles
+        self.handle_table = HandleTable()
+        # receive state changes of several processes in one message, they
+        # are dispatched one by one
+        self.batch = batch
+        # messages waiting for the lookup of an unknown handle
+        self._pending: Deque = deque()
+        self._lookups: Set[int] = set()
+        self._unknown_handles: Set[int] = set()
+        self._flushing = False
+        self._address = ("127.0.0.1", 8766, None)
 
         self._awaited_response: Optional[AwaitedResponse] = None
         self._read_task: Optional[asyncio.Task] = None
-
-    async def connect(self, host="127.0.0.1", port=8766):
-        uri = f"ws://{host}:{port}"
+        self._requests: Dict[int, asyncio.Future] = {}
+        self._next_request_id = 0
+        # seconds to wait for the response of a request, None waits forever
+        self.request_timeout: Optional[float] = 60.
+        # the events of the jobs awaited by run_job, events of a job may
+        # arrive before the response which tells its id
+        self._jobs: Dict[int, asyncio.Queue] = {}
+        self._unclaimed_job_events: Dict[int, List[JobEvent]] = {}
+
+    async def connect(self, host="127.0.0.1", port=8766, path: Optional[str] = None):
+        """
+        Connects via TCP or, if path is given, via the unix socket at path.
+        """
+        self._address = (host, port, path)
+        # resumes the session of a previous connection
+        uri = with_features(self.resume.url(f"ws://{host}:{port}/"),
+                            [feature for feature, enabled in ((FEATURE_BINARY, self.binary),
+                                                              (FEATURE_HANDLES, self.handles),
+                                                              (FEATURE_BATCH, self.batch)) if enabled])
         try:
-            self.websocket = await websockets.connect(uri)
+            if path is not None:
+                self.websocket = await websockets.unix_connect(path, uri, max_size=None)
+            else:
+                self.websocket = await websockets.connect(uri, max_size=None)
         except Exception as excpt:
             logger.warning("Failed to connect to server: %s", excpt)
             self.is_connected = False
@@ -51,7 +95,23 @@ class WSMonitorClient:
 
         self.start_read_task()
         self.is_connected = True
+        self.backoff.reset()
         logger.debug("Client connected")
+        asyncio.ensure_future(self._on_connected())
+        return True
+
+    async def connect_with_backoff(self, host="127.0.0.1", port=8766,
+                                   path: Optional[str] = None,
+                                   max_attempts: Optional[int] = None):
+        attempts = 0
+        while not await self.connect(host, port, path):
+            attempts += 1
+            if max_attempts is not None and attempts >= max_attempts:
+                return False
+
+            delay = self.backoff.next_delay()
+            logger.info("Connection to server could not be established. Retrying in %.1fs", delay)
+            await asyncio.sleep(delay)
         return True
 
     async def action(self, action_name: str, **kwargs):
@@ -72,8 +132,80 @@ class WSMonitorClient:
 
         return response
 
+    async def request(self, action_name: str, **kwargs) -> ActionResponse:
+        """
+        Sends the action with a request id and returns the ActionResponse.
+        Other requests can be sent while waiting, the server handles them
+        concurrently. Fails after request_timeout seconds without response.
+        """
+        if not self.is_connected:
+            return ActionFailure(kwargs.get("uid", None), action_name, "Not connected")
+
+        self._next_request_id += 1
+        request_id = self._next_request_id
+        future = asyncio.get_event_loop().create_future()
+        self._requests[request_id] = future
+        try:
+            await self.websocket.send(json.dumps({"action": action_name, "data": kwargs, "id": request_id}))
+            return await asyncio.wait_for(future, self.request_timeout)
+        except websockets.WebSocketException as excpt:
+            return ActionFailure(kwargs.get("uid", None), action_name, f"Connection failed: {excpt}")
+        except asyncio.TimeoutError:
+            return ActionFailure(kwargs.get("uid", None), action_name,
+                                 f"No response within {self.request_timeout}s")
+        finally:
+            self._requests.pop(request_id, None)
+
+    async def run_job(self, action_name: str, on_progress: Optional[Callable[[Any], None]] = None,
+                      **kwargs) -> Union[JobEvent, ActionResponse]:
+        """
+        Runs a job action and waits for its end, on_progress is called with
+        the progress the job reports. Returns the last JobEvent of the job
+        or the failed response if it was not started.
+        """
+        response = await self.request(action_name, **kwargs)
+        if not response.success:
+            return response
+
+        job_id = response.data["job"]
+        queue = self._jobs[job_id] = asyncio.Queue()
+        for event in self._unclaimed_job_events.pop(job_id, []):
+            queue.put_nowait(event)
+        try:
+            while True:
+                event = await queue.get()
+                if event.state != JobEvent.PROGRESS:
+                    return event
+                if on_progress is not None:
+                    on_progress(event.data)
+        finally:
+            del self._jobs[job_id]
+
+    def _on_job_event(self, event: JobEvent) -> None:
+        queue = self._jobs.get(event.job, None)
+        if queue is not None:
+            queue.put_nowait(event)
+        elif event.state == JobEvent.PROGRESS:
+            # only the last progress is of interest
+            self._unclaimed_job_events[event.job] = [event]
+        else:
+            self._unclaimed_job_events.setdefault(event.job, []).append(event)
+        while len(self._unclaimed_job_events) > 100:
+            del self._unclaimed_job_events[next(iter(self._unclaimed_job_events))]
+
+    def _fail_requests(self, reason: str) -> None:
+        for future in self._requests.values():
+            if not future.done():
+                future.set_result(ActionFailure(None, "unknown", reason))
+        # the events of the jobs are lost with the connection
+        for job_id, queue in self._jobs.items():
+            queue.put_nowait(JobEvent(job_id, "unknown", JobEvent.FAILED, reason))
+
     async def _on_action_response(self, response: ActionResponse):
         logger.debug("Response: %s", response)
+        if self._awaited_response is None:
+            logger.warning("Received unexpected response '%s'", response.action)
+            return
         # assert response.action == action_name, f"{event.action} != {action_name}"
         if not self._awaited_response.set_if_match(response.action, response.data):
             logger.warning("Received response '%s' while expecting '%s'",
@@ -92,17 +224,108 @@ class WSMonitorClient:
                 data = await self.websocket.recv()
             except websockets.WebSocketException:
                 logger.info("Receiving message failed")
-                break
+                self.is_connected = False
+                self._fail_requests("Connection lost")
+                self._pending.clear()
+                self._lookups.clear()
+                if not self.reconnect:
+                    break
+                await self.connect_with_backoff(*self._address)
+                continue
+
+            if isinstance(data, bytes):
+                event = decode_frame(data)
+            elif data.startswith("["):
+                # compact message with a handle, decoded in order
+                message = json.loads(data)
+                if message[0] == KIND_STATES:
+                    self._pending.extend(split_compact_batch(message))
+                else:
+                    self._pending.append(message)
+                await self._flush_pending()
+                continue
+            else:
+                event = from_json(data)
+
+            if isinstance(event, StateBatchEvent):
+                for state_event in event.events:
+                    await self._receive(state_event)
+            else:
+                await self._receive(event)
+
+    async def _receive(self, event):
+        if isinstance(event, SyncEvent) and event.session != self.resume.session:
+            self.handle_table.clear()
+            self._unknown_handles.clear()
+        elif isinstance(event, HandlesEvent):
+            self.handle_table.update(event.handles)
+
+        if isinstance(event, ActionResponse):
+            # not delayed by pending messages, it may be a lookup
+            await self._dispatch(event)
+        elif self._pending:
+            self._pending.append(event)
+            await self._flush_pending()
+        else:
+            await self._dispatch(event)
 
-            event = from_json(data)
-            if isinstance(event, ActionResponse):
+    async def _dispatch(self, event):
+        if not self.resume.accept(event):
+            return
+
+        if isinstance(event, ActionResponse):
+            future = self._requests.get(event.request_id, None)
+            if future is not None:
+                if not future.done():
+                    future.set_result(event)
+            else:
                 await self._on_action_response(event)
+            return
 
-            elif isinstance(event, OutputEvent):
-                await self._on_output(event)
+        if isinstance(event, OutputEvent):
+            await self._on_output(event)
+        elif isinstance(event, JobEvent):
+            self._on_job_event(event)
+        if event is not None:
+            await self._on_event(event)
+
+    async def _flush_pending(self):
+        if self._flushing:
+            return
+        self._flushing = True
+        try:
+            while self._pending:
+                event = self._pending[0]
+                if isinstance(event, list):
+                    handle = event[1]
+                    if handle in self._unknown_handles:
+                        self._pending.popleft()
+                        continue
+                    event = self.handle_table.decode(event)
+                    if event is None:
+                        if handle not in self._lookups:
+                            self._lookups.add(handle)
+                            asyncio.ensure_future(self._lookup(handle))
+                        return
+                self._pending.popleft()
+                await self._dispatch(event)
+        finally:
+            self._flushing = False
+
+    async def _lookup(self, handle: int):
+        response = await self.request("handles", ids=[handle])
+        self._lookups.discard(handle)
+        if response.success:
+            self.handle_table.update(response.data)
+        if handle not in self.handle_table.uids:
+            logger.warning("Server does not know handle %d, dropping its events", handle)
+            self._unknown_handles.add(handle)
+        await self._flush_pending()
 
     async def close(self):
-        if not self.is_connected:
+        # stops a pending reconnect as well
+        self.reconnect = False
+        if not self.is_connected and (self._read_task is None or self._read_task.done()):
             logger.debug("Client is not connected, cannot close connection!")
             return
 
@@ -123,22 +346,56 @@ class WSMonitorClient:
     async def _on_output(self, event: OutputEvent):
         pass
 
+    async def _on_connected(self):
+        # called after every (re)connect, may send requests
+        pass
+
+    async def _on_event(self, event):
+        # called for every event except the action responses
+        pass
+
     def get_read_task(self):
         return self._read_task
 
 
-def run_single_action_client(host: str, port: int, action_name: str, **kwargs):
-    client = WSMonitorClient()
+def format_output(event: OutputEvent, stream: Optional[int] = None,
+                  timestamps: bool = False) -> str:
+    if stream is None and not timestamps:
+        return event.output
+
+    lines = []
+    for chunk_stream, wall, _, output in event.iter_chunks():
+        if stream is not None and chunk_stream != stream:
+            continue
+        if not timestamps:
+            lines.append(output)
+            continue
+
+        prefix = time.strftime("%H:%M:%S", time.localtime(wall)) + \
+            f".{int(wall * 1000) % 1000:03d} " + \
+            ("err " if chunk_stream == OutputEvent.STDERR else "out ")
+        lines.extend(prefix + line for line in output.splitlines(True))
+    return "".join(lines)
+
+
+def run_single_action_client(host: str, port: int, action_name: str,
+                             socket_path: Optional[str] = None, **kwargs):
+    # the output is followed across reconnects, actions are sent once
+    client = WSMonitorClient(reconnect=action_name == "output",
+                             binary=action_name == "output")
 
     async def main():
-        while not await client.connect(host, port):
-            logger.info("Connection to server could be established. Waiting 5s to retry")
-            await asyncio.sleep(5)
+        await client.connect_with_backoff(host, port, socket_path)
 
         result = None
         if action_name == "output":
+            uid = kwargs.get("uid", None)
+            stream = kwargs.get("stream", None)
+            timestamps = kwargs.get("timestamps", False)
+
             async def on_output(event: OutputEvent):
-                print(event.output, end="")
+                if not uid or event.uid == uid:
+                    print(format_output(event, stream, timestamps), end="")
 
             client._on_output = on_output
             try:
@@ -1,15 +1,28 @@
+import asyncio
+import contextvars
 import json
 import logging
-from typing import Dict, List, Any, Callable, Awaitable, Optional
+import os
+import socket
+import stat
+import time
+from collections import deque
+from concurrent.futures import Executor
+from typing import Dict, List, Any, Callable, Awaitable, Optional, Deque, Union, Set, Tuple
 
 import websockets
 from websockets import WebSocketException, ConnectionClosedOK
 
-from wsmonitor.process.data import ActionResponse, ActionFailure
+from wsmonitor.jobs import JobManager, EXECUTORS, LOOP
+from wsmonitor.metrics import Metrics, Histogram
+from wsmonitor.process.data import ActionResponse, ActionFailure, JobEvent
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# the websocket of the client whose action is being handled
+current_client: contextvars.ContextVar = contextvars.ContextVar("current_client", default=None)
+
 
 class ClientAction:
 
@@ -33,8 +46,8 @@ class CallbackClientAction(ClientAction):
         self.func = func
         self.defaults: Dict = {} if defaults is None else defaults
 
-    async def call_with_data(self, json_data: Dict[str, str]) -> ActionResponse:
-
+    def _fill_defaults(self, json_data: Dict[str, Any]) -> Optional[ActionResponse]:
+        # returns the failure if keys without a default are missing
         missing = set(self.keys) - set(json_data.keys())
         if len(missing) > 0:
             # check if all of the missing keys are set in the defaults
@@ -44,19 +57,180 @@ class CallbackClientAction(ClientAction):
             else:
                 return ActionFailure(None, self.action_id,
                                      f"Missing keys: {missing}")
+        return None
+
+    async def call_with_data(self, json_data: Dict[str, str]) -> ActionResponse:
+        failure = self._fill_defaults(json_data)
+        if failure is not None:
+            return failure
 
         response = await self.func(*(json_data[key] for key in self.keys))
         logger.info("Action '%s' result: %s", self.action_id, response)
         return response
 
 
+class JobClientAction(CallbackClientAction):
+    """
+    An action which runs as a job: it responds with the job id right away,
+    the client then receives JobEvents with the progress and the result.
+    func is called with the Job followed by the values of the keys. It is a
+    coroutine function on the loop, otherwise it runs on the thread or
+    process pool of jobs or on the given executor, see JobManager.start.
+    """
+
+    def __init__(self, action_id, keys: List[str], func: Callable,
+                 jobs: JobManager, executor: Union[str, Executor] = LOOP,
+                 defaults=None):
+        if not isinstance(executor, Executor) and executor not in EXECUTORS:
+            raise ValueError(f"Unknown executor '{executor}', expected one of {EXECUTORS}")
+        if executor == LOOP and not asyncio.iscoroutinefunction(func):
+            raise ValueError(f"The job of '{action_id}' runs on the loop and must be a coroutine function")
+        CallbackClientAction.__init__(self, action_id, keys, func, defaults)
+        self.jobs = jobs
+        self.executor = executor
+
+    async def call_with_data(self, json_data: Dict[str, Any]) -> ActionResponse:
+        failure = self._fill_defaults(json_data)
+        if failure is not None:
+            return failure
+
+        job = self.jobs.start(self.action_id, self.func, [json_data[key] for key in self.keys],
+                              self.executor, current_client.get())
+        return ActionResponse(None, self.action_id, True, {"job": job.id})
+
+
+class ForwardClientAction(ClientAction):
+    """
+    Passes the data of the action unchecked to func, e.g. to forward it to
+    another server.
+    """
+
+    def __init__(self, action_id,
+                 func: Callable[[str, Dict[str, Any]], Awaitable[ActionResponse]]):
+        ClientAction.__init__(self, action_id)
+        self.func = func
+
+    async def call_with_data(self, json_data: Dict[str, Any]) -> ActionResponse:
+        return await self.func(self.action_id, json_data)
+
+
+class ClientSender:
+    """
+    Sends the broadcasts to one client from its own task. The welcome
+    messages go first, then the messages of the priority lane. Queueing never
+    waits: a client which falls max_priority messages behind on the priority
+    lane or max_queued_size characters behind on the other one is
+    disconnected, it can resume the session once it reconnects.
+    """
+
+    def __init__(self, websocket, on_sent: Callable[[float], None],
+                 max_queued_size: int = 16 * 1024 * 1024, max_priority: int = 10000):
+        self.websocket = websocket
+        self.max_queued_size = max_queued_size
+        self.max_priority = max_priority
+        self.welcome: Deque = deque()
+        # (key, message), see put
+        self.priority: Deque[Tuple[Optional[str], Any]] = deque()
+        self.normal: Deque = deque()
+        self._normal_size = 0
+        self._closed = False
+        self._on_sent = on_sent
+        self._ready = asyncio.Event()
+        self._task = asyncio.ensure_future(self._send_loop())
+
+    def is_closed(self) -> bool:
+        return self._closed or self._task.done()
+
+    def put_welcome(self, message) -> None:
+        # only bounded by the resume history
+        self.welcome.append(message)
+        self._ready.set()
+
+    def put(self, message, priority: bool = False, key: Optional[str] = None) -> None:
+        """
+        Queues the message. A queued priority message with the same key, e.g.
+        an older summary, is dropped for the newer one at the end of the lane.
+        """
+        if priority:
+            if key is not None:
+                self.priority = deque(entry for entry in self.priority if entry[0] != key)
+            self.priority.append((key, message))
+            if len(self.priority) > self.max_priority and not self.is_closed():
+                self._disconnect(f"{len(self.priority)} updates")
+        else:
+            self.normal.append(message)
+            self._normal_size += len(message)
+            if self._normal_size > self.max_queued_size and not self.is_closed():
+                self._disconnect(f"{self._normal_size} characters of output")
+        if self.is_closed():
+            # the connection failed, the messages are dropped
+            self.welcome.clear()
+            self.priority.clear()
+            self.normal.clear()
+            self._normal_size = 0
+            return
+        self._ready.set()
+
+    def _disconnect(self, behind: str) -> None:
+        logger.warning("Client %s is %s behind, disconnecting it", self.websocket.remote_address, behind)
+        self._closed = True
+        self._task.cancel()
+        # the connection handler removes the client once it is closed
+        asyncio.ensure_future(self.websocket.close(1013, "Too slow to receive the updates"))
+
+    async def _send_loop(self) -> None:
+        try:
+            while True:
+                await self._ready.wait()
+                self._ready.clear()
+                while self.welcome or self.priority or self.normal:
+                    if self.welcome:
+                        message = self.welcome.popleft()
+                    elif self.priority:
+                        _, message = self.priority.popleft()
+                    else:
+                        message = self.normal.popleft()
+                        self._normal_size -= len(message)
+                    start = time.perf_counter()
+                    await self.websocket.send(message)
+                    self._on_sent(time.perf_counter() - start)
+        except WebSocketException as excpt:
+            # the connection handler removes the client
+            logger.warning("WS write failed: %s", excpt)
+
+    async def close(self) -> None:
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
 class WebsocketActionServer:
 
-    def __init__(self):
+    def __init__(self, metrics: Optional[Metrics] = None):
         super().__init__()
-        self.known_actions = {}  # type: Dict[str, ClientAction]
+        # runs the JobClientActions, see add_action
+        self.jobs = JobManager(self._send_job_event)
+        self.known_actions = {
+            "jobs": CallbackClientAction("jobs", [], self._jobs_action),
+            "cancel_job": CallbackClientAction("cancel_job", ["job"], self._cancel_job_action),
+        }  # type: Dict[str, ClientAction]
         self.server: Optional[websockets.server.WebSocketServer] = None
+        self.unix_server: Optional[websockets.server.WebSocketServer] = None
+        self.unix_socket_path: Optional[str] = None
         self.clients = set()
+        self._senders: Dict[Any, ClientSender] = {}
+        self.metrics = Metrics() if metrics is None else metrics
+        self.metrics.gauge("wsmonitor_clients", lambda: len(self.clients), "Connected websocket clients")
+        self.metrics.gauge("wsmonitor_send_queue_depth", lambda: {
+            (("lane", "welcome"),): sum(len(sender.welcome) for sender in self._senders.values()),
+            (("lane", "priority"),): sum(len(sender.priority) for sender in self._senders.values()),
+            (("lane", "normal"),): sum(len(sender.normal) for sender in self._senders.values())},
+            "Messages waiting to be sent to the clients")
+        self.metrics.gauge("wsmonitor_jobs_running", self.jobs.running, "Running job actions")
+        # the wsmonitor_action_seconds histogram of each known action
+        self._action_histograms: Dict[str, Histogram] = {}
 
     def add_action(self, name: str, action: ClientAction):
         if name in self.known_actions:
@@ -65,8 +239,30 @@ class WebsocketActionServer:
         self.known_actions[name] = action
         return True
 
+    def _send_job_event(self, client, event: JobEvent) -> None:
+        if client in self._senders:
+            asyncio.ensure_future(self.broadcast(event.to_json_str(), [client]))
+
+    async def _jobs_action(self) -> ActionResponse:
+        return ActionResponse(None, "jobs", True, [job.to_json() for job in self.jobs.get_jobs()])
+
+    async def _cancel_job_action(self, job_id: int) -> ActionResponse:
+        result = self.jobs.cancel(job_id)
+        if isinstance(result, str):
+            return ActionFailure(None, "cancel_job", result)
+        return ActionResponse(None, "cancel_job", True, result.to_json())
+
     async def stop_server(self):
         logger.info("Server shutdown triggered")
+        self.jobs.shutdown()
+        if self.unix_server is not None:
+            self.unix_server.close()
+            await self.unix_server.wait_closed()
+            self.unix_server = None
+            try:
+                os.unlink(self.unix_socket_path)
+            except OSError:
+                pass
         if self.server is None:
             logger.info("Server is None (not running)")
             return
@@ -86,12 +282,67 @@ class WebsocketActionServer:
         logger.info("Webserver started")
         return True
 
-    async def __on_client_connected(self, websocket, _):
+    async def start_unix_server(self, path: str, mode: int = 0o600):
+        # Access is controlled by the permissions of the socket file
+        logger.info("Starting server on unix socket %s", path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._remove_stale_socket(path)
+            # the socket is created with its permissions, the umask is only
+            # changed for the bind
+            umask = os.umask(0o777 & ~mode)
+            try:
+                sock.bind(path)
+            finally:
+                os.umask(umask)
+            self.unix_server = await websockets.unix_serve(self.__on_client_connected, sock=sock)
+            self.unix_socket_path = path
+        except Exception as excpt:
+            logger.error("Failed to start unix socket server: %s", excpt)
+            sock.close()
+            return False
+
+        return True
+
+    @staticmethod
+    def _remove_stale_socket(path: str) -> None:
+        # Only a socket left behind by a server which is gone is removed
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise FileExistsError(f"{path} exists and is not a socket")
+
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        probe.settimeout(1.)
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.unlink(path)
+            return
+        except OSError:
+            # e.g. a timeout, the server is busy
+            pass
+        finally:
+            probe.close()
+        raise FileExistsError(f"Another server is listening on {path}")
+
+    async def __on_client_connected(self, websocket, path):
         # TODO(mark) is every listen()-invocation, run in its own task?
-        self.clients.add(websocket)
-        logger.debug("Client added: %s", websocket)
+        histogram = self.metrics.histogram("wsmonitor_broadcast_seconds", "Time to send a broadcast to a client",
+                                           client=self._client_name(websocket))
+        self._senders[websocket] = ClientSender(websocket, histogram.observe)
+        current_client.set(websocket)
 
         try:
+            # Send initial information, queued ahead of the broadcasts the
+            # client receives from now on
+            await self.welcome_client(websocket, path)
+            self.clients.add(websocket)
+            logger.debug("Client added: %s", websocket)
+            await self.client_connected(websocket)
+
             await self.__client_loop_may_throw(websocket)
         except ConnectionClosedOK:
             pass
@@ -99,40 +350,86 @@ class WebsocketActionServer:
             logger.info("WebSocket connection error: %s", excpt)
 
         finally:
-            self.clients.remove(websocket)
+            self.clients.discard(websocket)
+            await self._senders.pop(websocket).close()
+            self.metrics.remove("wsmonitor_broadcast_seconds", client=self._client_name(websocket))
+            await self.client_disconnected(websocket)
             logger.debug("Client removed: %s", websocket)
 
-    async def welcome_client(self, websocket):
+    async def welcome_client(self, websocket, path: Optional[str] = None):
+        # Queue the initial messages with send_welcome. The client is not
+        # sent broadcasts yet, nothing may be awaited between taking the
+        # state and queueing it or changes in between are lost
         pass
 
-    async def __client_loop_may_throw(self,
-                                      websocket: websockets.WebSocketServerProtocol):
-        # Send initial information
-        await self.welcome_client(websocket)
+    async def send_welcome(self, websocket, message) -> None:
+        # sent ahead of everything else, this never waits
+        self._senders[websocket].put_welcome(message)
 
-        while True:
-            data = await websocket.recv()  # raises on close/error
+    async def client_connected(self, websocket):
+        pass
 
-            result = await self.__handle_input_from_client(data)
-            await websocket.send(result.to_json_str())
+    async def client_disconnected(self, websocket):
+        pass
 
-    async def broadcast(self, line: str):
-        # TODO(mark): this blocks the process processing application!
-        clients = self.clients.copy()
-        for client in clients:
+    async def __client_loop_may_throw(self,
+                                      websocket: websockets.WebSocketServerProtocol):
+        # the concurrently handled requests, cancelled on disconnect
+        requests: Set[asyncio.Future] = set()
+        try:
+            while True:
+                data = await websocket.recv()  # raises on close/error
+
+                try:
+                    json_data = json.loads(data)
+                except json.JSONDecodeError:
+                    json_data = None
+
+                # Actions with a request id are handled concurrently, their
+                # responses carry the id. Others are answered in order.
+                if isinstance(json_data, dict) and json_data.get("id", None) is not None:
+                    request = asyncio.ensure_future(self.__respond(websocket, data, json_data))
+                    requests.add(request)
+                    request.add_done_callback(requests.discard)
+                else:
+                    await self.__respond(websocket, data, json_data)
+        finally:
+            for request in requests:
+                request.cancel()
+
+    async def __respond(self, websocket, line: str, json_data):
+        if not isinstance(json_data, dict):
+            result = ActionFailure(None, "invalid", "Received invalid input: %s" % line)
+        else:
             try:
-                await client.send(line)
-            except WebSocketException as excpt:
-                logger.warning("WS write failed: %s", excpt)
-                # TODO(mark): assumption: __on_client_connected will remove the failed websocket
+                result = await self.__handle_action(json_data)
+            except Exception as excpt:
+                logger.warning("Action '%s' raised", json_data.get("action", None), exc_info=excpt)
+                result = ActionFailure(None, json_data.get("action", None),
+                                       f"Action failed: {excpt.__class__.__name__}: {excpt}")
+            result.request_id = json_data.get("id", None)
 
-    async def __handle_input_from_client(self, line: str) -> ActionResponse:
         try:
-            json_data = json.loads(line)
-        except json.JSONDecodeError:
-            return ActionFailure(None, "invalid",
-                                 "Received invalid input: %s" % line)
+            await websocket.send(result.to_json_str())
+        except WebSocketException as excpt:
+            logger.info("Failed to send the response of %s: %s", result.action, excpt)
+
+    @staticmethod
+    def _client_name(websocket) -> str:
+        address = websocket.remote_address
+        return "unknown" if not address else f"{address[0]}:{address[1]}"
+
+    async def broadcast(self, line: str, clients=None, priority: bool = False,
+                        key: Optional[str] = None):
+        # queued per client without waiting for slow ones, priority messages
+        # are sent ahead of the others, see ClientSender.put for the key
+        clients = self.clients.copy() if clients is None else clients
+        for client in clients:
+            sender = self._senders.get(client, None)
+            if sender is not None:
+                sender.put(line, priority, key)
 
+    async def __handle_action(self, json_data: Dict[str, Any]) -> ActionResponse:
         action_name = json_data.get("action", None)
         payload = json_data.get("data", None)
 
@@ -142,4 +439,12 @@ class WebsocketActionServer:
                                  f"Invalid action '{action_name}' or missing data")
 
         action = self.known_actions[action_name]
-        return await action.call_with_data(payload)
+        histogram = self._action_histograms.get(action_name, None)
+        if histogram is None:
+            histogram = self._action_histograms[action_name] = self.metrics.histogram(
+                "wsmonitor_action_seconds", "Time to handle an action", action=action_name)
+        start = time.perf_counter()
+        try:
+            return await action.call_with_data(payload)
+        finally:
+            histogram.observe(time.perf_counter() - start)
@@ -1,12 +1,23 @@
 import asyncio
 import logging
+import uuid
+from collections import deque
+from typing import Optional, List, Deque, Dict, Set, Union, Any
 
 import websockets
 
+from wsmonitor.config import read_process_config, reload_processes
+from wsmonitor.metrics import Metrics, serve_prometheus
 from wsmonitor.process.data import ProcessSummaryEvent, StateChangedEvent, \
-    OutputEvent, ActionResponse, ActionFailure
+    OutputEvent, ActionResponse, ActionFailure, SyncEvent, HandlesEvent, ProcessData, StateBatchEvent
+from wsmonitor.process.index import check_labels
 from wsmonitor.process.process_monitor import ProcessMonitor
-from wsmonitor.ws_monitor import WebsocketActionServer, CallbackClientAction
+from wsmonitor.process.output_limit import output_limit_from_config
+from wsmonitor.process.watch import watch_rules_from_config
+from wsmonitor.resume import ResumeState
+from wsmonitor.wire import OutputFrame, FEATURE_BINARY, FEATURE_HANDLES, FEATURE_BATCH, features_from_path, \
+    encode_compact, encode_compact_batch
+from wsmonitor.ws_monitor import WebsocketActionServer, CallbackClientAction, current_client
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -14,11 +25,53 @@ logger.setLevel(logging.INFO)
 
 class WebsocketProcessMonitor(ProcessMonitor, WebsocketActionServer):
 
-    def __init__(self, output_broadcast_timeout=.5):
-        ProcessMonitor.__init__(self)
-        WebsocketActionServer.__init__(self)
+    def __init__(self, output_broadcast_timeout=.5, resume_history=10000,
+                 resume_output_size=1024 * 1024, metrics_port: Optional[int] = None,
+                 state_coalesce_timeout=.02):
+        metrics = Metrics()
+        ProcessMonitor.__init__(self, metrics)
+        WebsocketActionServer.__init__(self, metrics)
+        # serves the metrics for Prometheus on localhost if set
+        self.metrics_port = metrics_port
+        self._metrics_server: Optional[asyncio.AbstractServer] = None
 
-        self._output_queue = {}
+        # pending output by uid, local output is collected in binary frames
+        self._output_queue: Dict[str, Union[OutputFrame, OutputEvent]] = {}
+        # Reconnecting clients of the same session only receive the state
+        # changes and output they missed, as long as it is still kept here.
+        # None in the state history marks an added or removed process.
+        self.session = uuid.uuid4().hex
+        self._state_seq = 0
+        self._state_history: Deque[Optional[StateChangedEvent]] = deque(maxlen=resume_history)
+        self._output_offset = 0
+        self._output_history: Deque[Union[OutputFrame, OutputEvent]] = deque()
+        self._output_history_size = 0
+        self.resume_output_size = resume_output_size
+        # uids whose output a client subscribed to, clients without an
+        # entry receive the output of all processes
+        self._subscriptions: Dict[websockets.WebSocketServerProtocol, Set[str]] = {}
+        # clients which receive the output as binary frames
+        self._binary_clients: Set[websockets.WebSocketServerProtocol] = set()
+        # Clients with handles receive state changes and json output with a
+        # handle instead of the uid. The handles are assigned when they are
+        # first needed and kept for the session.
+        self._handle_clients: Set[websockets.WebSocketServerProtocol] = set()
+        self._handles: Dict[str, int] = {}
+        self._handle_uids: List[str] = []
+        # clients which receive the state changes of several processes in
+        # one StateBatchEvent
+        self._batch_clients: Set[websockets.WebSocketServerProtocol] = set()
+        # State changes are collected for state_coalesce_timeout, only the
+        # last change of a process is sent.
+        self.state_coalesce_timeout = state_coalesce_timeout
+        self._pending_states: Dict[str, StateChangedEvent] = {}
+        self._states_pending = asyncio.Event()
+        self._coalesced_states = self.metrics.counter("wsmonitor_state_events_coalesced_total",
+                                                      "State changes replaced by a later one before sending")
+        # the --initial process config, re-read by reload_config
+        self.config_path: Optional[str] = None
+        # SIGHUP and the reload action are applied one after the other
+        self._reload_lock = asyncio.Lock()
         self.periodic_update_timeout = 30
         self.periodic_output_broadcast = output_broadcast_timeout
         self.trigger_periodic_event = asyncio.Event()
@@ -26,9 +79,14 @@ class WebsocketProcessMonitor(ProcessMonitor, WebsocketActionServer):
 
         self.known_actions.update({
             "add": CallbackClientAction("add", ["uid", "cmd", "group",
-                                                "command_kwargs"],
+                                                "command_kwargs", "watch",
+                                                "labels", "limits", "output_limit"],
                                         self.__add_action,
-                                        defaults={"command_kwargs": None}),
+                                        defaults={"command_kwargs": None,
+                                                  "watch": None,
+                                                  "labels": None,
+                                                  "limits": None,
+                                                  "output_limit": None}),
             "remove": CallbackClientAction("remove", ["uid"],
                                            self.__remove_action),
             "start": CallbackClientAction("start", ["uid", "command_kwargs"],
@@ -40,18 +98,125 @@ class WebsocketProcessMonitor(ProcessMonitor, WebsocketActionServer):
                                             defaults={"command_kwargs": {}}),
             "stop": CallbackClientAction("stop", ["uid"], self.__stop_action),
             "list": CallbackClientAction("list", [], self.__list_action),
+            "query": CallbackClientAction("query",
+                                          ["state", "labels", "prefix", "failed",
+                                           "offset", "limit", "fields"],
+                                          self.__query_action,
+                                          defaults={"state": None,
+                                                    "labels": None,
+                                                    "prefix": None,
+                                                    "failed": None,
+                                                    "offset": 0,
+                                                    "limit": None,
+                                                    "fields": None}),
+            "stats": CallbackClientAction("stats", [], self.__stats_action),
+            "usage": CallbackClientAction("usage", ["uid"], self.__usage_action),
+            "history": CallbackClientAction("history",
+                                            ["uid", "start", "count", "since"],
+                                            self.__history_action,
+                                            defaults={"start": None,
+                                                      "count": 100,
+                                                      "since": None}),
+            "subscribe": CallbackClientAction("subscribe", ["uids"],
+                                              self.__subscribe_action,
+                                              defaults={"uids": None}),
+            "handles": CallbackClientAction("handles", ["ids"],
+                                            self.__handles_action),
+            "reload": CallbackClientAction("reload", ["restart", "processes"],
+                                           self.__reload_action,
+                                           defaults={"restart": False,
+                                                     "processes": None}),
         })
 
     async def welcome_client(self,
-                             websocket: websockets.WebSocketClientProtocol):
-        await websocket.send(str(ProcessSummaryEvent(self.get_processes())))
+                             websocket: websockets.WebSocketClientProtocol,
+                             path: Optional[str] = None):
+        features = features_from_path(path)
+        binary = FEATURE_BINARY in features
+        compact = FEATURE_HANDLES in features
+        batch = FEATURE_BATCH in features
+        resume = ResumeState.from_path(path)
+        missed_states = self._missed_state_events(resume)
+        if binary:
+            self._binary_clients.add(websocket)
+        if batch:
+            self._batch_clients.add(websocket)
+        if compact:
+            for uid in [data.uid for data in self.get_processes()] + [event.uid for event in missed_states or ()]:
+                await self._handle(uid)
+            self._handle_clients.add(websocket)
 
-    async def run(self, host="127.0.0.1", port=8766):
+        await self.send_welcome(websocket, SyncEvent(self.session, self._state_seq, self._output_offset,
+                                                     missed_states is not None).to_json_str())
+        if compact:
+            # later handles are announced when they are first used
+            handles = [[handle, uid] for handle, uid in enumerate(self._handle_uids, 1)]
+            await self.send_welcome(websocket, HandlesEvent(handles).to_json_str())
+
+        if missed_states is None:
+            await self.send_welcome(websocket, ProcessSummaryEvent(self.get_processes()).to_json_str())
+        else:
+            logger.info("Resuming client at state %d, output %d", resume.seq, resume.offset)
+            for message in self._state_messages(missed_states, batch, compact):
+                await self.send_welcome(websocket, message)
+            for output in list(self._output_history):
+                if output.offset > resume.offset:
+                    await self.send_welcome(websocket, self._output_message(output, binary, compact))
+
+    async def client_connected(self, websocket):
+        await self.on_subscriptions_changed()
+
+    async def client_disconnected(self, websocket):
+        self._subscriptions.pop(websocket, None)
+        self._binary_clients.discard(websocket)
+        self._handle_clients.discard(websocket)
+        self._batch_clients.discard(websocket)
+        await self.on_subscriptions_changed()
+
+    def _missed_state_events(self, resume: Optional[ResumeState]) -> Optional[List[StateChangedEvent]]:
+        # None if the client has to be sent a full summary
+        if resume is None or resume.session != self.session or resume.seq > self._state_seq:
+            return None
+
+        missed = self._state_seq - resume.seq
+        if missed > len(self._state_history):
+            return None
+
+        events = list(self._state_history)[len(self._state_history) - missed:]
+        if any(event is None for event in events):
+            return None
+        if self._output_gap(resume.offset):
+            # the output the client missed is no longer kept
+            return None
+        return events
+
+    def _output_gap(self, offset: int) -> bool:
+        oldest = self._output_history[0].offset if self._output_history else self._output_offset + 1
+        return oldest > offset + 1
+
+    def _next_state_seq(self, event: Optional[StateChangedEvent]) -> int:
+        self._state_seq += 1
+        self._state_history.append(event)
+        return self._state_seq
+
+    async def run(self, host="127.0.0.1", port=8766, socket_path: Optional[str] = None,
+                  socket_mode: int = 0o600):
+        # TCP is not served if port is None, the unix socket if socket_path is set
         # TODO(mark): the server seems to cause problems with other task (they are not scheduled?)
         # therefore start in another task
-        server_task = asyncio.ensure_future(self.start_server(host, port))
+        # Raises an OSError if none of the servers could be started
+        server_task = None if port is None else asyncio.ensure_future(self.start_server(host, port))
+        serving = False
+        if socket_path is not None:
+            serving = await self.start_unix_server(socket_path, socket_mode)
+        if server_task is not None:
+            serving = await server_task or serving
+        if not serving:
+            raise OSError("Failed to start the server, see the log for details")
+        if self.metrics_port is not None:
+            self._metrics_server = await serve_prometheus(self.metrics, port=self.metrics_port)
         self.start_monitor()
-        return await server_task
+        return True
 
     async def shutdown(self):
         logger.info("Shutdown initiated")
@@ -59,13 +224,28 @@ class WebsocketProcessMonitor(ProcessMonitor, WebsocketActionServer):
         # stop process monitor and websocket server
         await ProcessMonitor.shutdown(self)
         await self.stop_server()
+        if self._metrics_server is not None:
+            self._metrics_server.close()
+            await self._metrics_server.wait_closed()
 
     async def __add_action(self, uid: str, cmd: str,
-                           group=True, command_kwargs=None) -> ActionResponse:
-        result = self.add_process(uid, cmd, group, command_kwargs)
+                           group=True, command_kwargs=None,
+                           watch=None, labels=None, limits=None,
+                           output_limit=None) -> ActionResponse:
+        try:
+            watch_rules = None if watch is None else watch_rules_from_config(watch)
+            result = self.add_process(uid, cmd, group, command_kwargs,
+                                      watch_rules=watch_rules, labels=labels,
+                                      limits=limits,
+                                      output_limit=None if output_limit is None else
+                                      output_limit_from_config(output_limit))
+        except ValueError as excpt:
+            return ActionFailure(uid, "add", str(excpt))
+
         if isinstance(result, str):
             return ActionFailure(uid, "add", result)
 
+        self._next_state_seq(None)
         self.trigger_periodic_event.set()
         return ActionResponse(uid, "add", True, True)
 
@@ -74,6 +254,7 @@ class WebsocketProcessMonitor(ProcessMonitor, WebsocketActionServer):
         if isinstance(result, str):
             return ActionFailure(uid, "remove", result)
 
+        self._next_state_seq(None)
         self.trigger_periodic_event.set()
         return ActionResponse(uid, "remove", True)
 
@@ -81,6 +262,152 @@ class WebsocketProcessMonitor(ProcessMonitor, WebsocketActionServer):
         payload = [proc.to_json() for proc in self.get_processes()]
         return ActionResponse(None, "list", True, payload)
 
+    async def __query_action(self, state, labels, prefix, failed, offset,
+                             limit, fields) -> ActionResponse:
+        if isinstance(state, str):
+            state = [state]
+        if state is not None and not (isinstance(state, list) and all(isinstance(item, str) for item in state)):
+            return ActionFailure(None, "query", "state must be a state or a list of states")
+        invalid = check_labels(labels)
+        if invalid is not None:
+            return ActionFailure(None, "query", invalid)
+        if prefix is not None and not isinstance(prefix, str):
+            return ActionFailure(None, "query", "prefix must be a string")
+        if failed is not None and not isinstance(failed, bool):
+            return ActionFailure(None, "query", "failed must be a boolean")
+        if not isinstance(offset, int) or offset < 0 or \
+                limit is not None and (not isinstance(limit, int) or limit < 0):
+            return ActionFailure(None, "query", "offset and limit must be positive integers")
+        if fields is not None:
+            if not isinstance(fields, list) or not all(isinstance(field, str) for field in fields) or \
+                    not set(fields) <= set(ProcessData.__slots__):
+                return ActionFailure(None, "query", f"fields must be a list of {', '.join(ProcessData.__slots__)}")
+            # the uid identifies the process in the result
+            fields = ["uid"] + [field for field in fields if field != "uid"]
+
+        processes = self.query_processes(state, labels, prefix, failed)
+        page = processes[offset:None if limit is None else offset + limit]
+        fields = ProcessData.__slots__ if fields is None else fields
+        return ActionResponse(None, "query", True, {
+            "total": len(processes), "offset": offset,
+            "processes": [{field: getattr(data, field) for field in fields} for data in page]})
+
+    async def __usage_action(self, uid: str) -> ActionResponse:
+        result = self.get_usage(uid)
+        if isinstance(result, str):
+            return ActionFailure(uid, "usage", result)
+        return ActionResponse(uid, "usage", True, result)
+
+    async def __stats_action(self) -> ActionResponse:
+        return ActionResponse(None, "stats", True, self.metrics.snapshot())
+
+    async def __subscribe_action(self, uids) -> ActionResponse:
+        websocket = current_client.get()
+        if uids is None:
+            self._subscriptions.pop(websocket, None)
+        elif isinstance(uids, list) and all(isinstance(uid, str) for uid in uids):
+            self._subscriptions[websocket] = set(uids)
+        else:
+            return ActionFailure(None, "subscribe", "uids must be a list of strings or null")
+
+        await self.on_subscriptions_changed()
+        return ActionResponse(None, "subscribe", True, uids)
+
+    async def reload_config(self, processes: Optional[List[Dict[str, Any]]] = None,
+                            restart: bool = False) -> Union[str, Dict[str, List[str]]]:
+        """
+        Applies the changes of the process config, read from config_path
+        unless processes are given. See config.reload_processes.
+        """
+        async with self._reload_lock:
+            return await self.__reload_config(processes, restart)
+
+    async def __reload_config(self, processes: Optional[List[Dict[str, Any]]],
+                              restart: bool) -> Union[str, Dict[str, List[str]]]:
+        if processes is None:
+            if self.config_path is None:
+                return "No process config to reload"
+            try:
+                processes = await asyncio.get_event_loop().run_in_executor(
+                    None, read_process_config, self.config_path)
+            except (OSError, ValueError) as excpt:
+                logger.error("Failed to read the process config %s: %s", self.config_path, excpt)
+                return f"Failed to read the process config: {excpt}"
+        if not isinstance(processes, list):
+            return "processes must be a list of process configs"
+
+        result = await self._reload_processes(processes, restart)
+        if isinstance(result, str):
+            logger.error("Failed to reload the process config: %s", result)
+        elif any(result[key] for key in ("added", "updated", "restarted", "removed")):
+            self._next_state_seq(None)
+            self.trigger_periodic_event.set()
+        return result
+
+    async def _reload_processes(self, processes: List[Dict[str, Any]],
+                                restart: bool) -> Union[str, Dict[str, List[str]]]:
+        return await reload_processes(self, processes, restart)
+
+    async def __reload_action(self, restart, processes) -> ActionResponse:
+        result = await self.reload_config(processes, bool(restart))
+        if isinstance(result, str):
+            return ActionFailure(None, "reload", result)
+        return ActionResponse(None, "reload", True, result)
+
+    async def _handle(self, uid: str) -> int:
+        handle = self._handles.get(uid, None)
+        if handle is None:
+            self._handle_uids.append(uid)
+            handle = self._handles[uid] = len(self._handle_uids)
+            if self._handle_clients:
+                await self.broadcast(HandlesEvent([[handle, uid]]).to_json_str(), list(self._handle_clients),
+                                     priority=True)
+        return handle
+
+    async def __handles_action(self, ids) -> ActionResponse:
+        if not isinstance(ids, list):
+            return ActionFailure(None, "handles", "ids must be a list of handles")
+        handles = [[handle, self._handle_uids[handle - 1]] for handle in ids
+                   if isinstance(handle, int) and 0 < handle <= len(self._handle_uids)]
+        return ActionResponse(None, "handles", True, handles)
+
+    def subscribed_uids(self) -> Optional[Set[str]]:
+        """
+        Returns the uids whose output any client subscribed to, None if a
+        client receives all output.
+        """
+        uids = set()
+        for websocket in self.clients:
+            subscription = self._subscriptions.get(websocket, None)
+            if subscription is None:
+                return None
+            uids |= subscription
+        return uids
+
+    async def on_subscriptions_changed(self) -> None:
+        pass
+
+    def _output_clients(self, uid: str):
+        # None for all clients
+        if not self._subscriptions:
+            return None
+        return [websocket for websocket in self.clients
+                if websocket not in self._subscriptions or uid in self._subscriptions[websocket]]
+
+    async def __history_action(self, uid: str, start, count,
+                               since) -> ActionResponse:
+        if start is not None and (isinstance(start, bool) or not isinstance(start, int)):
+            return ActionFailure(uid, "history", f"Invalid start: {start!r}, expected a line number")
+        if isinstance(count, bool) or not isinstance(count, int) or count < 0:
+            return ActionFailure(uid, "history", f"Invalid count: {count!r}, expected a number of lines")
+        if since is not None and (isinstance(since, bool) or not isinstance(since, (int, float))):
+            return ActionFailure(uid, "history", f"Invalid since: {since!r}, expected a timestamp")
+        result = await self.get_output_history(uid, start, count, since)
+        if isinstance(result, str):
+            return ActionFailure(uid, "history", result)
+
+        return ActionResponse(uid, "history", True, result)
+
     async def __start_action(self, uid: str, command_kwargs) -> ActionResponse:
         result = self.start_process(uid, **command_kwargs)
         if isinstance(result, str):
@@ -120,15 +447,80 @@ class WebsocketProcessMonitor(ProcessMonitor, WebsocketActionServer):
                          self.trigger_periodic_event.is_set())
             self.trigger_periodic_event.clear()
             event = ProcessSummaryEvent(self.get_processes())
-            await self.broadcast(event.to_json_str())
+            # a summary still queued for a slow client is outdated
+            await self.broadcast(event.to_json_str(), priority=True, key="summary")
 
     async def _periodic_output_broadcast(self) -> None:
         logger.info("Periodic output started")
         while self._is_monitor_running:
             await asyncio.sleep(self.periodic_output_broadcast)
-            for event in self._output_queue.values():
-                await self.broadcast(event.to_json_str())
+            pending = list(self._output_queue.values())
             self._output_queue.clear()
+            for output in pending:
+                self._output_offset += 1
+                if isinstance(output, OutputFrame):
+                    output.finish(self._output_offset)
+                else:
+                    output.offset = self._output_offset
+                self._keep_output(output)
+                await self._broadcast_output(output)
+
+    async def _broadcast_output(self, output: Union[OutputFrame, OutputEvent]) -> None:
+        clients = self._output_clients(output.uid)
+        if not self._binary_clients and not self._handle_clients:
+            await self.broadcast(self._output_event(output).to_json_str(), clients)
+            return
+
+        clients = self.clients.copy() if clients is None else clients
+        binary = [websocket for websocket in clients if websocket in self._binary_clients]
+        compact = [websocket for websocket in clients
+                   if websocket not in self._binary_clients and websocket in self._handle_clients]
+        text = [websocket for websocket in clients
+                if websocket not in self._binary_clients and websocket not in self._handle_clients]
+        if binary:
+            await self.broadcast(self._output_frame(output), binary)
+        if compact or text:
+            event = self._output_event(output)
+            if compact:
+                await self.broadcast(encode_compact(await self._handle(event.uid), event), compact)
+            if text:
+                await self.broadcast(event.to_json_str(), text)
+
+    def _output_message(self, output: Union[OutputFrame, OutputEvent], binary: bool, compact: bool):
+        if binary:
+            return self._output_frame(output)
+        event = self._output_event(output)
+        handle = self._handles.get(event.uid, None) if compact else None
+        return event.to_json_str() if handle is None else encode_compact(handle, event)
+
+    @staticmethod
+    def _output_event(output: Union[OutputFrame, OutputEvent]) -> OutputEvent:
+        return output.to_event() if isinstance(output, OutputFrame) else output
+
+    @staticmethod
+    def _output_frame(output: Union[OutputFrame, OutputEvent]) -> bytearray:
+        if isinstance(output, OutputFrame):
+            return output.buffer
+        return OutputFrame.from_event(output).finish(output.offset)
+
+    @staticmethod
+    def _output_size(output: Union[OutputFrame, OutputEvent]) -> int:
+        return len(output) if isinstance(output, OutputFrame) else len(output.output)
+
+    def _keep_output(self, output: Union[OutputFrame, OutputEvent]) -> None:
+        self._output_history.append(output)
+        self._output_history_size += self._output_size(output)
+        while self._output_history_size > self.resume_output_size and len(self._output_history) > 1:
+            self._output_history_size -= self._output_size(self._output_history.popleft())
+
+    def _queue_output(self, uid: str, output: bytes, stream: int, wall: float, mono: float) -> None:
+        # the raw output goes into the frame of the next broadcast, it is
+        # only decoded for clients which receive json
+        frame = self._output_queue.get(uid, None)
+        if not isinstance(frame, OutputFrame):
+            frame = OutputFrame(uid) if frame is None else OutputFrame.from_event(frame)
+            self._output_queue[uid] = frame
+        frame.append(output, stream, wall, mono)
 
     def _get_monitor_tasks(self):
         tasks = ProcessMonitor._get_monitor_tasks(self)
@@ -138,16 +530,59 @@ class WebsocketProcessMonitor(ProcessMonitor, WebsocketActionServer):
             self._periodic_update_func())
         tasks.append(periodic_output_task)
         tasks.append(periodic_state_update_task)
+        tasks.append(asyncio.ensure_future(self._state_batch_broadcast()))
         return tasks
 
     async def on_state_event(self, event: StateChangedEvent):
         logger.debug("Received state event: %s", event.to_json_str())
-        await self.broadcast(event.to_json_str())
+        if isinstance(event, StateChangedEvent):
+            # sent by _state_batch_broadcast
+            if self._pending_states.pop(event.uid, None) is not None:
+                self._coalesced_states.inc()
+            self._pending_states[event.uid] = event
+            self._states_pending.set()
+            return
+        # the queue carries MatchEvents as well, they are not resumed
+        await self.broadcast(event.to_json_str(), priority=True)
+
+    async def _state_batch_broadcast(self) -> None:
+        while self._is_monitor_running:
+            await self._states_pending.wait()
+            await asyncio.sleep(self.state_coalesce_timeout)
+            self._states_pending.clear()
+            events = list(self._pending_states.values())
+            self._pending_states.clear()
+            for event in events:
+                event.seq = self._next_state_seq(event)
+            if self._handle_clients:
+                for event in events:
+                    await self._handle(event.uid)
+
+            clients = self.clients.copy()
+            for batch in (False, True):
+                for compact in (False, True):
+                    group = [websocket for websocket in clients
+                             if (websocket in self._batch_clients) == batch
+                             and (websocket in self._handle_clients) == compact]
+                    if group:
+                        for message in self._state_messages(events, batch, compact):
+                            await self.broadcast(message, group, priority=True)
+
+    def _state_messages(self, events: List[StateChangedEvent], batch: bool, compact: bool) -> List[str]:
+        # the handles of compact messages have to be assigned before
+        if compact:
+            entries = [(self._handles[event.uid], event) for event in events]
+            if batch and len(entries) > 1:
+                return [encode_compact_batch(entries)]
+            return [encode_compact(handle, event) for handle, event in entries]
+        if batch and len(events) > 1:
+            return [StateBatchEvent(events).to_json_str()]
+        return [event.to_json_str() for event in events]
 
     async def on_output_event(self, event: OutputEvent):
-        logger.debug("Received output event: %s", event.to_json_str())
+        logger.debug("Received output event of %s", event.uid)
         output = self._output_queue.get(event.uid, None)
         if output is None:
             self._output_queue[event.uid] = event
         else:
-            self._output_queue[event.uid].output += event.output
+            output.extend(event)